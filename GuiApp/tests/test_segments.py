@@ -0,0 +1,109 @@
+"""
+Segmented mode on synthetic data: a signal split with plan_segments and
+crossfaded back must equal the original, and MIDI transcribed per segment
+must stitch back into the notes of the whole file.
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from wav2midi.audio import crossfade_segments, open_wav, write_array
+from wav2midi.segments import midi_agreement, plan_segments, stitch_midi
+
+RATE = 8000
+DURATION = 10.0
+LENGTH = 4.0
+OVERLAP = 1.0
+
+# (pitch, start, end) of the whole file; several notes cross a segment boundary
+NOTES = [
+    (60, 0.5, 1.0),
+    (62, 2.5, 3.5),   # inside the first overlap
+    (64, 2.0, 5.5),   # from the first segment into the second
+    (67, 3.9, 4.4),   # starts just before the first segment ends
+    (69, 5.2, 9.5),   # spans the second and third segment
+    (71, 8.0, 8.25),
+]
+
+
+def _signal(dtype):
+    t = np.arange(int(DURATION * RATE)) / RATE
+    left = 0.5 * np.sin(2 * np.pi * 220 * t) * np.linspace(0.2, 1.0, len(t))
+    right = 0.3 * np.sin(2 * np.pi * 331 * t + 0.5)
+    data = np.stack([left, right], axis=1)
+    if dtype == np.int16:
+        return np.round(data * 32767).astype(np.int16)
+    return data.astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.int16])
+def test_crossfade_restores_split_signal(tmp_path, dtype):
+    data = _signal(dtype)
+    windows = plan_segments(DURATION, LENGTH, OVERLAP)
+    assert len(windows) > 2
+
+    parts = []
+    for index, (start, end) in enumerate(windows):
+        path = tmp_path / f"{index:03d}.wav"
+        write_array(path, RATE, data[int(round(start * RATE)):int(round(end * RATE))])
+        parts.append((path, start))
+
+    output = tmp_path / "joined.wav"
+    crossfade_segments(parts, output, block_frames=1000)
+    rate, joined = open_wav(output)
+    assert rate == RATE
+    assert joined.dtype == data.dtype
+    assert joined.shape == data.shape
+    # Both sides of an overlap hold the same samples, so the fade only adds rounding
+    tolerance = 1 if dtype == np.int16 else 1e-5
+    assert np.abs(joined.astype(np.float64) - data.astype(np.float64)).max() <= tolerance
+
+
+def _write_midi(path, notes):
+    import pretty_midi
+
+    midi = pretty_midi.PrettyMIDI()
+    instrument = pretty_midi.Instrument(program=0)
+    for pitch, start, end in notes:
+        instrument.notes.append(pretty_midi.Note(velocity=100, pitch=pitch, start=start, end=end))
+    midi.instruments.append(instrument)
+    midi.write(str(path))
+
+
+def _segment_notes(start, end):
+    """What a transcriber sees in [start, end): notes clipped to the window, in window time."""
+    return [(pitch, max(s, start) - start, min(e, end) - start)
+            for pitch, s, e in NOTES if s < end and e > start]
+
+
+def test_stitched_midi_matches_whole_file(tmp_path):
+    pytest.importorskip("pretty_midi")
+    import pretty_midi
+
+    reference = tmp_path / "whole.mid"
+    _write_midi(reference, NOTES)
+
+    parts = []
+    for index, (start, end) in enumerate(plan_segments(DURATION, LENGTH, OVERLAP)):
+        path = tmp_path / f"{index:03d}.mid"
+        _write_midi(path, _segment_notes(start, end))
+        parts.append((path, start, end))
+
+    stitched = tmp_path / "stitched.mid"
+    stitch_midi(parts, stitched)
+
+    result = midi_agreement(reference, stitched)
+    assert result["candidate_notes"] == len(NOTES)
+    assert result["f1"] == pytest.approx(1.0)
+
+    # Notes crossing a boundary are joined back into one note of the full length
+    notes = sorted((n.pitch, n.start, n.end) for i in pretty_midi.PrettyMIDI(str(stitched)).instruments
+                   for n in i.notes)
+    for (pitch, start, end), expected in zip(notes, sorted(NOTES)):
+        assert pitch == expected[0]
+        assert start == pytest.approx(expected[1], abs=0.01)
+        assert end == pytest.approx(expected[2], abs=0.01)
@@ -0,0 +1,27 @@
+"""
+Headless Wav2Midi engine shared by the GUI and the batch CLI.
+
+The pipeline pulls in numpy and scipy, so it is only imported when one of
+its names is first used; `import wav2midi.models` (the BandIt registry)
+stays cheap enough for GUI startup.
+"""
+_PIPELINE_EXPORTS = {
+    "BanditSettings",
+    "ConversionOptions",
+    "ConversionResult",
+    "convert",
+    "convert_file",
+    "dry_run",
+}
+
+__all__ = sorted(_PIPELINE_EXPORTS | {"scan_bandit_models"})
+
+
+def __getattr__(name):
+    if name in _PIPELINE_EXPORTS:
+        from . import pipeline
+        return getattr(pipeline, name)
+    if name == "scan_bandit_models":
+        from .models import scan_bandit_models
+        return scan_bandit_models
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
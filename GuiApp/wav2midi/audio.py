@@ -0,0 +1,502 @@
+"""
+Block-wise WAV helpers.
+
+Stems of a feature-length soundtrack do not fit comfortably in memory, so
+everything here works on memory-mapped inputs in fixed-size blocks and
+streams the result to disk through WavWriter.
+
+Stems may also be stored as FLAC (ConversionOptions.stem_format). open_wav
+then returns a FlacFrames view that decodes the requested blocks on
+demand, and open_writer picks FlacWriter for a .flac output, so every
+function here reads and writes either format. soundfile is only imported
+when a FLAC file is actually used.
+
+Functions that read a stem also accept a (rate, array) pair instead of a
+path, for stems the in-process path keeps in memory (see
+ConversionOptions.in_process).
+"""
+import math
+import os
+import struct
+import threading
+from pathlib import Path
+
+import numpy as np
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+
+BLOCK_FRAMES = 1 << 16
+# Files treated as stems when a folder is scanned
+AUDIO_SUFFIXES = (".wav", ".flac")
+
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_IEEE_FLOAT = 3
+
+
+def stem_files(directory, recursive=False, suffixes=AUDIO_SUFFIXES):
+    """Sorted audio files (WAV or FLAC) in a folder."""
+    directory = Path(directory)
+    files = directory.rglob("*") if recursive else directory.glob("*")
+    return sorted(f for f in files if f.suffix.lower() in suffixes and f.is_file())
+
+
+class FlacFrames:
+    """
+    Read-only stand-in for a memory-mapped (frames, channels) array backed
+    by a FLAC file: slicing it decodes just those frames. 16-bit files read
+    as int16, deeper ones as int32 (full scale, like a 32-bit WAV).
+    """
+    ndim = 2
+
+    def __init__(self, path):
+        import soundfile
+
+        self._file = soundfile.SoundFile(str(path))
+        self.rate = self._file.samplerate
+        self.shape = (self._file.frames, self._file.channels)
+        self.size = self.shape[0] * self.shape[1]
+        self.dtype = np.dtype(np.int16 if self._file.subtype in ("PCM_16", "PCM_S8", "PCM_U8") else np.int32)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("FlacFrames only supports contiguous slices")
+        start, stop, _ = key.indices(self.shape[0])
+        with self._lock:
+            if self._file.tell() != start:
+                self._file.seek(start)
+            return self._file.read(max(0, stop - start), dtype=self.dtype.name, always_2d=True)
+
+    def close(self):
+        self._file.close()
+
+
+def open_wav(path):
+    """
+    Returns (rate, data) with data memory-mapped, shape (frames, channels).
+    FLAC files give a FlacFrames view instead, which supports the same
+    block-wise slicing.
+    """
+    if Path(path).suffix.lower() == ".flac":
+        data = FlacFrames(path)
+        return data.rate, data
+    rate, data = wavfile.read(str(path), mmap=True)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    return rate, data
+
+
+def open_source(source):
+    """(rate, data) of a path (see open_wav) or of a (rate, array) pair already in memory."""
+    if isinstance(source, tuple):
+        rate, data = source
+        return rate, data.reshape(-1, 1) if data.ndim == 1 else data
+    return open_wav(source)
+
+
+def to_float(block):
+    """Converts a block of samples to float64 in [-1, 1]."""
+    if block.dtype.kind == "f":
+        return block.astype(np.float64)
+    if block.dtype == np.uint8:
+        return (block.astype(np.float64) - 128.0) / 128.0
+    return block.astype(np.float64) / float(-np.iinfo(block.dtype).min)
+
+
+def from_float(block, dtype):
+    """Converts float samples in [-1, 1] to `dtype`, clipping instead of wrapping."""
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return block.astype(dtype)
+    if dtype == np.uint8:
+        return np.clip(np.round(block * 128.0 + 128.0), 0, 255).astype(dtype)
+    info = np.iinfo(dtype)
+    return np.clip(np.round(block * float(-info.min)), info.min, info.max).astype(dtype)
+
+
+class WavWriter:
+    """
+    Streams PCM / float WAV data to disk block by block. The file is written
+    under a temporary name and moved over `path` on close(), so readers (and
+    hard-linked cache entries) never see a half-written file.
+    """
+
+    def __init__(self, path, rate, channels, dtype):
+        self.path = Path(path)
+        self.rate = rate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.frames = 0
+        self._tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self._file = open(self._tmp_path, "wb")
+        self._write_header()
+
+    def _write_header(self):
+        fmt = _WAVE_FORMAT_IEEE_FLOAT if self.dtype.kind == "f" else _WAVE_FORMAT_PCM
+        block_align = self.channels * self.dtype.itemsize
+        data_size = self.frames * block_align
+        self._file.write(b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE")
+        self._file.write(b"fmt " + struct.pack("<IHHIIHH", 16, fmt, self.channels, self.rate,
+                                               self.rate * block_align, block_align, self.dtype.itemsize * 8))
+        self._file.write(b"data" + struct.pack("<I", data_size))
+
+    def write(self, block):
+        block = np.asarray(block, dtype=self.dtype)
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        self._file.write(block.astype(self.dtype.newbyteorder("<"), copy=False).tobytes())
+        self.frames += len(block)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FlacWriter:
+    """
+    WavWriter's counterpart for FLAC (lossless for 16/24-bit PCM). FLAC
+    has no float samples, so float data is stored as 24-bit, which is far
+    below anything a transcriber can hear.
+    """
+
+    def __init__(self, path, rate, channels, dtype):
+        import soundfile
+
+        self.path = Path(path)
+        self.rate = rate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.frames = 0
+        subtype = "PCM_16" if self.dtype.itemsize <= 2 and self.dtype.kind != "f" else "PCM_24"
+        self._tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self._file = soundfile.SoundFile(str(self._tmp_path), "w", rate, channels, subtype, format="FLAC")
+
+    def write(self, block):
+        block = np.asarray(block)
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        if block.dtype.kind == "f" or block.dtype == np.uint8:
+            # libsndfile wraps out-of-range floats around instead of clipping them
+            block = np.clip(to_float(block), -1.0, 1.0)
+        self._file.write(block)
+        self.frames += len(block)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def open_writer(path, rate, channels, dtype):
+    """WavWriter, or FlacWriter for a .flac path."""
+    if Path(path).suffix.lower() == ".flac":
+        return FlacWriter(path, rate, channels, dtype)
+    return WavWriter(path, rate, channels, dtype)
+
+
+def write_array(path, rate, data):
+    """Writes a (frames, channels) array to a WAV or FLAC file in its sample format."""
+    with open_writer(path, rate, data.shape[1], data.dtype) as writer:
+        writer.write(data)
+
+
+def _match_channels(block, channels):
+    if block.shape[1] == channels:
+        return block
+    if block.shape[1] == 1:
+        return np.repeat(block, channels, axis=1)
+    raise ValueError(f"Cannot mix {block.shape[1]} channels into {channels}")
+
+
+def _mix_blocks(arrays, out_dtype, block_frames):
+    """Yields the sum of `arrays` block by block, in out_dtype (see mix_stems)."""
+    channels = max(a.shape[1] for a in arrays)
+    frames = min(len(a) for a in arrays)
+    dtypes = {a.dtype for a in arrays}
+    exact = len(dtypes) == 1 and out_dtype in dtypes and out_dtype.kind == "i"
+    for start in range(0, frames, block_frames):
+        stop = min(start + block_frames, frames)
+        if exact:
+            info = np.iinfo(out_dtype)
+            acc = np.zeros((stop - start, channels), dtype=np.int64)
+            for a in arrays:
+                acc += _match_channels(a[start:stop], channels)
+            yield np.clip(acc, info.min, info.max).astype(out_dtype)
+        else:
+            acc = np.zeros((stop - start, channels), dtype=np.float64)
+            for a in arrays:
+                acc += to_float(_match_channels(a[start:stop], channels))
+            yield from_float(acc, out_dtype)
+
+
+def _open_mix_sources(sources, out_dtype):
+    opened = [open_source(s) for s in sources]
+    rates = {rate for rate, _ in opened}
+    if len(rates) != 1:
+        raise ValueError("Sample rates do not match!")
+    arrays = [data for _, data in opened]
+    return rates.pop(), arrays, np.dtype(out_dtype or arrays[0].dtype)
+
+
+def mix_arrays(sources, out_dtype=None, block_frames=BLOCK_FRAMES):
+    """mix_stems() into memory: returns (rate, array) instead of writing a file."""
+    rate, arrays, out_dtype = _open_mix_sources(sources, out_dtype)
+    blocks = list(_mix_blocks(arrays, out_dtype, block_frames))
+    if not blocks:
+        return rate, np.zeros((0, max(a.shape[1] for a in arrays)), dtype=out_dtype)
+    return rate, np.concatenate(blocks)
+
+
+def mix_stems(sources, output_file, out_dtype=None, block_frames=BLOCK_FRAMES):
+    """
+    Sums any number of WAV files (or (rate, array) pairs) into output_file
+    in a single pass.
+
+    Inputs are memory-mapped and processed `block_frames` at a time, so
+    memory stays flat regardless of duration. Sums are accumulated in a
+    wider type (int64 when every input shares one integer format, float64
+    otherwise) and clipped once, so nothing wraps around. The result is as
+    long as the shortest input and uses `out_dtype` (default: the first
+    input's format). output_file may be one of the inputs.
+    """
+    rate, arrays, out_dtype = _open_mix_sources(sources, out_dtype)
+    writer = open_writer(output_file, rate, max(a.shape[1] for a in arrays), out_dtype)
+    try:
+        for block in _mix_blocks(arrays, out_dtype, block_frames):
+            writer.write(block)
+    except BaseException:
+        writer.abort()
+        raise
+    # Release the memory maps before the result replaces one of the inputs
+    arrays = None
+    writer.close()
+
+
+def level_db(value):
+    """Linear amplitude (1.0 = full scale) to dBFS; -inf for digital silence."""
+    return float(20.0 * np.log10(value)) if value > 0 else float("-inf")
+
+
+def scan_levels(path, block_frames=BLOCK_FRAMES):
+    """Returns (peak_db, rms_db) of a WAV file (or (rate, array) pair) in dBFS, reading it block by block."""
+    _, data = open_source(path)
+    peak = 0.0
+    squares = 0.0
+    for start in range(0, len(data), block_frames):
+        block = to_float(data[start:start + block_frames])
+        peak = max(peak, float(np.abs(block).max(initial=0.0)))
+        squares += float(np.einsum("ij,ij->", block, block))
+    samples = data.size
+    data = None
+    return level_db(peak), level_db(np.sqrt(squares / samples) if samples else 0.0)
+
+
+def convert_wav(path, dtype=np.int16, block_frames=BLOCK_FRAMES):
+    """
+    Rewrites a WAV file in another sample format (e.g. float -> int16),
+    block by block and with clipping. Returns False if it already had it.
+    """
+    dtype = np.dtype(dtype)
+    rate, data = open_wav(path)
+    if data.dtype == dtype:
+        return False
+
+    writer = open_writer(path, rate, data.shape[1], dtype)
+    try:
+        for start in range(0, len(data), block_frames):
+            writer.write(from_float(to_float(data[start:start + block_frames]), dtype))
+    except BaseException:
+        writer.abort()
+        raise
+    data = None
+    writer.close()
+    return True
+
+
+def write_slice(path, start_frame, stop_frame, output_file, block_frames=BLOCK_FRAMES):
+    """Copies frames [start_frame, stop_frame) of a WAV file into output_file, in its sample format."""
+    rate, data = open_wav(path)
+    stop_frame = min(stop_frame, len(data))
+    writer = open_writer(output_file, rate, data.shape[1], data.dtype)
+    try:
+        for start in range(start_frame, stop_frame, block_frames):
+            writer.write(data[start:min(start + block_frames, stop_frame)])
+    except BaseException:
+        writer.abort()
+        raise
+    data = None
+    writer.close()
+
+
+def crossfade_segments(parts, output_file, block_frames=BLOCK_FRAMES):
+    """
+    Joins overlapping segments back into one file. `parts` is a list of
+    (path, start_seconds) in order; wherever two consecutive segments
+    overlap they are blended with a linear crossfade, elsewhere samples
+    are copied unchanged. The result uses the first segment's format.
+    """
+    opened = [open_wav(p) for p, _ in parts]
+    rates = {rate for rate, _ in opened}
+    if len(rates) != 1:
+        raise ValueError("Sample rates do not match!")
+    rate = rates.pop()
+
+    arrays = [data for _, data in opened]
+    out_dtype = arrays[0].dtype
+    channels = max(a.shape[1] for a in arrays)
+    # Segment boundaries are placed in seconds, so they hold for any output sample rate
+    starts = [int(round(start * rate)) for _, start in parts]
+    ends = [start + len(a) for start, a in zip(starts, arrays)]
+
+    def frames(i, start, stop):
+        block = _match_channels(arrays[i][start - starts[i]:stop - starts[i]], channels)
+        return block if block.dtype == out_dtype else from_float(to_float(block), out_dtype)
+
+    writer = open_writer(output_file, rate, channels, out_dtype)
+    try:
+        pos = starts[0]
+        for i in range(len(arrays)):
+            last = i == len(arrays) - 1
+            # Part covered by this segment alone
+            solo_end = ends[i] if last else min(ends[i], starts[i + 1])
+            for start in range(pos, solo_end, block_frames):
+                writer.write(frames(i, start, min(start + block_frames, solo_end)))
+            pos = max(pos, solo_end)
+            if last:
+                break
+
+            # Overlap with the next segment: fade this one out and the next one in
+            fade_start, fade_end = pos, min(ends[i], ends[i + 1])
+            for start in range(fade_start, fade_end, block_frames):
+                stop = min(start + block_frames, fade_end)
+                weight = ((np.arange(start, stop) - fade_start + 0.5) / (fade_end - fade_start)).reshape(-1, 1)
+                mixed = to_float(frames(i, start, stop)) * (1.0 - weight) + to_float(frames(i + 1, start, stop)) * weight
+                writer.write(from_float(mixed, out_dtype))
+            pos = max(pos, fade_end)
+    except BaseException:
+        writer.abort()
+        raise
+    arrays = opened = None
+    writer.close()
+
+
+def resample_wav(path, output_file, rate, channels=1, dtype=np.int16, block_frames=BLOCK_FRAMES):
+    """
+    Writes a WAV file resampled to `rate` and downmixed to `channels` (the
+    mean of the input channels, as librosa's to_mono) into output_file.
+
+    Uses scipy's polyphase resample_poly block by block. Every block is
+    read with enough extra input on both sides for the filter and starts
+    on a whole input step, so the result is the same as resampling the
+    whole file at once while memory stays flat.
+    """
+    in_rate, data = open_wav(path)
+    g = math.gcd(rate, in_rate)
+    up, down = rate // g, in_rate // g
+    frames = len(data)
+    # resample_poly's filter has 10 * max(up, down) taps per side at the upsampled rate
+    pad = math.ceil((10 * max(up, down) // up + 1) / down) * down
+    step = max(down, block_frames // down * down)
+
+    writer = open_writer(output_file, rate, channels, dtype)
+    try:
+        for start in range(0, frames, step):
+            stop = min(start + step, frames)
+            lo, hi = max(0, start - pad), min(frames, stop + pad)
+            block = to_float(data[lo:hi])
+            if channels == 1 and block.shape[1] > 1:
+                block = block.mean(axis=1, keepdims=True)
+            else:
+                block = _match_channels(block, channels)
+            if up != down:
+                block = resample_poly(block, up, down, axis=0)
+            # Output frames belonging to input frames [start, stop)
+            first = (start - lo) * up // down
+            count = math.ceil(stop * up / down) - start * up // down
+            writer.write(from_float(block[first:first + count], dtype))
+    except BaseException:
+        writer.abort()
+        raise
+    data = None
+    writer.close()
+
+
+def resample_array(data, in_rate, rate, channels=1):
+    """
+    resample_wav() for samples already in memory: returns float32 samples
+    of `data` at `rate`, downmixed (or upmixed) to `channels`.
+    """
+    block = to_float(np.asarray(data[:]))
+    if channels == 1 and block.shape[1] > 1:
+        block = block.mean(axis=1, keepdims=True)
+    else:
+        block = _match_channels(block, channels)
+    g = math.gcd(rate, in_rate)
+    if rate != in_rate:
+        block = resample_poly(block, rate // g, in_rate // g, axis=0)
+    return block.astype(np.float32)
+
+
+def transcode(path, output_file, dtype=None, block_frames=BLOCK_FRAMES):
+    """
+    Copies an audio file into output_file, whose suffix picks the format
+    (e.g. WAV -> FLAC for compact storage, FLAC -> WAV for export).
+    dtype defaults to the input's sample format.
+    """
+    rate, data = open_wav(path)
+    dtype = np.dtype(dtype or data.dtype)
+    writer = open_writer(output_file, rate, data.shape[1], dtype)
+    try:
+        for start in range(0, len(data), block_frames):
+            block = data[start:start + block_frames]
+            writer.write(block if block.dtype == dtype else from_float(to_float(block), dtype))
+    except BaseException:
+        writer.abort()
+        raise
+    data = None
+    writer.close()
+
+
+def compact_stems(directory, block_frames=BLOCK_FRAMES):
+    """Replaces every WAV file under directory with a FLAC copy. Returns the new paths."""
+    compacted = []
+    for wav in stem_files(directory, recursive=True, suffixes=(".wav",)):
+        flac = wav.with_suffix(".flac")
+        transcode(wav, flac, block_frames=block_frames)
+        wav.unlink()
+        compacted.append(flac)
+    return compacted
@@ -0,0 +1,211 @@
+"""
+In-process wrappers around Demucs, Basic Pitch and ADTOF.
+
+Each backend loads its model once in load() and can then run any number of
+jobs. They are used by the warm model server and by the in-process path
+(local_backend(), see ConversionOptions.in_process); the heavy libraries
+are only imported inside load() so that importing this module stays cheap.
+"""
+import sys
+import threading
+from pathlib import Path
+
+
+class DemucsBackend:
+    """Keeps one pretrained Demucs model (e.g. htdemucs_6s) resident."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.model = None
+
+    def load(self):
+        from demucs.pretrained import get_model
+        self.model = get_model(self.model_name)
+        self.model.cpu()
+        self.model.eval()
+
+    def _separate(self, input_path, shifts, overlap, segment, two_stems, log):
+        """[(stem name, (channels, samples) tensor)]; with two_stems only <stem> and no_<stem> (the rest mixed)."""
+        import torch
+        from demucs.apply import apply_model
+        from demucs.separate import load_track
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        log(f"Separating track {input_path}")
+        wav = load_track(input_path, self.model.audio_channels, self.model.samplerate)
+        ref = wav.mean(0)
+        wav -= ref.mean()
+        wav /= ref.std()
+        with torch.no_grad():
+            sources = apply_model(self.model, wav[None], device=device, shifts=shifts, split=True,
+                                  overlap=overlap, segment=segment, progress=False)[0]
+        sources *= ref.std()
+        sources += ref.mean()
+
+        stems = list(zip(self.model.sources, sources))
+        if two_stems:
+            index = self.model.sources.index(two_stems)
+            rest = sum(source for i, (_, source) in enumerate(stems) if i != index)
+            stems = [stems[index], (f"no_{two_stems}", rest)]
+        return stems
+
+    def separate(self, input_path, output_root, log=print, shifts=1, overlap=0.25, segment=None,
+                 two_stems=None, output="int16"):
+        """Writes <output_root>/<model>/<track>/<stem>.wav, like the demucs CLI."""
+        from demucs.audio import save_audio
+
+        input_path = Path(input_path)
+        out_dir = Path(output_root) / self.model_name / input_path.stem
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for name, source in self._separate(input_path, shifts, overlap, segment, two_stems, log):
+            save_audio(source, str(out_dir / f"{name}.wav"), samplerate=self.model.samplerate, clip="rescale",
+                       as_float=output == "float32", bits_per_sample=24 if output == "int24" else 16)
+        return out_dir
+
+    def separate_arrays(self, input_path, log=print, shifts=1, overlap=0.25, segment=None, two_stems=None):
+        """
+        Like separate(), but returns (samplerate, [(stem name, float32 array
+        (frames, channels))]) instead of writing files. Each stem is scaled
+        down like the CLI's clip="rescale" when it would clip.
+        """
+        stems = []
+        for name, source in self._separate(Path(input_path), shifts, overlap, segment, two_stems, log):
+            source = source / max(1.01 * source.abs().max().item(), 1)
+            stems.append((name, source.cpu().t().numpy().astype("float32")))
+        return self.model.samplerate, stems
+
+
+class BasicPitchBackend:
+    """Keeps the ICASSP 2022 Basic Pitch model resident."""
+
+    def __init__(self):
+        self.model = None
+
+    def load(self):
+        from basic_pitch import ICASSP_2022_MODEL_PATH
+        from basic_pitch.inference import Model
+        self.model = Model(ICASSP_2022_MODEL_PATH)
+
+    def transcribe(self, audio_path, midi_dir, minimum_note_length=None, log=print):
+        """Writes <midi_dir>/<stem>_basic_pitch.mid, like the basic-pitch CLI."""
+        from basic_pitch.inference import predict
+
+        audio_path = Path(audio_path)
+        midi_out = Path(midi_dir) / f"{audio_path.stem}_basic_pitch.mid"
+        kwargs = {}
+        if minimum_note_length is not None:
+            kwargs["minimum_note_length"] = float(minimum_note_length)
+
+        log(f"Predicting MIDI for {audio_path}...")
+        _, midi_data, _ = predict(audio_path, self.model, **kwargs)
+        midi_data.write(str(midi_out))
+        return midi_out
+
+    def transcribe_array(self, audio, midi_out, minimum_note_length=None, log=print):
+        """
+        transcribe() for audio already in memory: float32 mono samples at
+        basic_pitch.constants.AUDIO_SAMPLE_RATE. Follows basic-pitch's
+        run_inference() and predict(), minus decoding a file with librosa.
+        """
+        import numpy as np
+        from basic_pitch import note_creation
+        from basic_pitch.constants import AUDIO_N_SAMPLES, AUDIO_SAMPLE_RATE, FFT_HOP
+        from basic_pitch.inference import unwrap_output
+
+        n_overlapping_frames = 30
+        overlap_len = n_overlapping_frames * FFT_HOP
+        hop_size = AUDIO_N_SAMPLES - overlap_len
+        audio = np.concatenate([np.zeros(overlap_len // 2, dtype=np.float32), np.asarray(audio, dtype=np.float32)])
+
+        log(f"Predicting MIDI for {Path(midi_out).name} ({len(audio) / AUDIO_SAMPLE_RATE:.1f}s in memory)...")
+        output = {"note": [], "onset": [], "contour": []}
+        for start in range(0, len(audio), hop_size):
+            window = audio[start:start + AUDIO_N_SAMPLES]
+            if len(window) < AUDIO_N_SAMPLES:
+                window = np.pad(window, (0, AUDIO_N_SAMPLES - len(window)))
+            for key, value in self.model.predict(window[None, :, None]).items():
+                output[key].append(value)
+        original_length = len(audio) - overlap_len // 2
+        model_output = {key: unwrap_output(np.concatenate(values), original_length, n_overlapping_frames)
+                        for key, values in output.items()}
+
+        # predict()'s defaults; minimum_note_length is in milliseconds
+        minimum_note_length = 127.70 if minimum_note_length is None else float(minimum_note_length)
+        midi_data, _ = note_creation.model_output_to_notes(
+            model_output, onset_thresh=0.5, frame_thresh=0.3,
+            min_note_len=int(np.round(minimum_note_length / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP))),
+            min_freq=None, max_freq=None, multiple_pitch_bends=False, melodia_trick=True)
+        midi_data.write(str(midi_out))
+        return Path(midi_out)
+
+
+class AdtofBackend:
+    """
+    ADTOF-pytorch only exposes its console script, so the server keeps the
+    entry point module (and torch) imported and calls it with patched argv.
+    This saves interpreter start-up and imports; sys.argv is process-global,
+    so calls are serialized.
+    """
+
+    _argv_lock = threading.Lock()
+
+    def __init__(self):
+        self.entry_point = None
+
+    def load(self):
+        from importlib.metadata import entry_points
+        matches = [ep for ep in entry_points(group="console_scripts") if ep.name == "adtof"]
+        if not matches:
+            raise RuntimeError("adtof console script is not installed")
+        self.entry_point = matches[0].load()
+
+    def transcribe(self, audio_path, midi_out, device="cpu", log=print):
+        argv = ["adtof", "--audio", str(audio_path), "--out", str(midi_out), "--device", device]
+        with self._argv_lock:
+            saved_argv = sys.argv
+            sys.argv = argv
+            try:
+                self.entry_point()
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    raise RuntimeError(f"adtof exited with status {e.code}")
+            finally:
+                sys.argv = saved_argv
+        return Path(midi_out)
+
+
+def create_backend(tool, model=None):
+    if tool == "demucs":
+        return DemucsBackend(model)
+    if tool == "basic_pitch":
+        return BasicPitchBackend()
+    if tool == "adtof":
+        return AdtofBackend()
+    raise ValueError(f"Unknown tool '{tool}'")
+
+
+_local_backends = {}
+_local_lock = threading.Lock()
+
+
+def local_backend(tool, model=None, log=print):
+    """
+    (backend, lock) for running `tool` inside this process, loaded on first
+    use and kept until the process exits. A tool that failed to load (e.g.
+    its package is not installed) raises the same error on every call.
+    """
+    key = (tool, model)
+    with _local_lock:
+        entry = _local_backends.get(key)
+        if entry is None:
+            try:
+                log(f"Loading {tool}{f' ({model})' if model else ''} in process")
+                backend = create_backend(tool, model)
+                backend.load()
+                entry = (backend, threading.Lock())
+            except Exception as e:
+                entry = e
+            _local_backends[key] = entry
+    if isinstance(entry, Exception):
+        raise entry
+    return entry
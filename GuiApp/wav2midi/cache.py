@@ -0,0 +1,184 @@
+"""
+Content-addressed cache for separation results.
+
+Entries are keyed by a hash of the input audio plus the model and stage
+parameters, so the same audio under another file name is a hit and two
+different songs with the same name never collide. Results are built in a
+temporary folder and published with an atomic rename; an entry only exists
+once it is complete. The cache is kept under a size budget by evicting the
+least recently used entries.
+
+Layout:
+    <root>/entries/<key>/...files...   published results
+    <root>/entries/<key>/.meta.json    stage, params and size (written last)
+    <root>/tmp/                        entries being built
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+META_FILE = ".meta.json"
+_HASH_CHUNK = 4 * 1024 * 1024
+# Digests remembered by file_digest; the watch daemon and queue workers run for days
+DIGEST_MEMO_SIZE = 4096
+
+
+def link_or_copy(src, dst):
+    """Hard-links src to dst when possible (same filesystem), otherwise copies."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+_digest_memo = OrderedDict()
+_digest_lock = threading.Lock()
+
+
+def file_digest(path):
+    """sha256 of a file's content, memoized on (path, size, mtime) for the last DIGEST_MEMO_SIZE files."""
+    path = Path(path)
+    st = path.stat()
+    memo_key = (str(path.resolve()), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        if memo_key in _digest_memo:
+            _digest_memo.move_to_end(memo_key)
+            return _digest_memo[memo_key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    with _digest_lock:
+        _digest_memo[memo_key] = h.hexdigest()
+        while len(_digest_memo) > DIGEST_MEMO_SIZE:
+            _digest_memo.popitem(last=False)
+    return h.hexdigest()
+
+
+def _tree_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+
+class SeparationCache:
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.entries_dir = self.root / "entries"
+        self.tmp_dir = self.root / "tmp"
+
+    def key(self, input_path, stage, params):
+        """Cache key for running `stage` with `params` on the audio in `input_path`."""
+        description = json.dumps({"audio": file_digest(input_path), "stage": stage, "params": params},
+                                 sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def lookup(self, key):
+        """Returns the entry directory for a complete entry (marking it recently used), or None."""
+        entry = self.entries_dir / key
+        if not (entry / META_FILE).exists():
+            return None
+        try:
+            os.utime(entry)
+        except OSError:
+            return None # evicted meanwhile
+        return entry
+
+    def materialize(self, key, dest_dir):
+        """
+        Replaces the content of dest_dir with the cached files (hard links when
+        possible). Returns False if the entry is missing.
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+
+        dest_dir = Path(dest_dir)
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        try:
+            for src in entry.rglob("*"):
+                if src.name == META_FILE or not src.is_file():
+                    continue
+                dst = dest_dir / src.relative_to(entry)
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(src, dst)
+        except OSError:
+            # Entry evicted by another process while we were reading it
+            shutil.rmtree(dest_dir, ignore_errors=True)
+            return False
+        return True
+
+    def publish(self, key, src_dir, stage, params):
+        """Stores the files of src_dir under `key` atomically, then enforces the size budget."""
+        src_dir = Path(src_dir)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.entries_dir.mkdir(parents=True, exist_ok=True)
+
+        staging = self.tmp_dir / f"{key}.{uuid.uuid4().hex}"
+        try:
+            for src in src_dir.rglob("*"):
+                if not src.is_file():
+                    continue
+                dst = staging / src.relative_to(src_dir)
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                link_or_copy(src, dst)
+
+            meta = {"stage": stage, "params": params, "size": _tree_size(staging), "created": time.time()}
+            staging.mkdir(parents=True, exist_ok=True)
+            with open(staging / META_FILE, "w") as f:
+                json.dump(meta, f, default=str)
+
+            entry = self.entries_dir / key
+            if entry.exists():
+                # Forced re-run: retire the old entry before publishing the new one
+                doomed = self.tmp_dir / f"evict.{key}.{uuid.uuid4().hex}"
+                try:
+                    os.rename(entry, doomed)
+                    shutil.rmtree(doomed, ignore_errors=True)
+                except OSError:
+                    pass
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                pass # another worker published the same key first
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def entries(self):
+        """[(last_used, size, path)] for every complete entry."""
+        result = []
+        if not self.entries_dir.exists():
+            return result
+        for entry in self.entries_dir.iterdir():
+            try:
+                with open(entry / META_FILE) as f:
+                    size = json.load(f)["size"]
+                result.append((entry.stat().st_mtime, size, entry))
+            except (OSError, ValueError, KeyError):
+                continue
+        return result
+
+    def evict(self, keep=None):
+        """Deletes least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry.name == keep:
+                continue
+            # Rename first so readers never see a half-deleted entry
+            doomed = self.tmp_dir / f"evict.{entry.name}.{uuid.uuid4().hex}"
+            try:
+                os.rename(entry, doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
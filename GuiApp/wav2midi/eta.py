@@ -0,0 +1,216 @@
+"""
+Progress and ETA from learned stage throughput.
+
+Every tool run is timed by the profiler, and its realtime factor (wall
+seconds per second of input audio) is kept per model and per host in
+<output_root>/.throughput.json, as a running average that starts from
+DEFAULT_REALTIME_FACTORS.
+
+Before a conversion starts, each song gets its work: seconds of audio per
+model, e.g. {"htdemucs": 180, "basic_pitch": 540, "adtof": 180} for a
+three-minute song with three pitched stems and drums (see plan_work() in
+pipeline.py). Multiplying by the factors predicts its duration.
+ProgressTracker then counts the audio each finished stage processed
+towards its song, learns from the runs that really ran (not cache hits or
+up-to-date outputs), and re-predicts the remaining work.
+
+The remaining time of a whole batch is estimated by queue_seconds(): runs
+of one kind share its slots (one Demucs at a time, transcribe_workers
+transcriptions, ...) and at most `jobs` songs are in flight.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+# model -> wall seconds per second of input audio, until measured on this host
+DEFAULT_REALTIME_FACTORS = {
+    "bandit": 0.5,
+    "htdemucs": 0.3,
+    "htdemucs_6s": 0.45,
+    "basic_pitch": 0.1,
+    "adtof": 0.08,
+}
+# Scheduler stage kind each model runs in
+MODEL_KINDS = {
+    "bandit": "bandit",
+    "htdemucs": "demucs",
+    "htdemucs_6s": "demucs",
+    "basic_pitch": "transcribe",
+    "adtof": "transcribe",
+}
+THROUGHPUT_FILE = ".throughput.json"
+# Weight of a new measurement in the running average
+SMOOTHING = 0.3
+
+
+def format_seconds(seconds):
+    """e.g. 45s, 12m05s, 3h20m"""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+
+def queue_seconds(works, slots, jobs=1):
+    """
+    Estimated wall time to run `works` (one {kind: seconds} dict per song)
+    with `slots` runs of each kind at a time and `jobs` songs in flight.
+    """
+    totals = [sum(work.values()) for work in works if work]
+    if not totals:
+        return 0.0
+    per_kind = {}
+    for work in works:
+        for kind, seconds in work.items():
+            per_kind[kind] = per_kind.get(kind, 0.0) + seconds
+    busiest = max(seconds / max(1, slots.get(kind, 1)) for kind, seconds in per_kind.items())
+    return max(busiest, max(totals), sum(totals) / max(1, jobs))
+
+
+class ThroughputModel:
+    def __init__(self, path=None, host=None):
+        self.path = Path(path) if path else None
+        self.host = host or socket.gethostname()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.factors = {model: {"rtf": rtf, "runs": 0} for model, rtf in DEFAULT_REALTIME_FACTORS.items()}
+        self.factors.update(self._load().get(self.host, {}))
+
+    def _load(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def predict(self, model, audio_seconds):
+        """Predicted wall seconds of `model` on audio_seconds of input (0 for unknown models)."""
+        entry = self.factors.get(model)
+        if entry is None or not audio_seconds:
+            return 0.0
+        return entry["rtf"] * audio_seconds
+
+    def work_seconds(self, work):
+        """{kind: predicted seconds} for a song's {model: audio seconds}."""
+        seconds = {}
+        for model, audio in work.items():
+            kind = MODEL_KINDS.get(model, model)
+            seconds[kind] = seconds.get(kind, 0.0) + self.predict(model, audio)
+        return seconds
+
+    def observe(self, model, audio_seconds, wall_seconds):
+        """Updates the factor of `model` from a run that processed audio_seconds in wall_seconds."""
+        if model not in self.factors or not audio_seconds or wall_seconds <= 0:
+            return
+        rtf = wall_seconds / audio_seconds
+        with self._lock:
+            entry = self.factors[model]
+            # The defaults are only a guess: the first measurement replaces them
+            if entry["runs"]:
+                rtf = entry["rtf"] * (1 - SMOOTHING) + rtf * SMOOTHING
+            entry["rtf"] = round(rtf, 4)
+            entry["runs"] += 1
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty or not self.path:
+            return
+        try:
+            hosts = self._load() # other hosts sharing the output root keep their factors
+            hosts[self.host] = self.factors
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f"{THROUGHPUT_FILE}.{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(hosts, f, indent=1)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except OSError:
+            pass
+
+
+class ProgressTracker:
+    """
+    Progress of the songs of one conversion. callback(report) is called
+    on notify() and whenever a stage finishes (from the thread that ran
+    it); see report() for its contents.
+    """
+
+    def __init__(self, model, slots, jobs=1, callback=None):
+        self.model = model
+        self.slots = dict(slots)
+        self.jobs = jobs
+        self.callback = callback
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self.songs = {} # name -> {"work": {model: audio s}, "done": {model: audio s}, "finished": bool}
+
+    def add_song(self, name, work):
+        with self._lock:
+            self.songs[name] = {"work": dict(work), "done": {}, "finished": False}
+
+    def finish(self, name, model, audio_seconds, wall_seconds, measured=True):
+        """
+        A stage of song `name` ran `model` on audio_seconds of audio. Only
+        measured runs (the tool really ran) update the throughput model.
+        """
+        if measured:
+            self.model.observe(model, audio_seconds, wall_seconds)
+        with self._lock:
+            song = self.songs.get(name)
+            if song is not None and model in song["work"] and audio_seconds:
+                song["done"][model] = song["done"].get(model, 0.0) + audio_seconds
+        self.notify()
+
+    def finish_song(self, name):
+        """Marks a song complete, including work that turned out not to be needed (or failed)."""
+        with self._lock:
+            if name in self.songs:
+                self.songs[name]["finished"] = True
+        self.notify()
+
+    def _remaining_work(self, song):
+        if song["finished"]:
+            return {}
+        return {model: max(0.0, audio - song["done"].get(model, 0.0)) for model, audio in song["work"].items()}
+
+    def report(self):
+        """
+        {"songs": {name: {"fraction", "predicted_s", "remaining_s"}},
+         "fraction", "remaining_s", "elapsed_s", "done", "total"}
+        with fractions in [0, 1] weighted by predicted time.
+        """
+        with self._lock:
+            songs = {name: (song["work"], self._remaining_work(song)) for name, song in self.songs.items()}
+        report = {"songs": {}}
+        total = remaining = 0.0
+        pending = []
+        for name, (work, left) in songs.items():
+            predicted = sum(self.model.work_seconds(work).values())
+            left_seconds = self.model.work_seconds(left)
+            left_total = sum(left_seconds.values())
+            total += predicted
+            remaining += left_total
+            if left_total > 0:
+                pending.append(left_seconds)
+            report["songs"][name] = {
+                "fraction": round(1 - left_total / predicted, 4) if predicted else float(not left_total),
+                "predicted_s": round(predicted, 1),
+                "remaining_s": round(left_total, 1),
+            }
+        report["fraction"] = round(1 - remaining / total, 4) if total else 0.0
+        report["remaining_s"] = round(queue_seconds(pending, self.slots, self.jobs), 1)
+        report["elapsed_s"] = round(time.monotonic() - self.started, 1)
+        report["done"] = sum(1 for s in report["songs"].values() if s["remaining_s"] == 0)
+        report["total"] = len(report["songs"])
+        return report
+
+    def notify(self):
+        if self.callback is not None:
+            self.callback(self.report())
@@ -0,0 +1,171 @@
+"""
+Resource governor: CPU thread budgets and memory admission for stages.
+
+Demucs and inference.py (torch), basic-pitch (tensorflow) and ADTOF each
+size their thread pools to every core, so two or three of them running at
+once oversubscribe the machine, and a few Demucs runs on long inputs can
+exhaust RAM. The scheduler asks the governor before starting a stage:
+
+Threads
+    A stage that runs a tool gets min(cpus // slots of its kind, cores not
+    yet handed out) threads, at least one, and its child processes see that
+    budget through OMP_NUM_THREADS and friends (see thread_env()). A stage
+    running alone gets the whole machine; stages running side by side share it.
+
+Memory
+    Each tool run is estimated as base_mb + mb_per_minute * minutes of input
+    from a per-model profile. A stage only starts while the estimates of the
+    running stages plus its own fit in the memory budget (80% of the memory
+    available when the conversion starts, unless set); a stage is always
+    allowed when nothing else with an estimate is running. Profiles start
+    from DEFAULT_MEMORY_PROFILES and are corrected from the peak RSS the
+    profiler measures for each tool run, and saved in
+    <output_root>/.memory_profiles.json for the next conversion.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+]
+# Stage kinds whose stages run a model in a child process
+TOOL_KINDS = {"bandit", "demucs", "transcribe"}
+# model -> peak RSS of one tool process: base MB + MB per minute of input audio
+DEFAULT_MEMORY_PROFILES = {
+    "bandit": {"base_mb": 2500, "mb_per_minute": 250},
+    "htdemucs": {"base_mb": 1500, "mb_per_minute": 150},
+    "htdemucs_6s": {"base_mb": 1700, "mb_per_minute": 220},
+    "basic_pitch": {"base_mb": 1200, "mb_per_minute": 40},
+    "adtof": {"base_mb": 900, "mb_per_minute": 30},
+}
+PROFILES_FILE = ".memory_profiles.json"
+# Share of the available memory used as the budget when none is given
+MEMORY_BUDGET_SHARE = 0.8
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: # not on Linux
+        return os.cpu_count() or 1
+
+
+def available_memory_mb():
+    """Memory available to new processes in MB, or None if it cannot be determined."""
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024 ** 2
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def thread_env(threads, base=None):
+    """Environment for a child process limited to `threads` threads."""
+    env = dict(os.environ if base is None else base)
+    for name in THREAD_ENV_VARS:
+        env[name] = str(threads)
+    env["TF_NUM_INTEROP_THREADS"] = "1"
+    return env
+
+
+class ResourceGovernor:
+    def __init__(self, slots, cpus=None, memory_budget_mb=None, profiles_path=None, log=print):
+        """
+        slots: concurrent stages per kind (as given to the scheduler).
+        cpus: cores to share out; 0 leaves the tools' thread pools alone.
+        memory_budget_mb: None = MEMORY_BUDGET_SHARE of the available memory, 0 = no admission control.
+        """
+        self.slots = dict(slots)
+        self.cpus = cpu_count() if cpus is None else cpus
+        if memory_budget_mb is None:
+            available = available_memory_mb()
+            memory_budget_mb = available * MEMORY_BUDGET_SHARE if available else 0
+        self.memory_budget_mb = memory_budget_mb
+        self.profiles_path = Path(profiles_path) if profiles_path else None
+        self.log = log
+        self._lock = threading.Lock()
+        self._threads_in_use = 0
+        self._dirty = False
+        self.profiles = {model: dict(p) for model, p in DEFAULT_MEMORY_PROFILES.items()}
+        if self.profiles_path:
+            try:
+                with open(self.profiles_path) as f:
+                    self.profiles.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+
+    def acquire_threads(self, kind):
+        """Thread budget for a stage of `kind` that is starting, or None when it is not limited."""
+        if not self.cpus or kind not in TOOL_KINDS:
+            return None
+        with self._lock:
+            fair_share = self.cpus // max(1, self.slots.get(kind, 1))
+            threads = max(1, min(fair_share, self.cpus - self._threads_in_use))
+            self._threads_in_use += threads
+        return threads
+
+    def release_threads(self, threads):
+        if threads:
+            with self._lock:
+                self._threads_in_use -= threads
+
+    def estimate_mb(self, model, audio_seconds):
+        """Estimated peak RSS of one `model` run on audio_seconds of input, or None if unknown."""
+        profile = self.profiles.get(model)
+        if profile is None or audio_seconds is None:
+            return None
+        return profile["base_mb"] + profile["mb_per_minute"] * audio_seconds / 60
+
+    def admits(self, estimate_mb, reserved_mb, running):
+        """Whether a stage estimated at estimate_mb may start next to `running` stages holding reserved_mb."""
+        if not self.memory_budget_mb or not estimate_mb or not running:
+            return True
+        return reserved_mb + estimate_mb <= self.memory_budget_mb
+
+    def observe(self, model, audio_seconds, peak_rss_bytes):
+        """Corrects the profile of `model` from a measured run (peak RSS of its child process)."""
+        if not peak_rss_bytes or not audio_seconds or model not in self.profiles:
+            return
+        peak_mb = peak_rss_bytes / 1024 ** 2
+        minutes = audio_seconds / 60
+        with self._lock:
+            profile = self.profiles[model]
+            predicted = profile["base_mb"] + profile["mb_per_minute"] * minutes
+            if peak_mb > predicted:
+                # Under-estimated: grow the per-minute part so this run would have fit
+                profile["mb_per_minute"] = round((peak_mb - profile["base_mb"]) / minutes, 1)
+            else:
+                # Over-estimated: move a tenth of the way down towards what was measured
+                target = max(0.0, (peak_mb - profile["base_mb"]) / minutes)
+                profile["mb_per_minute"] = round(profile["mb_per_minute"] * 0.9 + target * 0.1, 1)
+                if peak_mb < profile["base_mb"]:
+                    profile["base_mb"] = round(profile["base_mb"] * 0.9 + peak_mb * 0.1, 1)
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty or not self.profiles_path:
+            return
+        try:
+            self.profiles_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.profiles_path.with_name(f"{PROFILES_FILE}.{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(self.profiles, f, indent=1)
+            os.replace(tmp, self.profiles_path)
+            self._dirty = False
+        except OSError:
+            pass
@@ -0,0 +1,102 @@
+"""
+Buffered log sink.
+
+Subprocesses (Demucs, tensorflow) can print thousands of progress lines.
+Instead of handing every line to the UI, producers call the sink from any
+thread; it appends the line to a log file right away and queues it, and
+the UI drains the queue on a timer, getting one batch per tick.
+
+Lines starting with PROGRESS are redraws of a carriage-return progress bar
+(see run_command_capture). Within a batch, redraws from the same source
+(the same "[song] [stem] " prefix) collapse into the latest one, and the
+UI replaces the source's previous progress line instead of adding one.
+"""
+import re
+import threading
+from collections import deque
+
+PROGRESS = "\r"
+
+_PREFIX_RE = re.compile(r"^((?:\[[^\]]*\] )*)")
+
+
+def split_progress(message):
+    """Returns (is_progress, text) for a log message."""
+    if message.startswith(PROGRESS):
+        return True, message[len(PROGRESS):]
+    return False, message
+
+
+def prefix_message(prefix, message):
+    """Adds a "[prefix] " tag to a message, keeping the progress marker in front."""
+    is_progress, text = split_progress(message)
+    return f"{PROGRESS if is_progress else ''}[{prefix}] {text}"
+
+
+def source_key(text):
+    """The "[song] [stem] " tags identifying which job a line comes from."""
+    return _PREFIX_RE.match(text).group(1)
+
+
+class LogEntry:
+    __slots__ = ("key", "text", "progress")
+
+    def __init__(self, key, text, progress):
+        self.key = key
+        self.text = text
+        self.progress = progress
+
+
+class BufferedLogSink:
+    def __init__(self, max_pending=5000):
+        self._pending = deque()
+        self._max_pending = max_pending
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+    def open_file(self, path):
+        """Writes every following line to `path` as well (the previous file, if any, is closed)."""
+        with self._lock:
+            if self._file:
+                self._file.close()
+            self._file = open(path, "a", encoding="utf-8", errors="replace", buffering=1)
+
+    def close_file(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def __call__(self, message):
+        message = str(message)
+        with self._lock:
+            if self._file:
+                self._file.write(split_progress(message)[1] + "\n")
+            if len(self._pending) >= self._max_pending:
+                self._pending.popleft()
+                self._dropped += 1
+            self._pending.append(message)
+
+    def drain(self):
+        """Returns the queued lines as LogEntry objects, with progress redraws collapsed."""
+        with self._lock:
+            pending, self._pending = self._pending, deque()
+            dropped, self._dropped = self._dropped, 0
+
+        entries = []
+        if dropped:
+            entries.append(LogEntry("", f"... {dropped} lines not shown (see the log file) ...", False))
+        latest_progress = {} # key -> index in entries of its progress line in this batch
+        for message in pending:
+            is_progress, text = split_progress(message)
+            key = source_key(text)
+            if is_progress and key in latest_progress:
+                entries[latest_progress[key]].text = text
+                continue
+            if is_progress:
+                latest_progress[key] = len(entries)
+            else:
+                latest_progress.pop(key, None)
+            entries.append(LogEntry(key, text, is_progress))
+        return entries
@@ -0,0 +1,152 @@
+"""
+Per-song build manifest.
+
+<song>/manifest.json records, for every artifact the pipeline produced
+(BandIt and Demucs stems, each merged stem, each MIDI file), the
+fingerprint it was built from: the content hash of its inputs, the stage
+parameters and the tool version. A stage only runs again when the
+fingerprint it would be built from differs from the recorded one or its
+outputs were changed or removed, so e.g. changing one merge target redoes
+that stem's merge and MIDI and nothing else.
+
+Hashes of unchanged files are not recomputed: the manifest keeps each
+file's size and mtime next to its digest, like a build system would.
+"""
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from .cache import file_digest
+
+MANIFEST_FILE = "manifest.json"
+
+# Python distributions behind the external tools, for their version
+_TOOL_PACKAGES = {"demucs": "demucs", "basic_pitch": "basic-pitch", "adtof": "adtof", "bandit": None}
+
+
+@lru_cache(maxsize=None)
+def tool_version(tool):
+    package = _TOOL_PACKAGES.get(tool, tool)
+    if package is None:
+        return None
+    try:
+        from importlib.metadata import version
+        return version(package)
+    except Exception:
+        return "unknown"
+
+
+class Manifest:
+    def __init__(self, song_dir):
+        self.song_dir = Path(song_dir)
+        self.path = self.song_dir / MANIFEST_FILE
+        self._lock = threading.RLock()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.artifacts = data.get("artifacts", {})
+        self.files = data.get("files", {}) # relative path -> [size, mtime_ns, digest]
+
+    def _rel(self, path):
+        path = Path(path)
+        try:
+            return path.resolve().relative_to(self.song_dir.resolve()).as_posix()
+        except ValueError:
+            return str(path.resolve())
+
+    def digest(self, path):
+        """Content hash of a file, reusing the recorded one while its size and mtime are unchanged."""
+        st = Path(path).stat()
+        rel = self._rel(path)
+        with self._lock:
+            known = self.files.get(rel)
+            if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+                return known[2]
+        digest = file_digest(path)
+        with self._lock:
+            self.files[rel] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def fingerprint(self, inputs, params=None, tool=None):
+        """What an artifact is built from: input hashes, parameters and tool version."""
+        return {
+            "inputs": {self._rel(p): self.digest(p) for p in inputs},
+            "params": json.loads(json.dumps(params or {}, sort_keys=True, default=str)),
+            "tool": [tool, tool_version(tool)] if tool else None,
+        }
+
+    def current(self, name, fingerprint):
+        """
+        Returns the recorded entry when `name` was built from `fingerprint` and
+        its outputs are still intact, otherwise None.
+        """
+        with self._lock:
+            entry = self.artifacts.get(name)
+        if not entry or entry.get("fingerprint") != fingerprint:
+            return None
+        for rel, digest in entry.get("outputs", {}).items():
+            path = self.song_dir / rel if not os.path.isabs(rel) else Path(rel)
+            try:
+                if self.digest(path) != digest:
+                    return None
+            except OSError:
+                return None
+        return entry
+
+    def reason(self, name, fingerprint):
+        """Short explanation of why `name` is out of date (for logs and dry runs)."""
+        with self._lock:
+            entry = self.artifacts.get(name)
+        if not entry:
+            return "not built yet"
+        old = entry.get("fingerprint") or {}
+        if old.get("tool") != fingerprint.get("tool"):
+            return "tool version changed"
+        if old.get("params") != fingerprint.get("params"):
+            return "parameters changed"
+        if old.get("inputs") != fingerprint.get("inputs"):
+            return "input changed"
+        return "output changed or missing"
+
+    def record(self, name, fingerprint, outputs, **notes):
+        """Stores a freshly built artifact and saves the manifest."""
+        entry = {
+            "fingerprint": fingerprint,
+            "outputs": {self._rel(p): self.digest(p) for p in outputs},
+            "built": time.time(),
+            **notes,
+        }
+        with self._lock:
+            self.artifacts[name] = entry
+        self.save()
+
+    def forget(self, name):
+        with self._lock:
+            removed = self.artifacts.pop(name, None)
+        if removed is not None:
+            self.save()
+
+    def remove(self, name):
+        """Deletes the outputs of `name` and forgets it."""
+        with self._lock:
+            removed = self.artifacts.pop(name, None)
+            if removed is None:
+                return
+            for rel in removed.get("outputs", {}):
+                path = self.song_dir / rel if not os.path.isabs(rel) else Path(rel)
+                path.unlink(missing_ok=True)
+                self.files.pop(rel, None)
+        self.save()
+
+    def save(self):
+        with self._lock:
+            self.song_dir.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump({"version": 1, "artifacts": self.artifacts, "files": self.files}, f, indent=1)
+            os.replace(tmp, self.path)
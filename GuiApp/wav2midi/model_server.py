@@ -0,0 +1,271 @@
+"""
+Warm model server.
+
+A long-lived local process that keeps Demucs / Basic Pitch / ADTOF models
+loaded and runs separation and transcription jobs sent over a local socket,
+so each stem no longer pays for interpreter start-up, the torch/tensorflow
+import and loading weights. At most `max_models` models stay resident
+(least recently used ones are dropped) and the server exits after
+`idle_timeout` seconds without a job.
+
+Start it with `python GuiApp/wav2midi_cli.py serve`. The pipeline uses it
+when ConversionOptions.model_server is set and falls back to the usual
+subprocesses when nothing is listening.
+"""
+import gc
+import os
+import secrets
+import socket
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+from .backends import create_backend
+from .runner import stop_on_cancel
+
+KEY_ENV = "WAV2MIDI_SERVER_KEY"
+
+
+def key_path():
+    """Per-user file holding the server's authentication key."""
+    if os.name == "nt":
+        base = os.environ.get("APPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return Path(base) / "wav2midi" / "server.key"
+
+
+def server_key():
+    """
+    Key the server and its clients authenticate with: WAV2MIDI_SERVER_KEY
+    when set, else a random key generated on first use and kept in
+    key_path(), readable by the user only. Jobs arrive as pickles, so
+    without either the server does not start.
+    """
+    if os.environ.get(KEY_ENV):
+        return os.environ[KEY_ENV].encode()
+    path = key_path()
+    try:
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Written in full before it appears under its name, so a concurrent first use never reads half a key
+            fd, tmp = tempfile.mkstemp(dir=path.parent) # mode 0600
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(secrets.token_hex(32))
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(tmp)
+        if os.name != "nt" and path.stat().st_mode & 0o077:
+            raise Exception(f"{path} is accessible by other users; run 'chmod 600 {path}' or set {KEY_ENV}.")
+        key = path.read_text().strip()
+    except OSError as e:
+        raise Exception(f"Cannot create the model server key {path} ({e}); set {KEY_ENV}.")
+    if not key:
+        raise Exception(f"The model server key {path} is empty; delete it or set {KEY_ENV}.")
+    return key.encode()
+
+
+def default_address():
+    if os.name == "nt":
+        return "127.0.0.1:47615"
+    return os.path.join(tempfile.gettempdir(), f"wav2midi-model-server-{os.getuid()}.sock")
+
+
+def _parse_address(address):
+    """'host:port' -> TCP tuple, anything else is a Unix socket path."""
+    host, sep, port = str(address).rpartition(":")
+    if sep and port.isdigit() and os.sep not in host:
+        return (host, int(port)), "AF_INET"
+    return str(address), "AF_UNIX"
+
+
+class ModelServer:
+    def __init__(self, address=None, max_models=2, idle_timeout=600, log=print):
+        self.address = address or default_address()
+        self.max_models = max(1, max_models)
+        self.idle_timeout = idle_timeout
+        self.log = log
+        self._models = OrderedDict() # key -> (backend, lock)
+        self._models_lock = threading.Lock()
+        self._active_jobs = 0
+        self._last_activity = time.monotonic()
+        self._listener = None
+        self._stopping = False
+
+    def get_backend(self, tool, model=None):
+        """Returns (backend, lock) for a model, loading it and evicting the LRU one if needed."""
+        key = (tool, model)
+        with self._models_lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+
+            while len(self._models) >= self.max_models:
+                evicted, _ = self._models.popitem(last=False)
+                self.log(f"Unloading {evicted}")
+                gc.collect()
+
+            self.log(f"Loading {key}")
+            backend = create_backend(tool, model)
+            backend.load()
+            entry = (backend, threading.Lock())
+            self._models[key] = entry
+            return entry
+
+    def run_job(self, request, log):
+        tool = request["tool"]
+        params = request.get("params", {})
+
+        if tool == "demucs":
+            backend, lock = self.get_backend(tool, params["model"])
+            with lock:
+                settings = {k: params[k] for k in ("shifts", "overlap", "segment", "two_stems", "output") if k in params}
+                backend.separate(params["input"], params["output_root"], log=log, **settings)
+        elif tool == "basic_pitch":
+            backend, lock = self.get_backend(tool)
+            with lock:
+                backend.transcribe(params["input"], params["midi_dir"], params.get("minimum_note_length"), log=log)
+        elif tool == "adtof":
+            backend, lock = self.get_backend(tool)
+            with lock:
+                backend.transcribe(params["input"], params["midi_out"], params.get("device", "cpu"), log=log)
+        else:
+            raise ValueError(f"Unknown tool '{tool}'")
+
+    def _handle(self, conn):
+        with conn:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            if request.get("tool") == "ping":
+                conn.send({"ok": True})
+                return
+
+            self._touch(+1)
+            try:
+                self.run_job(request, lambda line: conn.send({"log": line}))
+                conn.send({"ok": True})
+            except Exception as e:
+                self.log(traceback.format_exc())
+                try:
+                    conn.send({"ok": False, "error": str(e)})
+                except OSError:
+                    pass
+            finally:
+                self._touch(-1)
+
+    def _touch(self, delta):
+        with self._models_lock:
+            self._active_jobs += delta
+            self._last_activity = time.monotonic()
+
+    def _watch_idle(self):
+        while True:
+            time.sleep(1.0)
+            with self._models_lock:
+                idle = self._active_jobs == 0 and time.monotonic() - self._last_activity > self.idle_timeout
+            if idle:
+                self.log(f"Idle for {self.idle_timeout}s, shutting down.")
+                self.stop()
+                return
+
+    def stop(self):
+        # Closing a listener does not interrupt a blocking accept(), so wake it up with a dummy connection.
+        self._stopping = True
+        try:
+            _connect(self.address).close()
+        except Exception:
+            pass
+
+    def serve_forever(self):
+        authkey = server_key()
+        address, family = _parse_address(self.address)
+        if family == "AF_UNIX" and os.path.exists(address):
+            os.unlink(address) # stale socket from a previous run
+        self._listener = Listener(address, family=family, authkey=authkey)
+        self.log(f"Model server listening on {self.address} (max {self.max_models} models, idle timeout {self.idle_timeout}s)")
+
+        if self.idle_timeout:
+            threading.Thread(target=self._watch_idle, daemon=True).start()
+
+        try:
+            while True:
+                try:
+                    conn = self._listener.accept()
+                except (OSError, AuthenticationError):
+                    if self._stopping:
+                        break
+                    continue # failed handshake, e.g. a client with another key
+                if self._stopping:
+                    conn.close()
+                    break
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._listener.close()
+            if family == "AF_UNIX" and os.path.exists(address):
+                os.unlink(address)
+
+
+def _connect(address):
+    address, family = _parse_address(address)
+    return Client(address, family=family, authkey=server_key())
+
+
+def _interrupt(conn, address):
+    # close() does not wake a thread blocked in recv(); shutting the socket down does
+    _, family = _parse_address(address)
+    try:
+        sock = socket.fromfd(conn.fileno(), getattr(socket, family), socket.SOCK_STREAM)
+        sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+    except OSError:
+        pass
+
+
+def model_server_available(address):
+    try:
+        with _connect(address) as conn:
+            conn.send({"tool": "ping"})
+            return conn.recv().get("ok", False)
+    except Exception: # not running, or no key / a different one
+        return False
+
+
+def run_on_model_server(address, tool, params, log=print):
+    """
+    Runs one job on the warm server. Returns True/False for success, or None
+    if the server is not reachable (the caller should use a subprocess).
+    Cancelling the stage drops the connection; the server abandons the job
+    the next time it tries to send a log line.
+    """
+    try:
+        conn = _connect(address)
+    except OSError:
+        return None
+    except Exception as e:
+        log(f"Cannot connect to model server: {e}")
+        return None
+
+    with conn, stop_on_cancel(lambda: _interrupt(conn, address)):
+        conn.send({"tool": tool, "params": {k: str(v) if hasattr(v, "__fspath__") else v for k, v in params.items()}})
+        try:
+            while True:
+                message = conn.recv()
+                if "log" in message:
+                    log(message["log"])
+                    continue
+                if not message["ok"]:
+                    log(f"Model server error: {message.get('error')}")
+                return message["ok"]
+        except (OSError, EOFError) as e:
+            log(f"Lost connection to model server: {e}")
+            return False
@@ -0,0 +1,209 @@
+"""
+BandIt model registry.
+
+Every model lives in a subdirectory of GuiApp/bandit with a ZFTurbo config
+(*.yaml) and a checkpoint (*.ckpt, *.chpt). Parsing the configs means
+importing yaml and reading every file, which is too slow for GUI startup
+and was repeated each time a model was selected or a conversion started.
+
+The registry keeps one entry per model directory with the directory and
+config mtimes it was built from, the config and checkpoint paths, the
+model type and the stems. Entries are reused until one of those mtimes
+changes, and the index is saved to GuiApp/bandit/.index.json so a fresh
+process can list the models and their stems without parsing anything.
+
+This module must stay cheap to import: yaml is only imported when a
+config actually has to be parsed.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+BANDIT_MODELS_DIR = Path("GuiApp") / "bandit"
+INDEX_FILE = ".index.json"
+INDEX_VERSION = 1
+MERGE_TARGET_CHOICES = ["None", "Vocals", "Drums", "Bass", "Other", "Guitar", "Piano"]
+# Stems each Demucs model writes
+DEMUCS_STEMS = {
+    "htdemucs": ["drums", "bass", "other", "vocals"],
+    "htdemucs_6s": ["drums", "bass", "other", "vocals", "guitar", "piano"],
+}
+# Sample formats Demucs can write its stems in
+DEMUCS_OUTPUT_CHOICES = ["int16", "int24", "float32"]
+
+
+def default_merge_target(stem):
+    """Guesses which Demucs stem a BandIt stem should be merged into."""
+    lower = stem.lower()
+    if "speech" in lower or "vocal" in lower: return "Vocals"
+    elif "drum" in lower: return "Drums"
+    elif "bass" in lower: return "Bass"
+    elif "guitar" in lower: return "Guitar"
+    elif "piano" in lower: return "Piano"
+    return "None"
+
+
+def parse_bandit_config(config_path):
+    """Returns (model_type, stems) from a ZFTurbo config file."""
+    import yaml
+
+    with open(config_path, 'r') as f:
+        model_config = yaml.safe_load(f) or {}
+
+    # ZFTurbo configs usually have training: model_type: ...
+    # inference.py needs --model_type, so fall back to "bandit" when it is missing.
+    model_type = "bandit"
+    if "training" in model_config and "model_type" in model_config["training"]:
+        model_type = model_config["training"]["model_type"]
+    elif "model_type" in model_config:
+        model_type = model_config["model_type"]
+
+    # In ZFTurbo config: training: instruments: [speech, music, sfx]
+    stems = []
+    if "training" in model_config and "instruments" in model_config["training"]:
+        stems = model_config["training"]["instruments"]
+    elif "model" in model_config and "stems" in model_config["model"]:
+        stems = model_config["model"]["stems"] # Old BandIt style fallback
+
+    return model_type, [str(s) for s in stems]
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ModelRegistry:
+    def __init__(self, base_dir=None):
+        self.base_dir = Path(base_dir) if base_dir else BANDIT_MODELS_DIR
+        self._lock = threading.Lock()
+        self._entries = None # resolved model dir -> entry dict
+        self._dirty = False
+
+    @property
+    def index_path(self):
+        return self.base_dir / INDEX_FILE
+
+    def _load_index(self):
+        if self._entries is not None:
+            return
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+            self._entries = data["models"] if data.get("version") == INDEX_VERSION else {}
+        except (OSError, ValueError, KeyError, TypeError):
+            self._entries = {}
+
+    def _save_index(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        base = self.base_dir.resolve()
+        models = {k: e for k, e in self._entries.items() if Path(k).parent == base}
+        try:
+            tmp = self.index_path.with_name(f"{INDEX_FILE}.{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump({"version": INDEX_VERSION, "models": models}, f, indent=1)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            pass # read-only model folder: the in-memory index still works
+
+    def _entry(self, model_dir):
+        """Index entry for model_dir, rebuilt only when the directory or its config changed."""
+        key = str(model_dir)
+        entry = self._entries.get(key)
+        dir_mtime = _mtime(model_dir)
+        if (entry and entry["dir_mtime"] == dir_mtime
+                and (entry["config_path"] is None or entry["config_mtime"] == _mtime(entry["config_path"]))):
+            return entry
+
+        # Files were added, removed or edited (or this is a new model)
+        yaml_files = sorted(model_dir.glob("*.yaml"))
+        ckpt_files = sorted(model_dir.glob("*.ckpt")) + sorted(model_dir.glob("*.chpt"))
+        config_path = yaml_files[0] if yaml_files else None # Assume the first yaml is the config
+        entry = {
+            "dir_mtime": dir_mtime,
+            "config_path": str(config_path) if config_path else None,
+            "config_mtime": _mtime(config_path) if config_path else None,
+            "ckpt_path": str(ckpt_files[0]) if ckpt_files else None,
+            "model_type": None,
+            "stems": None,
+            "error": None,
+        }
+        if config_path:
+            try:
+                entry["model_type"], entry["stems"] = parse_bandit_config(config_path)
+            except Exception as e:
+                entry["error"] = str(e)
+        self._entries[key] = entry
+        self._dirty = True
+        return entry
+
+    def scan(self):
+        """Returns {label: model_dir} for every subdirectory with a config and a checkpoint."""
+        models = {}
+        with self._lock:
+            self._load_index()
+            if self.base_dir.exists():
+                for item in sorted(self.base_dir.iterdir()):
+                    if item.is_dir():
+                        entry = self._entry(item.resolve())
+                        if entry["config_path"] and entry["ckpt_path"]:
+                            models[item.name] = item.resolve()
+            self._save_index()
+        return models
+
+    def info(self, model_dir):
+        """
+        Returns a dict with config_path, ckpt_path, model_type and stems
+        for a model directory. Directories outside base_dir are cached in
+        memory but not written to the index.
+        """
+        model_dir = Path(model_dir).resolve()
+        with self._lock:
+            self._load_index()
+            entry = self._entry(model_dir)
+            self._save_index()
+        if not entry["config_path"]:
+            raise Exception(f"No config file found in {model_dir}")
+        if entry["error"]:
+            raise Exception(f"Could not read {entry['config_path']}: {entry['error']}")
+        return {
+            "config_path": Path(entry["config_path"]),
+            "ckpt_path": Path(entry["ckpt_path"]) if entry["ckpt_path"] else None,
+            "model_type": entry["model_type"],
+            "stems": list(entry["stems"]),
+        }
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def model_registry(base_dir=None):
+    """The shared registry for base_dir (GuiApp/bandit by default)."""
+    base_dir = Path(base_dir) if base_dir else BANDIT_MODELS_DIR
+    key = str(base_dir.resolve())
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = ModelRegistry(base_dir)
+        return _registries[key]
+
+
+def scan_bandit_models(base_dir=None):
+    """
+    Scans GuiApp/bandit for subdirectories containing configuration files (*.yaml) and checkpoints (*.ckpt, *.chpt).
+    Returns a dict {label: path_to_directory}.
+    """
+    return model_registry(base_dir).scan()
+
+
+def load_bandit_model_info(model_dir):
+    """
+    Reads the ZFTurbo config of a BandIt model directory.
+    Returns a dict with config_path, ckpt_path, model_type and stems.
+    """
+    return model_registry().info(model_dir)
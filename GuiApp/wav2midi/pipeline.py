@@ -0,0 +1,1600 @@
+"""
+Headless Wav2Midi conversion pipeline.
+
+Everything that used to live in Wav2MidiApp.run_conversion is here so the
+same steps can be driven by the GUI, by the batch CLI or by other scripts
+without a display. The pipeline never touches tkinter: settings come in as
+a ConversionOptions object and progress goes out through a `log` callable.
+"""
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional
+import hashlib
+import io
+import json
+import os
+import sys
+import shutil
+import time
+import uuid
+import numpy as np
+
+from .audio import (
+    compact_stems,
+    convert_wav,
+    crossfade_segments,
+    from_float,
+    mix_arrays,
+    mix_stems,
+    open_wav,
+    resample_array,
+    resample_wav,
+    scan_levels,
+    stem_files,
+    write_array,
+    write_slice,
+)
+from .backends import local_backend
+from .cache import SeparationCache, file_digest
+from .eta import THROUGHPUT_FILE, ProgressTracker, ThroughputModel, queue_seconds
+from .governor import PROFILES_FILE, ResourceGovernor, thread_env
+from .logsink import PROGRESS, prefix_message, split_progress
+from .manifest import Manifest
+from .model_server import run_on_model_server
+from .models import (
+    DEMUCS_STEMS,
+    load_bandit_model_info,
+)
+from .profiling import Profiler, annotate, audio_seconds, wait_child
+from .runner import Cancelled, check_cancelled, current_context, kill_tree, popen_group, stop_on_cancel
+from .scheduler import DONE, FAILED, StageScheduler
+from .segments import plan_segments, stitch_midi
+
+ZFT_INFERENCE_SCRIPT = Path("Music-Source-Separation-Training") / "inference.py"
+# Demucs stems with BandIt stems mixed in, next to (not over) the Demucs output
+MERGED_DIR = "merged"
+# Stems already at their transcriber's sample rate and channel count (prepare_stems)
+PREPARED_DIR = "prepared"
+# (sample rate, channels) each transcriber loads its input as
+TRANSCRIBER_INPUT = {"basic_pitch": (22050, 1), "adtof": (44100, 1)}
+# Sample format the in-process path stores each demucs_output in (int24 as 32-bit PCM / 24-bit FLAC)
+DEMUCS_DTYPES = {"int16": np.int16, "int24": np.int32, "float32": np.float32}
+
+
+def mix_audio(file1, file2, output_file):
+    """Mixes two WAV/FLAC files into output_file (which may be one of them)."""
+    rate1, data1 = open_wav(file1)
+    rate2, data2 = open_wav(file2)
+    out_dtype = np.result_type(data1.dtype, data2.dtype)
+    del data1, data2
+    mix_stems([file1, file2], output_file, out_dtype=out_dtype)
+
+
+@dataclass
+class BanditSettings:
+    """BandIt pre-separation settings for one conversion."""
+    model_dir: Path
+    demucs_input_stem: str = "music"
+    # BandIt stem name -> Demucs target ("Vocals", "Drums", ... or "None")
+    merge_targets: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class ConversionOptions:
+    """Settings shared by every file of a convert() call."""
+    output_root: Path = Path("outputs")
+    use_6_stems: bool = False
+    force_separate: bool = False
+    force_midi: bool = False
+    bandit: Optional[BanditSettings] = None
+    # Number of songs in flight at the same time (their stages overlap, see scheduler.py).
+    jobs: int = 1
+    # Number of basic-pitch/adtof runs at the same time, across all songs.
+    transcribe_workers: int = 2
+    # Concurrency per stage kind ("bandit", "demucs", "merge", "transcribe", ...), overriding the defaults.
+    stage_slots: Dict[str, int] = field(default_factory=dict)
+    # Address of a warm model server (see model_server.py); None = always use subprocesses.
+    model_server: Optional[str] = None
+    # Content-addressed separation cache (see cache.py); cache_dir defaults to <output_root>/.cache
+    use_cache: bool = True
+    cache_dir: Optional[Path] = None
+    cache_max_bytes: int = 20 * 1024 ** 3
+    # Feed BandIt's float stems straight to Demucs instead of converting them to int16
+    keep_float_stems: bool = False
+    # Files converted to int16 at the same time
+    convert_workers: int = 4
+    # Separate the songs of a convert() call with one inference.py run per bandit_batch_size songs
+    batch_bandit: bool = True
+    # Songs per batched BandIt run. A song's Demucs waits for its whole batch, so smaller
+    # batches overlap BandIt with Demucs sooner; larger ones load the model less often.
+    bandit_batch_size: int = 4
+    # Write <song>/profile.json with per-stage timings (see profiling.py)
+    profile_report: bool = True
+    # Segmented mode (see segments.py): cut the Demucs input into segments of this many
+    # seconds, overlapping by segment_overlap; None = process the whole file at once.
+    segment_seconds: Optional[float] = None
+    segment_overlap: float = 5.0
+    # A stem whose peak or RMS level (dBFS) is below these is treated as silent (None = no limit).
+    # silent_stems: "empty" writes an empty MIDI file, "skip" writes nothing, "transcribe" disables the scan.
+    silence_peak_db: Optional[float] = -50.0
+    silence_rms_db: Optional[float] = -65.0
+    silent_stems: str = "empty"
+    # Seconds a stage of each kind ("bandit", "demucs", "transcribe", ...) may run before its
+    # processes are killed and it fails, e.g. {"transcribe": 600}; kinds not listed have no limit.
+    stage_timeouts: Dict[str, float] = field(default_factory=dict)
+    # Resample/downmix each stem once to what its transcriber expects (e.g. 22.05 kHz mono for
+    # basic-pitch) and keep it in <song>/prepared, instead of every tool decoding 44.1 kHz stereo.
+    prepare_stems: bool = False
+    # "flac" stores BandIt, Demucs and merged stems as FLAC instead of WAV (lossless for 16-bit
+    # stems, 24-bit for float ones); every stage reads it directly, see audio.FlacFrames.
+    stem_format: str = "wav"
+    # Cores shared out as thread budgets among the running tools (see governor.py);
+    # None = all available cores, 0 = leave the tools' thread pools alone.
+    cpu_threads: Optional[int] = None
+    # Tools only start while their estimated memory fits in this many MB next to the running ones;
+    # None = 80% of the memory available at the start, 0 = no memory admission control.
+    memory_budget_mb: Optional[float] = None
+    # Stems to transcribe (Demucs or BandIt stem names, e.g. ["drums"]); None = all. Demucs runs
+    # with --two-stems when only one of its stems is wanted and not at all when none is, and
+    # BandIt stems are only merged into selected targets.
+    stems: Optional[List[str]] = None
+    # Demucs --shifts, --overlap and --segment; None keeps Demucs' defaults (1, 0.25, the model's).
+    demucs_shifts: Optional[int] = None
+    demucs_overlap: Optional[float] = None
+    demucs_segment: Optional[int] = None
+    # Sample format of the Demucs stems: "int16", "int24" or "float32"
+    demucs_output: str = "int16"
+    # Run Demucs, basic-pitch and ADTOF inside this process (backends.py, models loaded once) and
+    # hand Demucs stems to the merges, level scans and basic-pitch as arrays instead of re-reading
+    # them; the stems and MIDI are still written as outputs. Tools that cannot be loaded here fall
+    # back to the model server / subprocess.
+    in_process: bool = False
+
+
+@dataclass
+class ConversionResult:
+    input_path: Path
+    output_dir: Path
+    success: bool
+    error: Optional[str] = None
+    # Stem name -> error message for stems whose MIDI conversion failed
+    failed_stems: Dict[str, str] = field(default_factory=dict)
+    # Stopped by CancelToken.cancel() before it finished
+    cancelled: bool = False
+
+
+def console_log(message):
+    # A single write per message, so lines from parallel stems do not interleave
+    sys.stdout.write(f"{split_progress(message)[1]}\n")
+    sys.stdout.flush()
+
+
+def run_command_capture(cmd, description, log=print):
+    """
+    Runs cmd, logging its output. Returns False when it fails; raises
+    Cancelled / StageTimeout (see runner.py) when the stage is cancelled or
+    times out, after killing the command's whole process tree.
+    """
+    check_cancelled()
+    log(f"Running: {description}")
+    log(f"Command: {' '.join(cmd)}")
+    context = current_context()
+    env = None
+    if context is not None and context.threads:
+        env = thread_env(context.threads)
+        annotate(threads=context.threads)
+    try:
+        process = popen_group(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+
+        with stop_on_cancel(lambda: kill_tree(process)):
+            # newline="" keeps "\r" visible, so progress bar redraws can be told apart
+            # from real lines and collapsed by the log sink (see logsink.py).
+            in_progress = False
+            for line in io.TextIOWrapper(process.stdout, errors="replace", newline=""):
+                text = line.strip()
+                if line.endswith("\r") and not line.endswith("\r\n"):
+                    if text:
+                        log(PROGRESS + text)
+                        in_progress = True
+                elif in_progress:
+                    # Final state of the bar replaces its last redraw
+                    log(PROGRESS + text)
+                    in_progress = False
+                else:
+                    log(text)
+
+            wait_child(process)
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+        log(f"--- Finished {description} ---")
+        return True
+    except subprocess.CalledProcessError as e:
+        log(f"Error during {description}: {e}")
+        return False
+    except FileNotFoundError:
+        log(f"Command not found: {cmd[0]}")
+        return False
+
+
+def run_tool(options, tool, params, cmd, description, log=print):
+    """
+    Runs a Demucs / Basic Pitch / ADTOF job on the warm model server when one
+    is configured and reachable, otherwise as a subprocess.
+    """
+    if options.model_server:
+        check_cancelled()
+        log(f"Running on model server: {description}")
+        ok = run_on_model_server(options.model_server, tool, params, log)
+        if ok is not None:
+            # The work happened in the server process, so no child CPU/RSS is recorded
+            annotate(runner="model_server")
+            if ok:
+                log(f"--- Finished {description} ---")
+            return ok
+        log(f"Model server {options.model_server} unavailable, falling back to subprocess.")
+    return run_command_capture(cmd, description, log)
+
+
+def unique_song_name(path):
+    """Output folder name that no other input path gets: the stem plus a short hash of the resolved path."""
+    path = Path(path)
+    return f"{path.stem}-{hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:8]}"
+
+
+def song_names(paths):
+    """
+    Output folder name of each path: its stem, or unique_song_name() when
+    other inputs share that stem (a/track.wav and b/track.wav), so their
+    outputs and manifests do not overwrite each other.
+    """
+    paths = [Path(p) for p in paths]
+    resolved = [p.resolve() for p in paths]
+    if len(set(resolved)) != len(resolved):
+        raise Exception("The same input file is given more than once.")
+    stems = [p.stem for p in paths]
+    return [p.stem if stems.count(p.stem) == 1 else unique_song_name(p) for p in paths]
+
+
+class SongJob:
+    """Paths and intermediate state of one song going through the pipeline."""
+
+    def __init__(self, input_path, options, log=print, profiler=None, song_name=None):
+        self.input_path = Path(input_path)
+        self.options = options
+        self.log = log
+        self.profiler = profiler or Profiler()
+        self.song_name = song_name or self.input_path.stem
+        self.output_dir = Path(options.output_root) / self.song_name
+        self.midi_dir = self.output_dir / "midi"
+        self.demucs_model = "htdemucs_6s" if options.use_6_stems else "htdemucs"
+        self.cache = None
+        if options.use_cache:
+            cache_dir = options.cache_dir or Path(options.output_root) / ".cache"
+            self.cache = SeparationCache(cache_dir, options.cache_max_bytes)
+        self._manifest = None
+        # Filled in while the stages run
+        self.demucs_input = self.input_path
+        self.bandit_stems = {} # Map stem_name -> file_path
+        self.demucs_stems = []
+        self.wav_files = [] # Stems to transcribe
+        self.stem_audio = {} # stem path -> (rate, array) kept in memory by the in-process path
+        self.progress = None # ProgressTracker of the conversion, see eta.py
+        # Segmented mode: (start, end) in seconds for a segment's job, the segment jobs for a song
+        self.segment = None
+        self.segments = []
+        # Names of MIDI files not written because their stem was silent (silent_stems="skip")
+        self.skipped_silent = set()
+
+    @property
+    def manifest(self):
+        # Created on first use, since segment jobs move output_dir after __init__
+        if self._manifest is None:
+            self._manifest = Manifest(self.output_dir)
+        return self._manifest
+
+
+def profile_stage(job, stage, audio=None):
+    return job.profiler.stage(job.song_name, stage, audio)
+
+
+def separation_fingerprint(job, stage, input_path, params):
+    return job.manifest.fingerprint([input_path], params, tool=stage)
+
+
+def adopt_existing_output(job, stage, out_dir):
+    """
+    Output folders written before the manifest existed are taken as they
+    are (as the old existence check did) instead of separating again.
+    """
+    return (not job.options.force_separate and stage not in job.manifest.artifacts
+            and bool(stem_files(out_dir, recursive=True)))
+
+
+def cached_stage(job, stage, input_path, params, out_dir, run, adopt=False):
+    """
+    Brings out_dir up to date with the result of `stage` on input_path.
+    Nothing happens when the manifest shows it was built from the same
+    input and parameters and is intact; otherwise it is filled from the
+    separation cache, or by calling run() (and published to the cache).
+    With adopt=True an existing output without a manifest entry is kept.
+    """
+    fingerprint = separation_fingerprint(job, stage, input_path, params)
+    if not job.options.force_separate and job.manifest.current(stage, fingerprint):
+        job.log(f"{stage} output for {Path(input_path).name} is up to date.")
+        annotate(cache="up to date")
+        return
+    if adopt and adopt_existing_output(job, stage, out_dir):
+        job.log(f"{stage} output already exists at {out_dir}. Skipping separation.")
+        annotate(cache="adopted")
+        job.manifest.record(stage, fingerprint, stem_files(out_dir, recursive=True))
+        return
+
+    key = job.cache.key(input_path, stage, params) if job.cache else None
+    if key and not job.options.force_separate and job.cache.materialize(key, out_dir):
+        job.log(f"Using cached {stage} result for {Path(input_path).name} ({key[:12]}).")
+        annotate(cache="hit")
+    else:
+        annotate(cache="miss")
+        if job.options.force_separate:
+            job.log(f"Force separation enabled: Re-running {stage}.")
+        else:
+            job.log(f"Running {stage}: {job.manifest.reason(stage, fingerprint)}.")
+        shutil.rmtree(out_dir, ignore_errors=True)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            run()
+            if job.options.stem_format == "flac":
+                with profile_stage(job, f"{stage}-flac"):
+                    compact_stems(out_dir)
+        except Exception:
+            # Do not leave half-written stems behind (e.g. when cancelled or timed out)
+            shutil.rmtree(out_dir, ignore_errors=True)
+            raise
+        if job.cache:
+            job.cache.publish(key, out_dir, stage, params)
+
+    job.manifest.record(stage, fingerprint, stem_files(out_dir, recursive=True))
+
+
+def stem_format_params(job, params):
+    """Adds the stem format to a stage's parameters (only when it is not the default, so old entries stay valid)."""
+    if job.options.stem_format != "wav":
+        params["stem_format"] = job.options.stem_format
+    return params
+
+
+def stage_file(src, dst):
+    """
+    Makes src available as dst without copying the audio when possible:
+    a hard link on the same filesystem, else a symlink, and only as a last
+    resort (e.g. Windows without symlink rights) a copy.
+    """
+    src, dst = Path(src), Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(src.resolve(), dst)
+        return
+    except (OSError, NotImplementedError):
+        pass
+    shutil.copy2(src, dst)
+
+
+def zft_command(info, input_dir, store_dir):
+    return [
+        sys.executable, str(ZFT_INFERENCE_SCRIPT),
+        "--model_type", info["model_type"],
+        "--config_path", str(info["config_path"]),
+        "--start_check_point", str(info["ckpt_path"]),
+        "--input_folder", str(input_dir),
+        "--store_dir", str(store_dir),
+        "--disable_detailed_pbar" # Clean logs
+    ]
+
+
+def run_zft_inference(job, info, bandit_output_dir):
+    job.log("Running ZFTurbo Separation...")
+
+    # inference.py processes every file of --input_folder, so the song is
+    # staged alone in a temporary folder.
+    tmp_input_dir = job.output_dir / "tmp_input"
+    shutil.rmtree(tmp_input_dir, ignore_errors=True)
+    stage_file(job.input_path, tmp_input_dir / job.input_path.name)
+
+    try:
+        if not run_command_capture(zft_command(info, tmp_input_dir, bandit_output_dir), "Separation Inference", job.log):
+            raise Exception("Separation failed")
+    finally:
+        shutil.rmtree(tmp_input_dir, ignore_errors=True)
+
+
+BANDIT_BATCH_DIR = "bandit.batch"
+_BATCH_SOURCE_FILE = ".source.json"
+
+
+def _batch_source(job):
+    st = job.input_path.stat()
+    return {
+        "input": str(job.input_path.resolve()),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "model_dir": str(Path(job.options.bandit.model_dir).resolve()),
+    }
+
+
+def bandit_cache_params(job, info):
+    ckpt = info["ckpt_path"]
+    return stem_format_params(job, {
+        "model_type": info["model_type"],
+        "config": file_digest(info["config_path"]),
+        "checkpoint": [ckpt.name, ckpt.stat().st_size, ckpt.stat().st_mtime_ns],
+        "format": "float" if job.options.keep_float_stems else "int16",
+    })
+
+
+def bandit_needs_separation(job, info):
+    if job.options.force_separate:
+        return True
+    params = bandit_cache_params(job, info)
+    if job.manifest.current("bandit", separation_fingerprint(job, "bandit", job.input_path, params)):
+        return False
+    if adopt_existing_output(job, "bandit", job.output_dir / "bandit"):
+        return False
+    if job.cache:
+        return job.cache.lookup(job.cache.key(job.input_path, "bandit", params)) is None
+    return True
+
+
+def run_bandit_batch(jobs, log=console_log):
+    """
+    Separates several songs with a single inference.py run (one interpreter
+    and one model load) instead of one process per song. The inputs are
+    linked into one staging folder, and each song's results are parked in
+    <song>/bandit.batch until its own pipeline picks them up. Returns the
+    jobs it separated.
+    """
+    info = load_bandit_model_info(jobs[0].options.bandit.model_dir)
+    if info["ckpt_path"] is None:
+        return []
+
+    jobs = [job for job in jobs if bandit_needs_separation(job, info)]
+    if len(jobs) < 2:
+        return []
+
+    staging_root = Path(jobs[0].options.output_root) / ".staging" / uuid.uuid4().hex
+    input_dir = staging_root / "input"
+    store_dir = staging_root / "output"
+    staged = []
+    for i, job in enumerate(jobs):
+        # Prefix with an index so songs with the same file name do not collide
+        staged_name = f"{i:04d}_{job.input_path.name}"
+        stage_file(job.input_path, input_dir / staged_name)
+        staged.append((job, Path(staged_name).stem))
+
+    try:
+        log(f"Running ZFTurbo Separation for {len(jobs)} songs in one batch...")
+        if not run_command_capture(zft_command(info, input_dir, store_dir), "Batch Separation Inference", log):
+            log("Batch separation failed; songs will be separated one by one.")
+            return []
+
+        for job, staged_stem in staged:
+            hold_dir = job.output_dir / BANDIT_BATCH_DIR
+            shutil.rmtree(hold_dir, ignore_errors=True)
+            hold_dir.mkdir(parents=True)
+            # inference.py writes either <store>/<track>/<stem>.wav or <store>/<track>_<stem>.wav
+            for item in store_dir.iterdir():
+                if item.name == staged_stem:
+                    shutil.move(str(item), str(hold_dir / job.song_name))
+                elif item.name.startswith(staged_stem + "_"):
+                    shutil.move(str(item), str(hold_dir / (job.song_name + item.name[len(staged_stem):])))
+            with open(hold_dir / _BATCH_SOURCE_FILE, "w") as f:
+                json.dump(_batch_source(job), f)
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
+    return jobs
+
+
+def take_batched_bandit_output(job, bandit_output_dir):
+    """Moves results of run_bandit_batch for this song into bandit_output_dir. Returns False if there are none."""
+    hold_dir = job.output_dir / BANDIT_BATCH_DIR
+    if not hold_dir.exists():
+        return False
+    try:
+        with open(hold_dir / _BATCH_SOURCE_FILE) as f:
+            valid = json.load(f) == _batch_source(job)
+    except (OSError, ValueError):
+        valid = False
+
+    if valid:
+        job.log("Using ZFTurbo output from the batch run.")
+        bandit_output_dir.mkdir(parents=True, exist_ok=True)
+        for item in hold_dir.iterdir():
+            if item.name == _BATCH_SOURCE_FILE:
+                continue
+            target = bandit_output_dir / item.name
+            if target.is_dir():
+                shutil.rmtree(target)
+            elif target.exists():
+                target.unlink()
+            shutil.move(str(item), str(target))
+    shutil.rmtree(hold_dir, ignore_errors=True)
+    return valid
+
+
+INT16_LEDGER = ".int16_converted.json"
+
+
+def convert_bandit_outputs(job, bandit_output_dir):
+    """
+    Converts float BandIt outputs to 16-bit Int in place, streaming each file
+    in blocks and several files at a time. Converted files are recorded with
+    their size and mtime, so a rerun does no I/O for them.
+    """
+    if job.options.keep_float_stems:
+        job.log("Keeping BandIt outputs in their original sample format.")
+        return
+
+    ledger_path = bandit_output_dir / INT16_LEDGER
+    try:
+        with open(ledger_path) as f:
+            ledger = json.load(f)
+    except (OSError, ValueError):
+        ledger = {}
+
+    def signature(f):
+        st = f.stat()
+        return [st.st_size, st.st_mtime_ns]
+
+    pending = []
+    for f in bandit_output_dir.rglob("*.wav"):
+        if ledger.get(f.relative_to(bandit_output_dir).as_posix()) != signature(f):
+            pending.append(f)
+    if not pending:
+        return
+
+    def convert_one(f, record):
+        cpu_start = time.thread_time()
+        try:
+            if convert_wav(f, np.int16):
+                job.log(f"Converted {f.name} to 16-bit.")
+            else:
+                job.log(f"{f.name} is already int16.")
+        except Exception as e:
+            job.log(f"Error converting {f.name}: {e}")
+            return
+        finally:
+            record.add_cpu(time.thread_time() - cpu_start)
+        ledger[f.relative_to(bandit_output_dir).as_posix()] = signature(f)
+
+    job.log("Converting BandIt outputs to 16-bit WAV...")
+    with profile_stage(job, "bandit-int16", pending) as record, \
+            ThreadPoolExecutor(max_workers=max(1, min(job.options.convert_workers, len(pending)))) as pool:
+        list(pool.map(partial(convert_one, record=record), pending))
+
+    with open(ledger_path, "w") as f:
+        json.dump(ledger, f)
+
+
+def run_bandit(job):
+    settings = job.options.bandit
+    if not settings.model_dir:
+        raise Exception("BandIt enabled but no valid model selected.")
+    info = load_bandit_model_info(settings.model_dir)
+    if info["ckpt_path"] is None:
+        raise Exception(f"No checkpoint found in {settings.model_dir}")
+
+    job.log(f"Selected Model: {Path(settings.model_dir).name} (Type: {info['model_type']})")
+    job.log(f"Expected Stems: {info['stems']}")
+
+    bandit_output_dir = job.output_dir / "bandit"
+    bandit_output_dir.mkdir(parents=True, exist_ok=True)
+
+    def separate():
+        if take_batched_bandit_output(job, bandit_output_dir):
+            annotate(batched=True)
+        else:
+            run_zft_inference(job, info, bandit_output_dir)
+        convert_bandit_outputs(job, bandit_output_dir)
+
+    # BandIt output is never modified afterwards, so folders from before the manifest can be adopted
+    cached_stage(job, "bandit", job.input_path, bandit_cache_params(job, info), bandit_output_dir, separate, adopt=True)
+    collect_bandit_stems(job, bandit_output_dir)
+
+
+def collect_bandit_stems(job, bandit_output_dir):
+    """Fills job.bandit_stems and picks the Demucs input among them."""
+    settings = job.options.bandit
+    found_files = stem_files(bandit_output_dir, recursive=True)
+    job.log(f"Generated files: {[f.name for f in found_files]}")
+    for f in found_files:
+        job.bandit_stems[f.stem.lower()] = f
+
+    # Select Demucs Input
+    target_stem_name = (settings.demucs_input_stem or "music").lower()
+
+    music_stem = job.bandit_stems.get(target_stem_name)
+    if music_stem is None:
+        # Fuzzy match fallback
+        for name in job.bandit_stems:
+            if target_stem_name in name:
+                music_stem = job.bandit_stems[name]
+                break
+
+    if not music_stem:
+        raise Exception(f"Selected Demucs input stem '{target_stem_name}' not found in BandIt outputs.")
+
+    job.demucs_input = music_stem
+    job.log(f"Using BandIt stem '{music_stem.name}' as input for Demucs.")
+
+
+def stem_selected(job, stem_name):
+    stems = job.options.stems
+    return stems is None or stem_name.lower() in {s.lower() for s in stems}
+
+
+def demucs_settings(job):
+    """
+    Demucs options that differ from its defaults, e.g. {"two_stems": "drums",
+    "shifts": 2}. They are part of the separation fingerprint, so changing
+    them separates again while runs with the defaults keep their cache.
+    """
+    options = job.options
+    settings = {}
+    if options.stems is not None:
+        wanted = [s for s in DEMUCS_STEMS[job.demucs_model] if stem_selected(job, s)]
+        if len(wanted) == 1:
+            settings["two_stems"] = wanted[0]
+    if options.demucs_shifts is not None:
+        settings["shifts"] = options.demucs_shifts
+    if options.demucs_overlap is not None:
+        settings["overlap"] = options.demucs_overlap
+    if options.demucs_segment is not None:
+        settings["segment"] = options.demucs_segment
+    if options.demucs_output != "int16":
+        settings["output"] = options.demucs_output
+    return settings
+
+
+def demucs_needed(job):
+    """False when stems are selected and none of them comes from Demucs."""
+    return any(stem_selected(job, s) for s in DEMUCS_STEMS[job.demucs_model])
+
+
+def demucs_command(job, settings):
+    cmd = ["demucs", "-n", job.demucs_model, str(job.demucs_input), "-o", str(job.output_dir)]
+    if "two_stems" in settings:
+        cmd += ["--two-stems", settings["two_stems"]]
+    for name in ("shifts", "overlap", "segment"):
+        if name in settings:
+            cmd += [f"--{name}", f"{settings[name]:g}"]
+    if settings.get("output") in ("int24", "float32"):
+        cmd.append(f"--{settings['output']}")
+    return cmd
+
+
+def run_demucs(job):
+    if not demucs_needed(job):
+        job.log(f"Skipping Demucs: none of the selected stems ({', '.join(job.options.stems)}) comes from it.")
+        annotate(skipped="not selected")
+        job.demucs_stems = []
+        return
+
+    demucs_output_path = demucs_output_dir(job)
+    settings = demucs_settings(job)
+
+    def separate():
+        if job.options.in_process and separate_in_process(job, settings, demucs_output_path):
+            return
+        demucs_cmd = demucs_command(job, settings)
+        params = dict(settings, model=job.demucs_model, input=job.demucs_input, output_root=job.output_dir)
+        if not run_tool(job.options, "demucs", params, demucs_cmd, "Demucs (Audio Separation)", job.log):
+            raise Exception("Demucs failed")
+
+    cached_stage(job, "demucs", job.demucs_input, demucs_params(job), demucs_output_path, separate)
+
+    # Only this model's output for this input; other folders under the song are not stems
+    job.demucs_stems = stem_files(demucs_output_path)
+    if not job.demucs_stems:
+        job.log(f"Warning: No audio files found in {demucs_output_path}. Please check if Demucs ran correctly.")
+        raise Exception("No wav files found")
+
+
+def separate_in_process(job, settings, out_dir):
+    """
+    Runs Demucs inside this process, writes its stems to out_dir and keeps
+    them in job.stem_audio. Returns False when Demucs cannot be loaded here.
+    """
+    try:
+        backend, lock = local_backend("demucs", job.demucs_model, job.log)
+    except Exception as e:
+        job.log(f"In-process Demucs unavailable ({e}); running it as a tool.")
+        return False
+
+    check_cancelled()
+    job.log("Running in process: Demucs (Audio Separation)")
+    kwargs = {k: v for k, v in settings.items() if k != "output"}
+    with lock:
+        rate, stems = backend.separate_arrays(job.demucs_input, log=job.log, **kwargs)
+    check_cancelled()
+    dtype = DEMUCS_DTYPES[settings.get("output", "int16")]
+    suffix = ".flac" if job.options.stem_format == "flac" else ".wav"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for name, samples in stems:
+        path = out_dir / f"{name}{suffix}"
+        data = from_float(samples, dtype)
+        write_array(path, rate, data)
+        job.stem_audio[path] = (rate, data)
+    annotate(runner="in_process")
+    return True
+
+
+def demucs_params(job):
+    return stem_format_params(job, dict(demucs_settings(job), model=job.demucs_model))
+
+
+def demucs_output_dir(job):
+    # Demucs writes to <out>/<model>/<input track name>/<stem>.wav
+    return job.output_dir / job.demucs_model / job.demucs_input.stem
+
+
+def merge_plan(job):
+    """{demucs stem key: (demucs file, [(bandit stem name, bandit file)])} for the configured merge targets."""
+    settings = job.options.bandit
+    if not settings or not settings.merge_targets:
+        return {}
+
+    job.log("Processing Merge Targets...")
+    demucs_map = {w.stem.lower(): w for w in job.demucs_stems}
+
+    # Collect every BandIt stem per Demucs target, so each target is read and written once
+    sources_by_target = {}
+    for b_stem_name, target in settings.merge_targets.items():
+        if target == "None":
+            continue
+
+        target_key = target.lower() # vocals, drums...
+        if not stem_selected(job, target_key):
+            continue
+
+        b_file = job.bandit_stems.get(b_stem_name.lower())
+        if not b_file:
+            job.log(f"Warning: Could not find BandIt output for stem '{b_stem_name}' to merge.")
+            continue
+
+        if target_key not in demucs_map:
+            job.log(f"Warning: Demucs target '{target}' not found. Cannot merge '{b_stem_name}'.")
+            continue
+
+        sources_by_target.setdefault(target_key, []).append((b_stem_name, b_file))
+
+    return {key: (demucs_map[key], sources) for key, sources in sources_by_target.items()}
+
+
+def merge_fingerprint(job, d_file, sources):
+    return job.manifest.fingerprint([d_file] + [f for _, f in sources], {"sources": sorted(n for n, _ in sources)})
+
+
+def stems_to_transcribe(job, plan, merged):
+    """
+    Demucs stems (their merged version where one exists) plus the BandIt
+    stems that were neither merged nor fed to Demucs, so every part of the
+    audio is transcribed exactly once. With a stem selection only the
+    selected ones (by name) are kept.
+    """
+    used = {f for _, sources in plan.values() for _, f in sources}
+    wav_files = [merged.get(d.stem.lower(), d) for d in job.demucs_stems]
+    # The Demucs input is only left over when Demucs was skipped
+    wav_files += [f for f in job.bandit_stems.values()
+                  if f not in used and (f != job.demucs_input or not demucs_needed(job))]
+    return [f for f in wav_files if stem_selected(job, f.stem)]
+
+
+def stale_merges(job, merged):
+    """Merged stems on disk whose merge is no longer configured."""
+    merged_dir = job.output_dir / MERGED_DIR
+    if not merged_dir.exists():
+        return []
+    return [f for f in stem_files(merged_dir) if f.stem.lower() not in merged]
+
+
+def midi_names(job, wav_files):
+    """File names of the MIDI files transcribed from wav_files."""
+    tasks = [transcription_task(job, f) for f in wav_files]
+    return {task.midi_out.name for task in tasks if task is not None}
+
+
+def stale_midi(job, keep):
+    """Manifest entries of MIDI files other than `keep` (names), i.e. of stems no longer transcribed."""
+    return [name for name in list(job.manifest.artifacts) if name.startswith("midi:") and name[5:] not in keep]
+
+
+def remove_stale_midi(job, keep):
+    """
+    Deletes the MIDI files built earlier for stems that are no longer
+    transcribed (e.g. a BandIt stem now merged into a Demucs stem) and
+    drops their manifest entries.
+    """
+    for name in stale_midi(job, keep):
+        job.manifest.remove(name)
+        job.log(f"Removed {name[5:]}: its stem is no longer transcribed.")
+
+
+def merge_bandit_stems(job):
+    """
+    Mixes BandIt stems into copies of their Demucs target under <song>/merged
+    (the Demucs output stays as it is) and sets job.wav_files. A merged stem
+    is only rebuilt when one of its sources or the source list changed.
+    """
+    plan = merge_plan(job)
+    merged_dir = job.output_dir / MERGED_DIR
+    merged = {}
+    for target_key, (d_file, sources) in plan.items():
+        output = merged_dir / d_file.name
+        name = f"merge:{d_file.stem}"
+        fingerprint = merge_fingerprint(job, d_file, sources)
+        if job.manifest.current(name, fingerprint):
+            job.log(f"Merged '{target_key}' is up to date.")
+            merged[target_key] = output
+            continue
+
+        names = ", ".join(f"'{name}'" for name, _ in sources)
+        job.log(f"Merging BandIt {names} into Demucs '{target_key}'.")
+        try:
+            merged_dir.mkdir(parents=True, exist_ok=True)
+            # Keeps the Demucs file's sample format
+            with profile_stage(job, f"merge:{target_key}", d_file):
+                if d_file in job.stem_audio:
+                    mixed = mix_arrays([job.stem_audio.pop(d_file)] + [f for _, f in sources])
+                    write_array(output, *mixed)
+                    job.stem_audio[output] = mixed
+                else:
+                    mix_stems([d_file] + [f for _, f in sources], output)
+            job.manifest.record(name, fingerprint, [output])
+            merged[target_key] = output
+        except Exception as e:
+            job.log(f"Failed to merge: {e}")
+
+    # Merges that are no longer configured
+    for stale in stale_merges(job, merged):
+        stale.unlink()
+        job.manifest.forget(f"merge:{stale.stem}")
+
+    job.wav_files = stems_to_transcribe(job, plan, merged)
+    remove_stale_midi(job, midi_names(job, job.wav_files))
+    # Only stems still to be transcribed stay in memory
+    job.stem_audio = {f: audio for f, audio in job.stem_audio.items() if f in job.wav_files}
+
+
+TranscriptionTask = namedtuple("TranscriptionTask", "tool params cmd midi_out description")
+
+
+def transcription_task(job, wav_file, source=None):
+    """
+    Describes how one stem is transcribed, or returns None when it is not
+    transcribed at all. The tool reads `source` (default: wav_file), e.g.
+    the stem prepared by prepare_stem.
+    """
+    stem_name = wav_file.stem  # e.g., "drums", "vocals", "bass", "other"
+    source = source or wav_file
+
+    if stem_name == "drums":
+        midi_out = job.midi_dir / f"{stem_name}_adtof.mid"
+        adtof_cmd = [
+            "adtof",
+            "--audio", str(source),
+            "--out", str(midi_out),
+            "--device", "cpu"
+        ]
+        params = {"input": source, "midi_out": midi_out, "device": "cpu"}
+        return TranscriptionTask("adtof", params, adtof_cmd, midi_out, f"ADTOF (Drums) for {wav_file.name}")
+
+    if stem_name == "effects":
+        return None
+
+    # basic-pitch <output_dir> <input_audio> writes <stem>_basic_pitch.mid
+    midi_out = job.midi_dir / f"{stem_name}_basic_pitch.mid"
+    basic_pitch_cmd = [
+        "basic-pitch",
+        str(job.midi_dir),
+        str(source)
+    ]
+    params = {"input": source, "midi_dir": job.midi_dir}
+
+    # Finer granularity (1/32, 1/64) for bass and other.
+    # Default minimum note length is ~58ms. 30ms is approx 1/64 at 120bpm.
+    # Also applying to guitar and piano for 6-stem mode.
+    if stem_name in ["bass", "other", "guitar", "piano"]:
+        basic_pitch_cmd.extend(["--minimum-note-length", "30"])
+        params["minimum_note_length"] = 30
+
+    return TranscriptionTask("basic_pitch", params, basic_pitch_cmd, midi_out, f"Basic Pitch for {wav_file.name}")
+
+
+def prepare_target(job, tool):
+    """(rate, channels) a stem for `tool` is prepared at, or None when stems are passed as they are."""
+    return TRANSCRIBER_INPUT.get(tool) if job.options.prepare_stems else None
+
+
+def prepare_stem(job, wav_file, tool, log):
+    """
+    Returns the file `tool` should read: wav_file itself, or a copy at the
+    tool's sample rate and channel count (see prepare_target), built once
+    in <song>/prepared and kept until the stem changes.
+    """
+    target = prepare_target(job, tool)
+    if target is None:
+        return wav_file
+    rate, channels = target
+    in_rate, data = open_wav(wav_file)
+    in_channels = data.shape[1]
+    data = None
+    if in_rate == rate and in_channels == channels:
+        return wav_file
+
+    # Always WAV: the tools decode it without any codec work
+    output = job.output_dir / PREPARED_DIR / f"{wav_file.stem}.wav"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with profile_stage(job, f"resample:{wav_file.stem}", wav_file):
+        if build_step(job, f"prepared:{wav_file.name}", [wav_file], {"rate": rate, "channels": channels},
+                      [output], lambda: resample_wav(wav_file, output, rate, channels)):
+            log(f"Prepared {output.name} for {tool}: {in_rate} Hz x{in_channels} -> {rate} Hz x{channels}.")
+    return output
+
+
+def stem_is_silent(job, wav_file, log, audio=None):
+    """Energy pre-scan: True when the stem (or its in-memory `audio`) is below the silence thresholds."""
+    options = job.options
+    if options.silent_stems == "transcribe" or (options.silence_peak_db is None and options.silence_rms_db is None):
+        return False
+
+    scan_start = time.perf_counter()
+    try:
+        peak_db, rms_db = scan_levels(audio or wav_file)
+    except Exception as e:
+        log(f"Could not scan levels of {wav_file.name}: {e}")
+        return False
+    scan_s = time.perf_counter() - scan_start
+
+    silent = ((options.silence_peak_db is not None and peak_db < options.silence_peak_db)
+              or (options.silence_rms_db is not None and rms_db < options.silence_rms_db))
+    # -inf (digital silence) is not valid JSON, so it is reported as null
+    annotate(peak_db=round(peak_db, 1) if peak_db > -np.inf else None,
+             rms_db=round(rms_db, 1) if rms_db > -np.inf else None,
+             scan_s=round(scan_s, 4), silent=silent)
+    if silent:
+        log(f"Level scan: peak {peak_db:.1f} dBFS, RMS {rms_db:.1f} dBFS ({scan_s * 1000:.0f} ms) "
+            f"is below the silence threshold.")
+    return silent
+
+
+# Format 0, one track, 220 ticks per beat (pretty_midi's default), end-of-track only
+_EMPTY_MIDI = b"MThd\x00\x00\x00\x06\x00\x00\x00\x01\x00\xdcMTrk\x00\x00\x00\x04\x00\xff\x2f\x00"
+
+
+def write_empty_midi(path):
+    Path(path).write_bytes(_EMPTY_MIDI)
+
+
+def transcription_fingerprint(job, wav_file, task):
+    options = job.options
+    params = {k: v for k, v in task.params.items() if k not in ("input", "midi_dir", "midi_out")}
+    params["silence"] = [options.silent_stems, options.silence_peak_db, options.silence_rms_db]
+    target = prepare_target(job, task.tool)
+    if target:
+        params["prepared"] = list(target)
+    return job.manifest.fingerprint([wav_file], params, tool=task.tool)
+
+
+def transcribe_stem(job, wav_file):
+    """Transcribes one stem. Returns an error message, or None on success or skip."""
+    task = transcription_task(job, wav_file)
+    if task is None:
+        return None
+    log = partial(_stem_log, job.log, wav_file.stem)
+    audio = job.stem_audio.pop(wav_file, None)
+
+    name = f"midi:{task.midi_out.name}"
+    fingerprint = transcription_fingerprint(job, wav_file, task)
+    if not job.options.force_midi:
+        entry = job.manifest.current(name, fingerprint)
+        if entry:
+            log(f"MIDI file {task.midi_out.name} is up to date. Skipping.")
+            annotate(skipped="up to date")
+            if entry.get("silent") and not entry["outputs"]:
+                job.skipped_silent.add(task.midi_out.name)
+            return None
+        log(f"Transcribing: {job.manifest.reason(name, fingerprint)}.")
+
+    if task.midi_out.exists():
+        # basic-pitch refuses to overwrite an existing output
+        task.midi_out.unlink()
+
+    if stem_is_silent(job, wav_file, log, audio):
+        if job.options.silent_stems == "skip":
+            job.skipped_silent.add(task.midi_out.name)
+            log("Stem is silent; skipping transcription.")
+            job.manifest.record(name, fingerprint, [], silent=True)
+        else:
+            write_empty_midi(task.midi_out)
+            log(f"Stem is silent; wrote an empty {task.midi_out.name}.")
+            job.manifest.record(name, fingerprint, [task.midi_out], silent=True)
+        return None
+
+    try:
+        ok = None
+        if job.options.in_process:
+            ok = transcribe_in_process(job, wav_file, task, audio, log)
+        audio = None
+        if ok is None:
+            source = prepare_stem(job, wav_file, task.tool, log)
+            if source != wav_file:
+                task = transcription_task(job, wav_file, source)
+            ok = run_tool(job.options, task.tool, task.params, task.cmd, task.description, log)
+    except Exception:
+        task.midi_out.unlink(missing_ok=True)
+        raise
+    if not ok:
+        return f"{task.description} failed"
+    if not task.midi_out.exists():
+        return f"{task.description} did not write {task.midi_out.name}"
+    job.manifest.record(name, fingerprint, [task.midi_out])
+    return None
+
+
+def transcribe_in_process(job, wav_file, task, audio, log):
+    """
+    Runs task's tool inside this process. basic-pitch gets the stem as an
+    array (its in-memory `audio`, else read from wav_file) resampled in
+    memory; ADTOF only reads files, so it gets wav_file. Returns None when
+    the tool cannot run here, so that run_tool takes over.
+    """
+    try:
+        backend, lock = local_backend(task.tool, log=log)
+    except Exception as e:
+        log(f"In-process {task.tool} unavailable ({e}); running it as a tool.")
+        return None
+
+    check_cancelled()
+    log(f"Running in process: {task.description}")
+    try:
+        with lock:
+            if task.tool == "basic_pitch":
+                rate, data = audio or open_wav(wav_file)
+                samples = resample_array(data, rate, TRANSCRIBER_INPUT["basic_pitch"][0])
+                data = None
+                backend.transcribe_array(samples[:, 0], task.midi_out, task.params.get("minimum_note_length"), log=log)
+            else:
+                backend.transcribe(wav_file, task.midi_out, task.params.get("device", "cpu"), log=log)
+    except Exception as e:
+        log(f"In-process {task.description} failed ({e}); running it as a tool.")
+        task.midi_out.unlink(missing_ok=True)
+        return None
+    annotate(runner="in_process")
+    log(f"--- Finished {task.description} ---")
+    return True
+
+
+def build_step(job, name, inputs, params, outputs, build):
+    """
+    Runs build() to (re)create `outputs` from `inputs`, unless the manifest
+    shows they were already built from the same inputs and params.
+    Returns True when build() ran.
+    """
+    fingerprint = job.manifest.fingerprint(inputs, params)
+    if job.manifest.current(name, fingerprint):
+        return False
+    build()
+    job.manifest.record(name, fingerprint, outputs)
+    return True
+
+
+def prepare_output_dirs(job):
+    job.output_dir.mkdir(parents=True, exist_ok=True)
+    job.midi_dir.mkdir(parents=True, exist_ok=True)
+    job.log(f"Output Directory: {job.output_dir}")
+
+
+def add_transcription_stages(scheduler, job, after, group=None, before=()):
+    """Adds one transcription stage per stem; they share the scheduler's "transcribe" slots."""
+    job.log(f"Found {len(job.wav_files)} split audio files.")
+
+    for wav_file in job.wav_files:
+        task = transcription_task(job, wav_file)
+        model = task.tool if task else None
+
+        def transcribe(wav_file=wav_file, model=model):
+            with profile_stage(job, f"transcribe:{wav_file.stem}", wav_file) as record:
+                error = transcribe_stem(job, wav_file)
+                observe_usage(scheduler, model, record)
+            report_progress(job, model, record)
+            if error:
+                job.log(f"MIDI conversion failed for '{wav_file.stem}': {error}")
+                raise Exception(error)
+
+        scheduler.add(f"{job.song_name}:transcribe:{wav_file.stem}", "transcribe", transcribe,
+                      deps=[after], group=group or job, before=before,
+                      memory=memory_estimate(scheduler, model, lambda wav_file=wav_file: wav_file))
+
+
+def add_whole_file_stages(scheduler, job, after, group=None, before=()):
+    """Demucs -> merge -> transcription per stem, for a song or one of its segments."""
+    group = group or job
+
+    def demucs():
+        # demucs_input is only known once BandIt has run
+        with profile_stage(job, "demucs", job.demucs_input) as record:
+            if job.segment:
+                annotate(segment=[round(t, 3) for t in job.segment])
+            run_demucs(job)
+            observe_usage(scheduler, job.demucs_model, record)
+        report_progress(job, job.demucs_model, record)
+
+    demucs_stage = scheduler.add(f"{job.song_name}:demucs", "demucs", demucs, deps=[after], group=group, before=before,
+                                 memory=memory_estimate(scheduler, job.demucs_model, lambda: job.demucs_input))
+
+    def merge():
+        merge_bandit_stems(job)
+        add_transcription_stages(scheduler, job, merge_stage, group, before)
+
+    merge_stage = scheduler.add(f"{job.song_name}:merge", "merge", merge, deps=[demucs_stage], group=group, before=before)
+
+
+def segment_job(job, index, start, end):
+    """A SongJob for one segment, working in <output_root>/.segments/<song>/<index>."""
+    seg = SongJob(job.input_path, job.options, partial(_prefixed_log, job.log, f"seg{index:03d}"), job.profiler)
+    seg.song_name = job.song_name
+    seg.output_dir = Path(job.options.output_root) / ".segments" / job.song_name / f"{index:03d}"
+    seg.midi_dir = seg.output_dir / "midi"
+    seg.segment = (start, end)
+    seg.progress = job.progress
+    return seg
+
+
+def split_into_segments(job):
+    """
+    Cuts the Demucs input and the BandIt stems into overlapping segments and
+    fills job.segments. Leaves it empty when the file is short enough (or not
+    a WAV file we can cut), so the song is processed as a whole.
+    """
+    options = job.options
+    try:
+        rate, data = open_wav(job.demucs_input)
+        duration = len(data) / rate
+        data = None
+    except Exception as e:
+        job.log(f"Cannot segment {job.demucs_input.name} ({e}); processing the whole file.")
+        return
+
+    plan = plan_segments(duration, options.segment_seconds, options.segment_overlap)
+    if len(plan) < 2:
+        job.log(f"{job.demucs_input.name} is shorter than one segment; processing the whole file.")
+        return
+
+    job.log(f"Splitting {duration:.1f}s into {len(plan)} segments of {options.segment_seconds}s "
+            f"({options.segment_overlap}s overlap).")
+    inputs_dir = Path(options.output_root) / ".segments" / job.song_name / "inputs"
+    for index, (start, end) in enumerate(plan):
+        seg = segment_job(job, index, start, end)
+        seg.demucs_input = inputs_dir / f"{index:03d}" / job.demucs_input.name
+        sources = [(job.demucs_input, seg.demucs_input)]
+        for name, path in job.bandit_stems.items():
+            seg.bandit_stems[name] = seg.output_dir / "bandit" / path.name
+            sources.append((path, seg.bandit_stems[name]))
+
+        def cut(sources=sources, start=start, end=end):
+            for src, dst in sources:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                src_rate = open_wav(src)[0]
+                write_slice(src, int(round(start * src_rate)), int(round(end * src_rate)), dst)
+
+        # Unchanged segments keep their files, so their digests need not be recomputed
+        seg.midi_dir.mkdir(parents=True, exist_ok=True)
+        build_step(job, f"segment:{index:03d}", [src for src, _ in sources], {"window": [start, end]},
+                   [dst for _, dst in sources], cut)
+        job.segments.append(seg)
+
+
+def stitch_segments(job):
+    """
+    Crossfades the segments' Demucs and merged stems and stitches their MIDI
+    files into the song's folders. Outputs whose parts did not change are kept.
+    """
+    # Paths relative to the segment folder, e.g. htdemucs/music/vocals.wav or merged/vocals.wav
+    stems = [{f.relative_to(seg.output_dir) for f in seg.demucs_stems + stem_files(seg.output_dir / MERGED_DIR)}
+             for seg in job.segments]
+    stitched = 0
+    for rel in sorted(set.intersection(*stems)):
+        parts = [(seg.output_dir / rel, seg.segment[0]) for seg in job.segments]
+        output = job.output_dir / rel
+        output.parent.mkdir(parents=True, exist_ok=True)
+        if build_step(job, f"stitch:{rel.as_posix()}", [p for p, _ in parts], {"starts": [s for _, s in parts]},
+                      [output], lambda: crossfade_segments(parts, output)):
+            stitched += 1
+    job.log(f"Stitched {stitched} stem(s) from {len(job.segments)} segments.")
+
+    remove_stale_midi(job, {name for seg in job.segments for name in midi_names(seg, seg.wav_files)})
+    for name in sorted({f.name for seg in job.segments for f in seg.midi_dir.glob("*.mid")}):
+        # A segment whose stem was silent (and skipped) contributes no notes
+        parts = [(None if name in seg.skipped_silent else seg.midi_dir / name, seg.segment[0], seg.segment[1])
+                 for seg in job.segments]
+        if not all(path is None or path.exists() for path, _, _ in parts):
+            job.log(f"Warning: {name} is missing for some segments; not stitched.")
+            continue
+        output = job.midi_dir / name
+        if build_step(job, f"midi:{name}", [p for p, _, _ in parts if p is not None],
+                      {"windows": [[start, end] for _, start, end in parts]}, [output],
+                      lambda: stitch_midi(parts, output)):
+            job.log(f"Stitched MIDI {name}.")
+
+
+def add_segmented_stages(scheduler, job, after):
+    """
+    Segmented mode: split -> per segment (Demucs -> merge -> transcription
+    per stem) -> stitch. Segments are independent stages, so one segment's
+    transcription overlaps the next segment's separation.
+    """
+    def split():
+        with profile_stage(job, "split", job.demucs_input):
+            split_into_segments(job)
+        if not job.segments:
+            add_whole_file_stages(scheduler, job, split_stage)
+            return
+        for seg in job.segments:
+            add_whole_file_stages(scheduler, seg, split_stage, group=job, before=[stitch_stage])
+
+    def stitch():
+        if job.segments:
+            with profile_stage(job, "stitch"):
+                stitch_segments(job)
+
+    split_stage = scheduler.add(f"{job.song_name}:split", "split", split, deps=[after], group=job)
+    stitch_stage = scheduler.add(f"{job.song_name}:stitch", "merge", stitch, deps=[split_stage], group=job)
+
+
+def add_song_stages(scheduler, job, after=None):
+    """
+    Adds the stage graph of one song: [BandIt ->] Demucs -> merge ->
+    transcription per stem. Returns the BandIt stage (None without BandIt).
+    """
+    prepare = scheduler.add(f"{job.song_name}:prepare", "prepare", lambda: prepare_output_dirs(job),
+                            deps=[after], group=job)
+    last = bandit_stage = prepare
+    if job.options.bandit:
+        def bandit():
+            with profile_stage(job, "bandit", job.input_path) as record:
+                run_bandit(job)
+                observe_usage(scheduler, "bandit", record)
+            report_progress(job, "bandit", record)
+
+        last = bandit_stage = scheduler.add(f"{job.song_name}:bandit", "bandit", bandit, deps=[last], group=job,
+                                            memory=memory_estimate(scheduler, "bandit", lambda: job.input_path))
+
+    if job.options.segment_seconds:
+        add_segmented_stages(scheduler, job, last)
+    else:
+        add_whole_file_stages(scheduler, job, last)
+    return bandit_stage if job.options.bandit else None
+
+
+def song_result(job, stages, cancelled=False):
+    """Builds the ConversionResult of one song from its finished stages."""
+    own = [s for s in stages if s.group is job]
+    if cancelled and any(s.status != DONE for s in own):
+        job.log("\n--- Cancelled ---")
+        return ConversionResult(job.input_path, job.output_dir, False, "Cancelled", cancelled=True)
+    failed_stems = {}
+    error = None
+    for s in own:
+        if s.status == DONE:
+            continue
+        if s.kind == "transcribe":
+            failed_stems[s.name.rsplit(":", 1)[-1]] = s.error
+        elif error is None and s.status == FAILED:
+            error = s.error
+
+    if error is not None:
+        job.log(f"\nError: {error}")
+        return ConversionResult(job.input_path, job.output_dir, False, error, failed_stems)
+    if failed_stems:
+        error = f"MIDI conversion failed for: {', '.join(sorted(failed_stems))}"
+        job.log(f"\nError: {error}")
+        return ConversionResult(job.input_path, job.output_dir, False, error, failed_stems)
+
+    job.log("\n--- All tasks completed successfully ---")
+    return ConversionResult(job.input_path, job.output_dir, True)
+
+
+def scheduler_slots(options):
+    slots = {"bandit": 1, "demucs": 1, "merge": 2, "transcribe": options.transcribe_workers}
+    slots.update(options.stage_slots or {})
+    return slots
+
+
+def build_scheduler(options, cancel=None, log=console_log):
+    slots = scheduler_slots(options)
+    governor = ResourceGovernor(slots, cpus=options.cpu_threads, memory_budget_mb=options.memory_budget_mb,
+                                profiles_path=Path(options.output_root) / PROFILES_FILE, log=log)
+    return StageScheduler(slots=slots, default_slots=2, max_groups=max(1, options.jobs),
+                          timeouts=options.stage_timeouts, cancel=cancel, governor=governor)
+
+
+def memory_estimate(scheduler, model, audio):
+    """Memory estimate for a stage running `model` on the file audio() returns (see governor.py)."""
+    governor = scheduler.governor
+    if governor is None or model is None:
+        return None
+    return lambda: governor.estimate_mb(model, audio_seconds(audio()))
+
+
+def observe_usage(scheduler, model, record):
+    """Feeds the measured peak RSS of a stage's tool back into the governor's memory profiles."""
+    if scheduler.governor is not None and record.children:
+        scheduler.governor.observe(model, record.audio_s, record.peak_rss_children)
+
+
+def work_scale(options, model):
+    # Demucs runs the model once per shift
+    return (options.demucs_shifts or 1) if model in DEMUCS_STEMS else 1
+
+
+def plan_work(job, audio_s=None):
+    """
+    Seconds of audio each model will process for this song, e.g.
+    {"htdemucs": 180, "basic_pitch": 540, "adtof": 180}, from the options
+    alone (outputs that are already up to date are not taken into account).
+    """
+    options = job.options
+    if audio_s is None:
+        audio_s = audio_seconds(job.input_path) or 0.0
+    runs = []
+    stems = []
+    if demucs_needed(job):
+        runs.append(job.demucs_model)
+        two_stems = demucs_settings(job).get("two_stems")
+        stems += [two_stems] if two_stems else DEMUCS_STEMS[job.demucs_model]
+    if options.bandit:
+        runs.append("bandit")
+        try:
+            bandit_stems = [s.lower() for s in load_bandit_model_info(options.bandit.model_dir)["stems"]]
+        except Exception:
+            bandit_stems = []
+        merged = {b.lower() for b, target in options.bandit.merge_targets.items()
+                  if target != "None" and target.lower() in stems}
+        demucs_input = (options.bandit.demucs_input_stem or "music").lower()
+        stems += [s for s in bandit_stems if s not in merged and (s != demucs_input or not demucs_needed(job))]
+    for stem in stems:
+        task = transcription_task(job, Path(f"{stem}.wav")) if stem_selected(job, stem) else None
+        if task is not None:
+            runs.append(task.tool)
+
+    work = {}
+    for model in runs:
+        work[model] = work.get(model, 0.0) + audio_s * work_scale(options, model)
+    return work
+
+
+def report_progress(job, model, record):
+    """Counts the audio a finished stage processed towards its song's progress (see eta.py)."""
+    if job.progress is None or model is None:
+        return
+    notes = record.notes
+    # Only runs where the tool really worked on the audio tell how fast it is
+    measured = not (notes.get("cache") in ("up to date", "adopted", "hit") or notes.get("skipped")
+                    or notes.get("silent") or notes.get("batched"))
+    audio_s = (record.audio_s or 0.0) * work_scale(job.options, model)
+    job.progress.finish(job.song_name, model, audio_s, record.wall_s, measured)
+
+
+def estimate(paths, options=None):
+    """
+    Predicted seconds per file (in input order) and for the whole batch,
+    from the throughput measured on this host (see eta.py).
+    """
+    options = options or ConversionOptions()
+    model = ThroughputModel(Path(options.output_root) / THROUGHPUT_FILE)
+    works = [plan_work(SongJob(p, options, lambda message: None, song_name=name)) for p, name in zip(paths, song_names(paths))]
+    seconds = [model.work_seconds(work) for work in works]
+    return [sum(s.values()) for s in seconds], queue_seconds(seconds, scheduler_slots(options), options.jobs)
+
+
+def convert_file(input_path, options, log=console_log, cancel=None, progress=None, song_name=None):
+    """Runs the whole pipeline for one audio file, into <output_root>/<song_name> (default: its stem)."""
+    names = [song_name] if song_name else None
+    return convert([input_path], options, log, cancel=cancel, progress=progress, names=names)[0]
+
+
+def _stem_log(log, stem, message):
+    log(prefix_message(stem, message))
+
+
+def _prefixed_log(log, prefix, message):
+    log(prefix_message(prefix, message))
+
+
+def plan_song(job):
+    """
+    Works out, from the manifest and the files on disk, which stages of a
+    song would run and why, without running anything. Returns log lines.
+    """
+    options = job.options
+    lines = []
+    manifest = job.manifest
+
+    def report(stage, name, fingerprint, force=False):
+        if not force and manifest.current(name, fingerprint):
+            lines.append(f"{stage}: up to date")
+            return False
+        lines.append(f"{stage}: run ({'forced' if force else manifest.reason(name, fingerprint)})")
+        return True
+
+    # Once a stage runs, everything after it runs too (its inputs will be new)
+    dirty = False
+    if options.bandit:
+        info = load_bandit_model_info(options.bandit.model_dir)
+        params = bandit_cache_params(job, info)
+        fingerprint = separation_fingerprint(job, "bandit", job.input_path, params)
+        if adopt_existing_output(job, "bandit", job.output_dir / "bandit"):
+            lines.append("bandit: existing output will be adopted")
+        else:
+            dirty = report("bandit", "bandit", fingerprint, options.force_separate)
+        if not dirty:
+            collect_bandit_stems(job, job.output_dir / "bandit")
+
+    if options.segment_seconds:
+        lines.append("segmented mode: segments are planned when the song runs")
+        return lines
+    if dirty:
+        lines.append("demucs, merges, MIDI: run (after BandIt)")
+        return lines
+
+    if not demucs_needed(job):
+        lines.append("demucs: skipped (no selected stem comes from it)")
+    else:
+        fingerprint = separation_fingerprint(job, "demucs", job.demucs_input, demucs_params(job))
+        if report("demucs", "demucs", fingerprint, options.force_separate):
+            lines.append("merges, MIDI: run (after Demucs)")
+            return lines
+        job.demucs_stems = stem_files(demucs_output_dir(job))
+
+    plan = merge_plan(job)
+    merged, rebuilt = {}, set()
+    for target_key, (d_file, sources) in plan.items():
+        output = job.output_dir / MERGED_DIR / d_file.name
+        merged[target_key] = output
+        if report(f"merge {target_key}", f"merge:{d_file.stem}", merge_fingerprint(job, d_file, sources)):
+            rebuilt.add(output)
+
+    for stale in stale_merges(job, merged):
+        lines.append(f"merged {stale.name}: remove (merge no longer configured)")
+    wav_files = stems_to_transcribe(job, plan, merged)
+    for name in stale_midi(job, midi_names(job, wav_files)):
+        lines.append(f"MIDI {name[5:]}: remove (stem no longer transcribed)")
+    for wav_file in wav_files:
+        task = transcription_task(job, wav_file)
+        if task is None:
+            continue
+        stage = f"MIDI {task.midi_out.name}"
+        if wav_file in rebuilt or not wav_file.exists():
+            lines.append(f"{stage}: run (after merge)")
+        else:
+            report(stage, f"midi:{task.midi_out.name}", transcription_fingerprint(job, wav_file, task), options.force_midi)
+    return lines
+
+
+def dry_run(paths, options=None, log=console_log):
+    """Logs the plan of every song in `paths` (see plan_song) without converting anything."""
+    options = options or ConversionOptions()
+    for path, name in zip(paths, song_names(paths)):
+        job = SongJob(path, options, lambda message: None, song_name=name)
+        log(f"{job.song_name} ({job.output_dir}):")
+        try:
+            for line in plan_song(job):
+                log(f"    {line}")
+        except Exception as e:
+            log(f"    cannot plan: {e}")
+
+
+def write_profile_report(job, result):
+    if not job.output_dir.exists():
+        return
+    path = job.output_dir / "profile.json"
+    try:
+        job.profiler.write_report(path, job.song_name, {"input": str(job.input_path), "success": result.success})
+    except OSError as e:
+        job.log(f"Could not write {path}: {e}")
+
+
+def add_bandit_batch_stage(scheduler, jobs, throughput, log, waits=()):
+    """
+    Adds the stage that separates `jobs` with one inference.py run (see
+    run_bandit_batch). It gets the bandit timeout once per song, and the
+    memory estimate of its longest input: the model is loaded once and the
+    songs are separated one after another.
+    """
+    profiler = jobs[0].profiler
+
+    def bandit_batch():
+        try:
+            # Shared by several songs, so it is recorded without one (song None)
+            with profiler.stage(None, "bandit-batch", [job.input_path for job in jobs]) as record:
+                separated = run_bandit_batch(jobs, log)
+            if separated:
+                throughput.observe("bandit", sum(audio_seconds(job.input_path) or 0 for job in separated),
+                                   record.wall_s)
+        except Cancelled:
+            raise
+        except Exception as e:
+            log(f"Batch separation skipped: {e}")
+
+    timeout = scheduler.timeouts.get("bandit")
+    longest = lambda: max((job.input_path for job in jobs), key=lambda p: audio_seconds(p) or 0)
+    return scheduler.add(f"bandit-batch:{jobs[0].song_name}", "bandit", bandit_batch,
+                         memory=memory_estimate(scheduler, "bandit", longest),
+                         timeout=timeout * len(jobs) if timeout else None, waits=waits)
+
+
+def convert(paths, options=None, log=console_log, profiler=None, cancel=None, progress=None, names=None):
+    """
+    Converts every file in `paths` and returns one ConversionResult per file,
+    in input order. All songs go through one stage scheduler, so different
+    stages of different songs overlap (options.jobs songs in flight, one
+    Demucs at a time, options.transcribe_workers transcriptions, ...). With
+    several files every log line is prefixed with the song name. Stage
+    timings are collected in `profiler` (a new one if not given).
+    Calling cancel.cancel() (a CancelToken) from another thread stops the
+    running tools and skips the remaining stages. progress(report) receives
+    the predicted progress and remaining time (see eta.ProgressTracker.report)
+    before the first stage and whenever a stage finishes. `names` overrides
+    the output folder names (see song_names).
+    """
+    options = options or ConversionOptions()
+    profiler = profiler or Profiler()
+    paths = [Path(p) for p in paths]
+    names = names or song_names(paths)
+    if len(paths) > 1:
+        jobs = [SongJob(p, options, partial(_prefixed_log, log, name), profiler, name) for p, name in zip(paths, names)]
+    else:
+        jobs = [SongJob(p, options, log, profiler, name) for p, name in zip(paths, names)]
+
+    scheduler = build_scheduler(options, cancel, log)
+    throughput = ThroughputModel(Path(options.output_root) / THROUGHPUT_FILE)
+    tracker = ProgressTracker(throughput, scheduler.slots, max(1, options.jobs), progress)
+    for job in jobs:
+        job.progress = tracker
+        tracker.add_song(job.song_name, plan_work(job))
+    tracker.notify()
+
+    size = 1
+    if options.bandit and options.batch_bandit and options.bandit.model_dir:
+        size = max(1, options.bandit_batch_size)
+    previous = []
+    for start in range(0, len(jobs), size):
+        chunk = jobs[start:start + size]
+        # Each song only waits for its own batch. A batch waits until the songs of the previous
+        # one have taken over their output (a bandit stage too), then runs next to their Demucs.
+        batch = None
+        if len(chunk) > 1:
+            batch = add_bandit_batch_stage(scheduler, chunk, throughput, log, waits=previous)
+        previous = [add_song_stages(scheduler, job, after=batch) for job in chunk]
+    stages = scheduler.run()
+    scheduler.governor.save()
+    for job in jobs:
+        tracker.finish_song(job.song_name)
+    throughput.save()
+
+    cancelled = scheduler.cancel.cancelled
+    results = [song_result(job, stages, cancelled) for job in jobs]
+    if options.profile_report:
+        for job, result in zip(jobs, results):
+            write_profile_report(job, result)
+    return results
@@ -0,0 +1,209 @@
+"""
+Per-stage profiling.
+
+Every pipeline stage runs inside Profiler.stage(), which records:
+
+    wall_s              elapsed time
+    cpu_thread_s        CPU time of the Python thread running the stage
+    cpu_children_s      user + system CPU of the child processes it waited for
+    peak_rss_children   largest peak RSS among those children (bytes)
+    peak_rss_process    high-water mark of this process at the end of the stage
+    audio_s / rtf       seconds of audio processed and wall_s / audio_s
+                        (below 1 is faster than realtime)
+
+Child usage comes from os.wait4 in wait_child(), so it is exact per process
+even when stages run in parallel. Stages may nest (the int16 conversion runs
+inside the BandIt stage); nested records name their parent and only
+top-level records are added up in the totals.
+"""
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+_local = threading.local()
+
+
+def _rss_bytes(ru_maxrss):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return ru_maxrss if sys.platform == "darwin" else ru_maxrss * 1024
+
+
+def audio_seconds(path):
+    """Duration of an audio file in seconds, or None if it cannot be read cheaply."""
+    try:
+        from .audio import open_wav
+        rate, data = open_wav(path)
+        return len(data) / rate
+    except Exception:
+        pass
+    try:
+        import soundfile
+        return soundfile.info(str(path)).duration
+    except Exception:
+        return None
+
+
+class StageRecord:
+    def __init__(self, song, stage, parent=None):
+        self.song = song
+        self.stage = stage
+        self.parent = parent
+        self.status = "ok"
+        self.started = time.time()
+        self.wall_s = 0.0
+        self.cpu_thread_s = 0.0
+        self.cpu_children_s = 0.0
+        self.peak_rss_children = 0
+        self.peak_rss_process = None
+        self.children = 0
+        self.audio_s = None
+        self.notes = {}
+        self._lock = threading.Lock()
+
+    def add_cpu(self, seconds):
+        """Adds CPU time spent for this stage on another thread (e.g. a worker pool)."""
+        with self._lock:
+            self.cpu_thread_s += seconds
+
+    def add_child_usage(self, usage):
+        with self._lock:
+            self.children += 1
+            self.cpu_children_s += usage.ru_utime + usage.ru_stime
+            self.peak_rss_children = max(self.peak_rss_children, _rss_bytes(usage.ru_maxrss))
+
+    def as_dict(self):
+        return {
+            "song": self.song,
+            "stage": self.stage,
+            "parent": self.parent,
+            "status": self.status,
+            "started": round(self.started, 3),
+            "wall_s": round(self.wall_s, 3),
+            "cpu_thread_s": round(self.cpu_thread_s, 3),
+            "cpu_children_s": round(self.cpu_children_s, 3),
+            "children": self.children,
+            "peak_rss_children": self.peak_rss_children,
+            "peak_rss_process": self.peak_rss_process,
+            "audio_s": None if self.audio_s is None else round(self.audio_s, 3),
+            "rtf": round(self.wall_s / self.audio_s, 4) if self.audio_s else None,
+            **self.notes,
+        }
+
+
+def current_record():
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def annotate(**notes):
+    """Attaches extra fields (e.g. cache="hit") to the stage running on this thread."""
+    record = current_record()
+    if record is not None:
+        record.notes.update(notes)
+
+
+def wait_child(process):
+    """Popen.wait() that also charges the child's CPU time and peak RSS to the current stage."""
+    if not hasattr(os, "wait4"):
+        return process.wait()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    record = current_record()
+    if record is not None:
+        record.add_child_usage(usage)
+    return process.returncode
+
+
+class Profiler:
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, song, stage, audio=None):
+        """
+        Profiles the enclosed block as `stage` of `song`. `audio` is the input
+        file (or a list of files) whose duration gives the realtime factor.
+        """
+        parent = current_record()
+        record = StageRecord(song, stage, parent.stage if parent else None)
+        if audio is not None:
+            paths = audio if isinstance(audio, (list, tuple)) else [audio]
+            durations = [audio_seconds(p) for p in paths]
+            if durations and None not in durations:
+                record.audio_s = sum(durations)
+
+        stack = _local.__dict__.setdefault("stack", [])
+        stack.append(record)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield record
+        except BaseException:
+            record.status = "failed"
+            raise
+        finally:
+            record.wall_s = time.perf_counter() - wall_start
+            record.add_cpu(time.thread_time() - cpu_start)
+            if resource is not None:
+                record.peak_rss_process = _rss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+            stack.pop()
+            with self._lock:
+                self.records.append(record)
+
+    def report(self, song, extra=None):
+        """Report dict for one song: its own records plus shared ones (song None, e.g. the BandIt batch)."""
+        with self._lock:
+            records = [r for r in self.records if r.song in (song, None)]
+        records.sort(key=lambda r: r.started)
+
+        totals = {}
+        for r in records:
+            if r.parent is not None:
+                continue
+            kind = r.stage.split(":", 1)[0]
+            t = totals.setdefault(kind, {"count": 0, "wall_s": 0.0, "cpu_children_s": 0.0, "peak_rss_children": 0})
+            t["count"] += 1
+            t["wall_s"] = round(t["wall_s"] + r.wall_s, 3)
+            t["cpu_children_s"] = round(t["cpu_children_s"] + r.cpu_children_s, 3)
+            t["peak_rss_children"] = max(t["peak_rss_children"], r.peak_rss_children)
+
+        return {
+            "song": song,
+            **(extra or {}),
+            "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+            "stages": [r.as_dict() for r in records],
+            "totals": totals,
+        }
+
+    def write_report(self, path, song, extra=None):
+        with open(path, "w") as f:
+            json.dump(self.report(song, extra), f, indent=2)
+
+    def summary(self):
+        """Human-readable table of every record, slowest stage kinds first."""
+        with self._lock:
+            records = list(self.records)
+
+        by_stage = {}
+        for r in records:
+            by_stage.setdefault(r.stage.split(":", 1)[0] if r.parent is None else r.stage, []).append(r)
+
+        lines = [f"{'stage':<16}{'runs':>5}{'wall s':>10}{'child cpu s':>13}{'peak rss MB':>13}{'rtf':>8}"]
+        for name, rs in sorted(by_stage.items(), key=lambda item: -sum(r.wall_s for r in item[1])):
+            wall = sum(r.wall_s for r in rs)
+            audio = sum(r.audio_s for r in rs if r.audio_s)
+            audio_wall = sum(r.wall_s for r in rs if r.audio_s)
+            rtf = f"{audio_wall / audio:.3f}" if audio else "-"
+            peak = max(r.peak_rss_children for r in rs) / 1024 ** 2
+            lines.append(f"{name:<16}{len(rs):>5}{wall:>10.2f}{sum(r.cpu_children_s for r in rs):>13.2f}{peak:>13.1f}{rtf:>8}")
+        return "\n".join(lines)
@@ -0,0 +1,202 @@
+"""
+Cancellation and timeouts for pipeline stages.
+
+Every stage runs on a scheduler thread inside a StageContext, which holds
+the CancelToken of the whole conversion and the stage's deadline (from
+ConversionOptions.stage_timeouts). Child processes are started with
+popen_group(), in their own process group (session on POSIX), so that
+kill_tree() also stops whatever they spawned (Demucs workers, ffmpeg, ...).
+
+While a child runs, stop_on_cancel() kills its tree as soon as the token is
+cancelled or the deadline passes, so the thread blocked on its output
+returns right away and the stage fails with Cancelled or StageTimeout. The
+scheduler then skips everything that depended on it, and never starts
+another stage once the token is cancelled.
+"""
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds between SIGTERM and SIGKILL when stopping a process tree
+KILL_GRACE = 0.5
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    pass
+
+
+class StageTimeout(Exception):
+    pass
+
+
+class CancelToken:
+    """Shared by every stage of a conversion; cancel() may be called from any thread (e.g. a GUI button)."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_id = 0
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled("Cancelled")
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """Calls callback if the token is (or gets) cancelled while the block runs."""
+        with self._lock:
+            key = self._next_id
+            self._next_id += 1
+            self._callbacks[key] = callback
+            already = self._event.is_set()
+        try:
+            if already:
+                callback()
+            yield
+        finally:
+            with self._lock:
+                self._callbacks.pop(key, None)
+
+
+class StageContext:
+    def __init__(self, name, cancel=None, timeout=None, threads=None):
+        self.name = name
+        self.cancel = cancel
+        self.timeout = timeout
+        # Thread budget for the stage's child processes (see governor.py); None = unlimited
+        self.threads = threads
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def check(self):
+        """Raises Cancelled or StageTimeout when the stage should stop."""
+        if self.cancel is not None:
+            self.cancel.check()
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise StageTimeout(f"{self.name} timed out after {self.timeout:g}s")
+
+
+@contextmanager
+def stage_context(name, cancel=None, timeout=None, threads=None):
+    """Runs the enclosed block as stage `name` (used by the scheduler for every stage)."""
+    stack = _local.__dict__.setdefault("stack", [])
+    context = StageContext(name, cancel, timeout, threads)
+    stack.append(context)
+    try:
+        context.check()
+        yield context
+    finally:
+        stack.pop()
+
+
+def current_context():
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def check_cancelled():
+    """Raises Cancelled / StageTimeout when the stage running on this thread should stop."""
+    context = current_context()
+    if context is not None:
+        context.check()
+
+
+def popen_group(cmd, **kwargs):
+    """subprocess.Popen in a new process group, so kill_tree() reaches the child's own children."""
+    if os.name == "nt":
+        kwargs["creationflags"] = kwargs.get("creationflags", 0) | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    return subprocess.Popen(cmd, **kwargs)
+
+
+def _signal_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def kill_tree(process, grace=KILL_GRACE):
+    """
+    Stops a process started with popen_group() and its descendants: SIGTERM,
+    then SIGKILL after `grace` seconds. Does not reap the child (wait_child
+    still collects its resource usage).
+    """
+    if os.name == "nt":
+        subprocess.run(["taskkill", "/T", "/F", "/PID", str(process.pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+    _signal_group(process.pid, signal.SIGTERM)
+    timer = threading.Timer(grace, _signal_group, (process.pid, signal.SIGKILL))
+    timer.daemon = True
+    timer.start()
+
+
+@contextmanager
+def stop_on_cancel(stop):
+    """
+    Calls stop() (e.g. killing a process tree) when the current stage is
+    cancelled or runs past its deadline during the block, and afterwards
+    raises Cancelled / StageTimeout instead of letting the caller treat
+    the interrupted work as an ordinary failure.
+    """
+    context = current_context()
+    if context is None:
+        yield
+        return
+
+    stopped = threading.Event()
+
+    def interrupt():
+        if not stopped.is_set():
+            stopped.set()
+            stop()
+
+    timer = None
+    remaining = context.remaining()
+    if remaining is not None:
+        timer = threading.Timer(max(0.0, remaining), interrupt)
+        timer.daemon = True
+        timer.start()
+    try:
+        if context.cancel is not None:
+            with context.cancel.on_cancel(interrupt):
+                yield
+        else:
+            yield
+    except BaseException:
+        if stopped.is_set():
+            context.check() # report the interruption, not its side effect (e.g. a closed pipe)
+        else:
+            interrupt() # the caller gave up on the work (e.g. a log callback raised)
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if stopped.is_set():
+        context.check()
@@ -0,0 +1,193 @@
+"""
+Dependency-graph scheduler for pipeline stages.
+
+Every stage (BandIt, Demucs, merge, one transcription per stem, ...) is a
+node with dependencies and a kind. Each kind has its own number of slots,
+so e.g. Demucs can work on song N+1 while Basic Pitch transcribes song N's
+stems, without ever running two Demucs at once. Stages belong to a group
+(a song) and at most `max_groups` groups are in flight, which bounds the
+number of half-finished songs on disk.
+
+Stages may add further stages while they run (the merge stage adds one
+transcription stage per stem once the stems are known). A stage added with
+`before=[other]` must finish before `other` starts, but `other` still runs
+if it fails; this lets a collecting stage (e.g. stitching segments) wait
+for stages that do not exist yet when it is added.
+
+Each stage runs inside runner.stage_context() with the timeout of its kind
+(if any) and the scheduler's cancel token. Once the token is cancelled no
+further stage starts; pending stages are skipped and running ones stop as
+soon as their child processes are killed. Ctrl+C cancels the token too:
+the tools run in their own process groups and no longer see it themselves.
+
+With a ResourceGovernor (see governor.py) a stage that has a memory
+estimate only starts while it fits in the memory budget next to the running
+stages, and each stage runs with the thread budget the governor gives it.
+"""
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .runner import CancelToken, stage_context
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Stage:
+    def __init__(self, name, kind, fn, deps=(), group=None, memory=None, timeout=None):
+        self.name = name
+        self.kind = kind
+        self.fn = fn
+        # Seconds before the stage is stopped; None = the timeout of its kind
+        self.timeout = timeout
+        # Callable returning the estimated peak memory (MB) of the stage's tool, asked once its deps are done
+        self.memory = memory
+        self.memory_mb = None
+        self.deferred = False # waited for memory (logged once)
+        self.threads = None
+        self.deps = list(deps)
+        # Stages that must have finished (in any state) before this one starts
+        self.waits = []
+        self.group = group
+        self.status = PENDING
+        self.error = None
+        self.result = None
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, {self.status})"
+
+
+class StageScheduler:
+    def __init__(self, slots=None, default_slots=1, max_groups=None, timeouts=None, cancel=None, governor=None):
+        self.slots = dict(slots or {})
+        self.default_slots = default_slots
+        self.max_groups = max_groups
+        # Seconds a stage of a kind may run (kinds without an entry have no limit)
+        self.timeouts = dict(timeouts or {})
+        self.cancel = cancel or CancelToken()
+        self.governor = governor
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def add(self, name, kind, fn, deps=(), group=None, before=(), memory=None, timeout=None, waits=()):
+        """
+        Adds a stage; safe to call from a running stage. Stages in `before`
+        wait for the new one, which only works while they are still pending;
+        the new one waits for the stages in `waits`. `memory` returns the
+        stage's estimated peak memory in MB (or None). `timeout` replaces
+        the timeout of its kind for this stage.
+        """
+        stage = Stage(name, kind, fn, [d for d in deps if d is not None], group, memory, timeout)
+        stage.waits.extend(w for w in waits if w is not None)
+        with self._lock:
+            self.stages.append(stage)
+            for other in before:
+                other.waits.append(stage)
+        return stage
+
+    def _slots_for(self, kind):
+        return max(1, self.slots.get(kind, self.default_slots))
+
+    def _active_groups(self):
+        """Groups that have started and still have unfinished stages."""
+        unfinished = {s.group for s in self.stages if s.status in (PENDING, RUNNING)}
+        started = {s.group for s in self.stages if s.status != PENDING}
+        return unfinished & started
+
+    def _estimate(self, stage):
+        if stage.memory is not None and stage.memory_mb is None:
+            try:
+                stage.memory_mb = stage.memory() or 0
+            except Exception:
+                stage.memory_mb = 0
+        return stage.memory_mb
+
+    def _pick_ready(self):
+        """Returns the stages that can start now, in the order they were added."""
+        running = {}
+        reserved = [s.memory_mb for s in self.stages if s.status == RUNNING and s.memory_mb]
+        for s in self.stages:
+            if s.status == RUNNING:
+                running[s.kind] = running.get(s.kind, 0) + 1
+        active_groups = self._active_groups()
+
+        ready = []
+        for s in self.stages:
+            if s.status != PENDING:
+                continue
+            if any(d.status in (FAILED, SKIPPED) for d in s.deps):
+                s.status = SKIPPED
+                failed = next(d for d in s.deps if d.status in (FAILED, SKIPPED))
+                s.error = f"skipped because {failed.name} did not complete"
+                continue
+            if any(d.status != DONE for d in s.deps):
+                continue
+            if any(w.status in (PENDING, RUNNING) for w in s.waits):
+                continue
+            if running.get(s.kind, 0) >= self._slots_for(s.kind):
+                continue
+            if self.max_groups and s.group not in active_groups and len(active_groups) >= self.max_groups:
+                continue
+            if self.governor is not None:
+                estimate = self._estimate(s)
+                if not self.governor.admits(estimate, sum(reserved), len(reserved)):
+                    if not s.deferred:
+                        s.deferred = True
+                        self.governor.log(f"{s.name} waits for memory: needs ~{estimate:.0f} MB, "
+                                          f"{sum(reserved):.0f} of {self.governor.memory_budget_mb:.0f} MB in use")
+                    continue
+                if estimate:
+                    reserved.append(estimate)
+            running[s.kind] = running.get(s.kind, 0) + 1
+            active_groups.add(s.group)
+            ready.append(s)
+        return ready
+
+    def _run_stage(self, stage):
+        if self.governor is not None:
+            stage.threads = self.governor.acquire_threads(stage.kind)
+        try:
+            timeout = stage.timeout if stage.timeout is not None else self.timeouts.get(stage.kind)
+            with stage_context(stage.name, self.cancel, timeout, stage.threads):
+                stage.result = stage.fn()
+            stage.status = DONE
+        except Exception as e:
+            stage.error = str(e) or type(e).__name__
+            stage.status = FAILED
+        finally:
+            if self.governor is not None:
+                self.governor.release_threads(stage.threads)
+
+    def run(self):
+        """Runs every stage to completion (or failure) and returns the stage list."""
+        futures = set()
+        # Threads are created lazily; the slots, not the pool size, bound concurrency
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            while True:
+                with self._lock:
+                    if self.cancel.cancelled:
+                        for s in self.stages:
+                            if s.status == PENDING:
+                                s.status = SKIPPED
+                                s.error = "cancelled"
+                    for stage in self._pick_ready():
+                        stage.status = RUNNING
+                        futures.add(pool.submit(self._run_stage, stage))
+                    if not futures and not any(s.status == PENDING for s in self.stages):
+                        break
+                if not futures:
+                    # Nothing running but stages pending: only possible with a cycle
+                    with self._lock:
+                        for s in self.stages:
+                            if s.status == PENDING:
+                                s.status = SKIPPED
+                                s.error = "unsatisfiable dependencies"
+                    break
+                try:
+                    _, futures = wait(futures, return_when=FIRST_COMPLETED)
+                except KeyboardInterrupt:
+                    self.cancel.cancel()
+        return self.stages
@@ -0,0 +1,128 @@
+"""
+Segmented long-audio mode.
+
+A feature-length input is cut into overlapping segments that go through
+Demucs and transcription independently (and therefore concurrently, see
+pipeline.add_segmented_stages). Afterwards the stems are crossfaded back
+together (audio.crossfade_segments) and the per-segment MIDI files are
+stitched here:
+
+* each overlap is split at its midpoint; a note belongs to the segment in
+  which its onset falls before/after that cut, which removes the copies
+  both segments transcribed;
+* a note that runs into the end of its segment is continued by the same
+  pitch in the next segment, so sustained notes are not chopped in two.
+
+midi_agreement() compares two MIDI files note by note, e.g. a segmented
+run against a whole-file run.
+
+pretty_midi comes with basic-pitch and is only imported when needed.
+"""
+import math
+
+# Onset/offset slack (seconds) when matching notes across a boundary
+NOTE_TOLERANCE = 0.05
+
+
+def plan_segments(duration, length, overlap):
+    """
+    Returns [(start, end)] in seconds covering `duration` with windows of
+    `length` seconds that overlap their neighbours by `overlap` seconds.
+    """
+    if overlap < 0 or overlap >= length:
+        raise ValueError("Segment overlap must be at least 0 and shorter than the segment length.")
+    if duration <= length:
+        return [(0.0, duration)]
+    hop = length - overlap
+    count = math.ceil((duration - overlap) / hop)
+    return [(i * hop, min(i * hop + length, duration)) for i in range(count)]
+
+
+def _instrument_key(instrument):
+    return (instrument.program, instrument.is_drum, instrument.name)
+
+
+def stitch_midi(parts, output_file, tolerance=NOTE_TOLERANCE):
+    """
+    Stitches per-segment MIDI files into output_file. `parts` is a list of
+    (midi_path, start, end) in seconds, in order, as given by plan_segments;
+    midi_path may be None for a segment without notes.
+    """
+    import pretty_midi
+
+    # Cut points in the middle of every overlap
+    cuts = [(parts[i][2] + parts[i + 1][1]) / 2 for i in range(len(parts) - 1)]
+
+    # instrument key -> list (per part) of [pitch, start, end, velocity] in absolute time
+    notes = {}
+    for index, (path, offset, _) in enumerate(parts):
+        if path is None:
+            continue
+        midi = pretty_midi.PrettyMIDI(str(path))
+        for instrument in midi.instruments:
+            per_part = notes.setdefault(_instrument_key(instrument), [[] for _ in parts])
+            per_part[index].extend([n.pitch, n.start + offset, n.end + offset, n.velocity]
+                                   for n in instrument.notes)
+
+    result = pretty_midi.PrettyMIDI()
+    for (program, is_drum, name), per_part in notes.items():
+        kept = []
+        for index, part_notes in enumerate(per_part):
+            lo = cuts[index - 1] if index > 0 else -math.inf
+            hi = cuts[index] if index < len(cuts) else math.inf
+            owned = [n for n in part_notes if lo <= n[1] < hi]
+
+            if index + 1 < len(per_part):
+                # Continue notes cut off by the end of this segment with the next segment's copy
+                segment_end = parts[index][2]
+                following = per_part[index + 1]
+                for note in owned:
+                    if note[2] < segment_end - tolerance:
+                        continue
+                    for other in following:
+                        if other[0] == note[0] and other[1] <= note[2] + tolerance and other[2] > note[2]:
+                            note[2] = other[2]
+                            # That copy must not survive as a separate note either
+                            other[1] = -math.inf
+            kept.extend(owned)
+
+        instrument = pretty_midi.Instrument(program=program, is_drum=is_drum, name=name)
+        for pitch, start, end, velocity in sorted(kept, key=lambda n: (n[1], n[0])):
+            instrument.notes.append(pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end))
+        result.instruments.append(instrument)
+
+    result.write(str(output_file))
+
+
+def midi_agreement(reference, candidate, onset_tolerance=NOTE_TOLERANCE):
+    """
+    Matches notes of two MIDI files by pitch and onset (within
+    onset_tolerance seconds, each note used once). Returns a dict with
+    precision, recall and f1 of `candidate` against `reference`.
+    """
+    import pretty_midi
+
+    def load(path):
+        midi = pretty_midi.PrettyMIDI(str(path))
+        return sorted((n.start, n.pitch) for i in midi.instruments for n in i.notes)
+
+    ref_notes, cand_notes = load(reference), load(candidate)
+    unmatched = {}
+    for onset, pitch in ref_notes:
+        unmatched.setdefault(pitch, []).append(onset)
+
+    matched = 0
+    for onset, pitch in cand_notes:
+        onsets = unmatched.get(pitch)
+        if not onsets:
+            continue
+        best = min(range(len(onsets)), key=lambda i: abs(onsets[i] - onset))
+        if abs(onsets[best] - onset) <= onset_tolerance:
+            onsets.pop(best)
+            matched += 1
+
+    precision = matched / len(cand_notes) if cand_notes else 1.0
+    recall = matched / len(ref_notes) if ref_notes else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"reference_notes": len(ref_notes), "candidate_notes": len(cand_notes), "matched": matched,
+            "precision": precision, "recall": recall, "f1": f1}
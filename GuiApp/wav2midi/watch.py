@@ -0,0 +1,330 @@
+"""
+Watch-folder daemon.
+
+Producers drop audio files into a folder; WatchDaemon converts each one
+once it is completely written:
+
+    1. Changes are noticed through inotify on Linux (IN_CLOSE_WRITE and
+       IN_MOVED_TO, via ctypes, no extra package), by polling elsewhere.
+       Files already in the folder at startup are picked up as well.
+    2. A file is ready when its size and mtime have not changed for
+       settle_seconds (a close event alone is not enough, some producers
+       write in several sessions).
+    3. Ready files go into a bounded queue (max_pending) served by `workers`
+       conversion threads. When it is full, files wait in the folder and are
+       admitted as slots free up, so a large drop never starts more than
+       `workers` conversions at a time.
+    4. A worker hashes the file first (off the watching thread, which
+       would otherwise stall on large files). Files whose content was
+       converted successfully before (see the ledger,
+       <output_root>/.watch_ledger.json) or is being converted are skipped,
+       so renamed or re-dropped copies are not converted again. Failures
+       are recorded with their attempt count but do not block the content:
+       dropping the file again (or restarting the daemon) retries it.
+    5. Each content converts into <output_root>/<stem>, unless that folder
+       already belongs to other content (converted earlier or converting
+       right now, e.g. track.wav next to track.mp3): then it gets
+       <stem>-<first 8 hex digits of its hash>. The ledger keeps the folder
+       of every content, so a retry goes to the same place.
+
+stats() (also written to <output_root>/.watch_status.json) reports the
+queue depth and the processing rate over the last RATE_WINDOW seconds.
+"""
+import collections
+import ctypes
+import ctypes.util
+import json
+import os
+import queue
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+
+from .cache import file_digest
+
+WATCH_SUFFIXES = (".wav", ".mp3", ".flac", ".ogg")
+LEDGER_FILE = ".watch_ledger.json"
+STATUS_FILE = ".watch_status.json"
+# Seconds of completions the processing rate is averaged over
+RATE_WINDOW = 600
+
+
+class Inotify:
+    """Minimal inotify binding for one directory (Linux only)."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout):
+        """Names of the files closed after writing or moved in within `timeout` seconds."""
+        names = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return names
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """Fallback for systems without inotify: lists the folder every poll_seconds."""
+
+    def __init__(self, directory, poll_seconds):
+        self.directory = Path(directory)
+        self.poll_seconds = poll_seconds
+        self.seen = {}
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.poll_seconds))
+        names = set()
+        current = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                st = entry.stat()
+                current[entry.name] = (st.st_size, st.st_mtime_ns)
+                if self.seen.get(entry.name) != current[entry.name]:
+                    names.add(entry.name)
+        self.seen = current
+        return names
+
+    def close(self):
+        pass
+
+
+def open_watcher(directory, poll_seconds, log=print):
+    if hasattr(os, "uname") and os.uname().sysname == "Linux":
+        try:
+            return Inotify(directory)
+        except (OSError, AttributeError) as e:
+            log(f"inotify unavailable ({e}); polling every {poll_seconds:g}s.")
+    return Poller(directory, poll_seconds)
+
+
+class WatchDaemon:
+    def __init__(self, directory, convert_one, output_root, workers=1, max_pending=8,
+                 settle_seconds=2.0, poll_seconds=2.0, log=print):
+        """
+        convert_one(path, cancel, song_name) converts one file into
+        <output_root>/<song_name> and returns True when it succeeded (e.g. a
+        wrapper around pipeline.convert_file).
+        """
+        self.directory = Path(directory)
+        self.convert_one = convert_one
+        self.output_root = Path(output_root)
+        self.workers = max(1, workers)
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self.log = log
+
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.lock = threading.Lock()
+        self.candidates = {} # name -> (size, mtime_ns, monotonic time of the last change)
+        self.queued = set() # names in the queue or converting
+        self.converting = {} # hash -> output folder name, of the files being converted
+        self.running = 0
+        self.counts = collections.Counter()
+        self.completed = collections.deque() # (monotonic time, seconds) of recent conversions
+        self.ledger_path = self.output_root / LEDGER_FILE
+        self.ledger = self._load_ledger() # content hash -> {"name", "song_name", "status", "finished"[, "attempts"]}
+        self.started = time.monotonic()
+
+    def _load_ledger(self):
+        try:
+            with open(self.ledger_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_ledger(self):
+        self.output_root.mkdir(parents=True, exist_ok=True)
+        tmp = self.ledger_path.with_name(f"{LEDGER_FILE}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.ledger, f, indent=1)
+        os.replace(tmp, self.ledger_path)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.completed and now - self.completed[0][0] > RATE_WINDOW:
+                self.completed.popleft()
+            recent = list(self.completed)
+            stats = {
+                "waiting": len(self.candidates),
+                "queued": self.queue.qsize(),
+                "running": self.running,
+                "done": self.counts["done"],
+                "failed": self.counts["failed"],
+                "skipped": self.counts["skipped"],
+            }
+        window = min(RATE_WINDOW, now - self.started) if recent else 0
+        stats["files_per_minute"] = round(len(recent) * 60 / window, 2) if window > 0 else 0.0
+        stats["mean_seconds_per_file"] = round(sum(s for _, s in recent) / len(recent), 1) if recent else None
+        return stats
+
+    def _write_status(self):
+        try:
+            self.output_root.mkdir(parents=True, exist_ok=True)
+            with open(self.output_root / STATUS_FILE, "w") as f:
+                json.dump(dict(self.stats(), updated=time.time()), f, indent=1)
+        except OSError:
+            pass
+
+    def _note(self, names):
+        """Records that files changed (or appeared); they become ready once they settle."""
+        now = time.monotonic()
+        for name in names:
+            if not name.lower().endswith(WATCH_SUFFIXES) or name.startswith("."):
+                continue
+            try:
+                st = os.stat(self.directory / name)
+            except FileNotFoundError:
+                self.candidates.pop(name, None)
+                continue
+            self.candidates[name] = (st.st_size, st.st_mtime_ns, now)
+
+    def _admit_ready(self, cancel):
+        """Moves settled files into the conversion queue while it has room."""
+        now = time.monotonic()
+        for name, (size, mtime, changed) in sorted(self.candidates.items(), key=lambda item: item[1][2]):
+            if self.queue.full() or cancel.cancelled:
+                return
+            path = self.directory / name
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self.candidates[name]
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                self.candidates[name] = (st.st_size, st.st_mtime_ns, now) # still being written
+                continue
+            if now - changed < self.settle_seconds or st.st_size == 0:
+                continue
+            with self.lock:
+                if name in self.queued:
+                    continue # rewritten while its previous version waits or converts: admitted afterwards
+                self.queued.add(name)
+
+            del self.candidates[name]
+            self.queue.put(path)
+            self.log(f"Queued {name} ({self.queue.qsize()} waiting for a worker).")
+
+    def _work(self, cancel):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            try:
+                if not cancel.cancelled:
+                    self._convert(path, cancel)
+            finally:
+                with self.lock:
+                    self.queued.discard(path.name)
+
+    def _song_name(self, path, digest):
+        """Output folder name for content `digest` (see the module docstring); called with the lock held."""
+        known = self.ledger.get(digest, {}).get("song_name")
+        if known:
+            return known
+        # Entries written before song_name was recorded used the stem of the file name
+        owners = {d for d, e in self.ledger.items() if e.get("song_name", Path(e["name"]).stem) == path.stem}
+        owners |= {d for d, name in self.converting.items() if name == path.stem}
+        return path.stem if owners <= {digest} else f"{path.stem}-{digest[:8]}"
+
+    def _convert(self, path, cancel):
+        try:
+            digest = file_digest(path)
+        except OSError as e:
+            self.log(f"Skipping {path.name}: {e}")
+            return
+        with self.lock:
+            converted = self.ledger.get(digest, {}).get("status") == "done"
+            if digest in self.converting or converted:
+                self.counts["skipped"] += 1
+                self.log(f"Skipping {path.name}: already {'converted' if converted else 'being converted'}.")
+                return
+            song_name = self._song_name(path, digest)
+            self.converting[digest] = song_name
+            self.running += 1
+        start = time.monotonic()
+        try:
+            success = self.convert_one(path, cancel, song_name)
+        except Exception as e:
+            self.log(f"Error converting {path.name}: {e}")
+            success = False
+        with self.lock:
+            self.running -= 1
+            del self.converting[digest]
+            if cancel.cancelled:
+                return # interrupted: converted again on the next start
+            status = "done" if success else "failed"
+            self.counts[status] += 1
+            self.completed.append((time.monotonic(), time.monotonic() - start))
+            entry = {"name": path.name, "song_name": song_name, "status": status, "finished": time.time()}
+            if not success:
+                entry["attempts"] = self.ledger.get(digest, {}).get("attempts", 0) + 1
+            self.ledger[digest] = entry
+            self._save_ledger()
+        self.log(f"{'Converted' if success else 'FAILED'} {path.name}.")
+
+    def serve(self, cancel, status_seconds=10.0):
+        """Watches the folder until `cancel` (a CancelToken) is cancelled."""
+        self.started = time.monotonic()
+        watcher = open_watcher(self.directory, self.poll_seconds, self.log)
+        threads = [threading.Thread(target=self._work, args=(cancel,), daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        self.log(f"Watching {self.directory} with {type(watcher).__name__.lower()} "
+                 f"({self.workers} worker(s), up to {self.queue.maxsize} queued).")
+
+        self._note(entry.name for entry in os.scandir(self.directory) if entry.is_file())
+        last_status = None
+        next_status = 0
+        try:
+            while not cancel.cancelled:
+                # Wake up in time to admit files as soon as they settle
+                timeout = min(self.poll_seconds, self.settle_seconds / 2) if self.candidates else self.poll_seconds
+                self._note(watcher.wait(timeout))
+                self._admit_ready(cancel)
+                if time.monotonic() >= next_status:
+                    next_status = time.monotonic() + status_seconds
+                    self._write_status()
+                    stats = self.stats()
+                    summary = {k: stats[k] for k in ("waiting", "queued", "running", "done", "failed")}
+                    if summary != last_status:
+                        last_status = summary
+                        self.log("Status: " + ", ".join(f"{k} {v}" for k, v in stats.items()))
+        finally:
+            watcher.close()
+            for _ in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+            self._write_status()
@@ -0,0 +1,306 @@
+"""
+Work queue on a shared directory (e.g. an NFS volume), without a broker.
+
+    <queue>/pending/<job>.<attempt>.json            waiting; claimed oldest first
+    <queue>/running/<job>.<attempt>.<worker>.json   claimed by a worker
+    <queue>/done/<job>.json                         finished, with its result
+    <queue>/failed/<job>.json                       failed max_attempts times
+
+Job ids start with the submission time, so sorting them gives FIFO order.
+A worker claims a job by renaming its file from pending/ to running/; the
+rename is atomic, so exactly one of several workers racing for the same
+file gets it. While the job runs the worker touches the file every third of
+`lease_seconds` (its lease). A job whose file was not touched for longer
+than that belonged to a worker that crashed or lost the volume: reap()
+renames it back to pending/ with the next attempt number, or to failed/
+after max_attempts. A worker that finds its file gone has lost the lease
+and cancels its conversion.
+
+Lease ages are measured against the file server's clock (the mtime of a
+file the worker just touched), not the local one, so hosts do not need
+synchronised clocks. Every host must mount the queue, the inputs and the
+output root at the same paths.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+DEFAULT_LEASE = 120.0
+DEFAULT_MAX_ATTEMPTS = 3
+QUEUE_DIRS = ["pending", "running", "done", "failed", "tmp", "clock"]
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def default_worker_id():
+    # Dots separate the parts of a running/ file name
+    return f"{socket.gethostname()}-{os.getpid()}".replace(".", "_")
+
+
+def _parse_name(name):
+    """'<job>.<attempt>[.<worker>].json' -> (job, attempt, worker or None)."""
+    parts = name[:-len(".json")].split(".")
+    return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else None
+
+
+def _write_json(path, data, tmp_dir):
+    tmp = Path(tmp_dir) / f"{uuid.uuid4().hex}.json"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1, default=str)
+    os.replace(tmp, path)
+
+
+class Lease:
+    """A claimed job. renew() keeps it; a lost lease raises LeaseLost."""
+
+    def __init__(self, queue, path, job, attempt, worker):
+        self.queue = queue
+        self.path = path
+        self.job = job
+        self.attempt = attempt
+        self.worker = worker
+
+    @property
+    def job_id(self):
+        return self.job["id"]
+
+    def renew(self):
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            raise LeaseLost(f"Lease on {self.job_id} expired and the job was re-queued")
+
+    @contextmanager
+    def keep_alive(self, on_lost):
+        """Renews the lease in the background during the block; calls on_lost() once if it is lost."""
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.queue.lease_seconds / 3):
+                try:
+                    self.renew()
+                except LeaseLost:
+                    on_lost()
+                    return
+                except OSError:
+                    pass # the volume hiccuped; try again before the lease runs out
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _finish(self, folder, result):
+        record = dict(self.job, attempt=self.attempt, worker=self.worker, finished=time.time(), result=result)
+        _write_json(self.queue.root / folder / f"{self.job_id}.json", record, self.queue.root / "tmp")
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass # reaped meanwhile; another worker will find the outputs up to date
+
+    def complete(self, result):
+        self._finish("done", result)
+
+    def fail(self, result):
+        """Re-queues the job for another attempt, or moves it to failed/ after max_attempts."""
+        if self.attempt >= self.queue.max_attempts:
+            self._finish("failed", result)
+        else:
+            self.requeue(self.attempt + 1)
+
+    def release(self):
+        """Puts the job back unchanged (e.g. the worker is shutting down)."""
+        self.requeue(self.attempt)
+
+    def requeue(self, attempt):
+        try:
+            os.rename(self.path, self.queue.root / "pending" / f"{self.job_id}.{attempt}.json")
+        except FileNotFoundError:
+            pass
+
+
+class WorkQueue:
+    def __init__(self, root, lease_seconds=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.root = Path(root)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        for name in QUEUE_DIRS:
+            (self.root / name).mkdir(parents=True, exist_ok=True)
+
+    def _list(self, folder):
+        try:
+            return sorted(n for n in os.listdir(self.root / folder) if n.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def submit(self, input_path, args=None, song_name=None):
+        """
+        Adds a job converting input_path; `args` are settings for the worker
+        (see wav2midi_cli.py) and `song_name` its output folder name.
+        """
+        job_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        job = {"id": job_id, "input": str(Path(input_path).resolve()), "args": args or {},
+               "submitted": time.time(), "submitted_by": default_worker_id()}
+        if song_name:
+            job["song_name"] = song_name
+        _write_json(self.root / "pending" / f"{job_id}.1.json", job, self.root / "tmp")
+        return job_id
+
+    def now(self, worker):
+        """Current time on the file server: the mtime of a file touched just now."""
+        clock = self.root / "clock" / worker
+        clock.touch()
+        return os.stat(clock).st_mtime
+
+    def claim(self, worker):
+        """Returns a Lease on the oldest pending job, or None when there is none."""
+        for name in self._list("pending"):
+            job_id, attempt, _ = _parse_name(name)
+            path = self.root / "running" / f"{job_id}.{attempt}.{worker}.json"
+            try:
+                os.rename(self.root / "pending" / name, path)
+            except FileNotFoundError:
+                continue # another worker was faster
+            try:
+                os.utime(path) # the lease starts now, not when the job was submitted
+                with open(path) as f:
+                    job = json.load(f)
+            except FileNotFoundError:
+                continue # reaped before the lease started
+            return Lease(self, path, job, attempt, worker)
+        return None
+
+    def reap(self, worker):
+        """Re-queues (or fails) jobs whose lease expired. Returns their ids."""
+        now = self.now(worker)
+        reaped = []
+        for name in self._list("running"):
+            path = self.root / "running" / name
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - max(st.st_mtime, st.st_ctime) <= self.lease_seconds:
+                continue
+            job_id, attempt, owner = _parse_name(name)
+            if attempt >= self.max_attempts:
+                target = self.root / "failed" / f"{job_id}.json"
+            else:
+                target = self.root / "pending" / f"{job_id}.{attempt + 1}.json"
+            try:
+                os.rename(path, target)
+            except FileNotFoundError:
+                continue # finished or reaped by someone else
+            if target.parent.name == "failed":
+                with open(target) as f:
+                    job = json.load(f)
+                job.update(attempt=attempt, worker=owner, finished=now,
+                           result={"success": False, "error": f"Lease expired {attempt} time(s)"})
+                _write_json(target, job, self.root / "tmp")
+            reaped.append(job_id)
+        return reaped
+
+    def jobs(self, folder):
+        """Job dicts in one folder ("pending", "running", ...), oldest first."""
+        jobs = []
+        for name in self._list(folder):
+            try:
+                with open(self.root / folder / name) as f:
+                    jobs.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue # claimed or finished meanwhile
+        return jobs
+
+    def active_inputs(self):
+        """{resolved input path: job id} of the pending and running jobs."""
+        return {job["input"]: job["id"] for folder in ("pending", "running") for job in self.jobs(folder)}
+
+    def status(self):
+        """Counts per folder and the running jobs as (job, attempt, worker, seconds since the last heartbeat)."""
+        now = time.time()
+        running = []
+        for name in self._list("running"):
+            job_id, attempt, worker = _parse_name(name)
+            try:
+                age = now - os.stat(self.root / "running" / name).st_mtime
+            except FileNotFoundError:
+                continue
+            running.append((job_id, attempt, worker, age))
+        counts = {folder: len(self._list(folder)) for folder in ["pending", "running", "done", "failed"]}
+        return counts, running
+
+
+class QueueWorker:
+    """
+    Claims jobs one at a time and runs them with run(job, cancel), which
+    returns a result dict with at least "success" (and "cancelled" when
+    `cancel` stopped it). Start several workers, on one or many hosts,
+    to scale out.
+    """
+
+    def __init__(self, queue, run, worker=None, poll_seconds=2.0, idle_exit=None, log=print):
+        self.queue = queue
+        self.run = run
+        self.worker = worker or default_worker_id()
+        self.poll_seconds = poll_seconds
+        self.idle_exit = idle_exit
+        self.log = log
+
+    def serve(self, cancel):
+        """Runs jobs until `cancel` (a CancelToken) is cancelled or the queue was idle for idle_exit seconds."""
+        from .runner import CancelToken
+
+        processed = 0
+        idle_since = time.monotonic()
+        while not cancel.cancelled:
+            for job_id in self.queue.reap(self.worker):
+                self.log(f"Lease on {job_id} expired; re-queued.")
+
+            lease = self.queue.claim(self.worker)
+            if lease is None:
+                if self.idle_exit is not None and time.monotonic() - idle_since >= self.idle_exit:
+                    break
+                time.sleep(self.poll_seconds)
+                continue
+
+            self.log(f"Claimed {lease.job_id} (attempt {lease.attempt}): {lease.job['input']}")
+            token = CancelToken()
+            lost = threading.Event()
+
+            def on_lost():
+                lost.set()
+                self.log(f"Lost the lease on {lease.job_id}; stopping it.")
+                token.cancel()
+
+            with cancel.on_cancel(token.cancel), lease.keep_alive(on_lost):
+                try:
+                    result = self.run(lease.job, token)
+                except Exception as e:
+                    result = {"success": False, "error": str(e)}
+
+            if lost.is_set():
+                pass # another worker owns the job now
+            elif result.get("cancelled"):
+                lease.release()
+                self.log(f"Stopped; {lease.job_id} was put back in the queue.")
+                break
+            elif result.get("success"):
+                lease.complete(result)
+                processed += 1
+                self.log(f"Finished {lease.job_id}.")
+            else:
+                retry = lease.attempt < self.queue.max_attempts
+                lease.fail(result)
+                self.log(f"Failed {lease.job_id}: {result.get('error')}" + ("; re-queued." if retry else ""))
+            idle_since = time.monotonic()
+        return processed
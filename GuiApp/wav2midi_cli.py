@@ -0,0 +1,548 @@
+"""
+wav2midi batch CLI.
+
+Converts many audio files without a display, e.g.
+
+    python GuiApp/wav2midi_cli.py songs/*.wav -j 4 --bandit BanditPlus
+
+Sub-commands:
+
+    python GuiApp/wav2midi_cli.py serve     # warm model server
+    python GuiApp/wav2midi_cli.py compare reference.mid candidate.mid
+    python GuiApp/wav2midi_cli.py export-wav outputs/song  # FLAC stems -> WAV
+    python GuiApp/wav2midi_cli.py submit /shared/queue songs/*.wav -o /shared/outputs
+    python GuiApp/wav2midi_cli.py worker /shared/queue     # one or more per host
+    python GuiApp/wav2midi_cli.py queue-status /shared/queue
+    python GuiApp/wav2midi_cli.py watch incoming/ -j 2   # convert files dropped into a folder
+
+Run it from the project root, like the GUI, so that outputs/, GuiApp/bandit
+and Music-Source-Separation-Training resolve the same way.
+"""
+import argparse
+import json
+import signal
+import sys
+import threading
+from pathlib import Path
+
+from wav2midi.pipeline import (
+    BanditSettings,
+    ConversionOptions,
+    console_log,
+    convert,
+    convert_file,
+    dry_run,
+    estimate,
+    load_bandit_model_info,
+    unique_song_name,
+)
+from wav2midi.audio import stem_files, transcode
+from wav2midi.models import DEMUCS_OUTPUT_CHOICES, MERGE_TARGET_CHOICES, default_merge_target, scan_bandit_models
+from wav2midi.eta import format_seconds
+from wav2midi.profiling import Profiler
+from wav2midi.segments import NOTE_TOLERANCE, midi_agreement
+from wav2midi.model_server import ModelServer, default_address, server_key
+from wav2midi.runner import CancelToken
+from wav2midi.watch import WatchDaemon
+from wav2midi.workqueue import DEFAULT_LEASE, DEFAULT_MAX_ATTEMPTS, QueueWorker, WorkQueue
+
+
+def parse_merge(values):
+    merges = {}
+    for value in values:
+        stem, sep, target = value.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"--merge expects STEM=TARGET, got '{value}'")
+        target = target.capitalize()
+        if target not in MERGE_TARGET_CHOICES:
+            raise argparse.ArgumentTypeError(f"Unknown merge target '{target}'. Choose from {MERGE_TARGET_CHOICES}")
+        merges[stem] = target
+    return merges
+
+
+def parse_stems(value):
+    stems = [s.strip().lower() for s in value.split(",") if s.strip()]
+    if not stems:
+        raise argparse.ArgumentTypeError("--stems expects a comma-separated list, e.g. drums,bass")
+    return stems
+
+
+def order_inputs(inputs, options, order, show=False):
+    """Returns the inputs in `order` ("input" or "shortest"); with show, prints the predicted times."""
+    inputs = list(inputs)
+    if order == "input" and not show:
+        return inputs
+    seconds, total = estimate(inputs, options)
+    predicted = list(zip(inputs, seconds))
+    if order == "shortest":
+        predicted.sort(key=lambda item: item[1])
+    if show:
+        for path, s in predicted:
+            print(f"    {format_seconds(s):>8}  {path}")
+        print(f"Estimated time: {format_seconds(total)} for {len(inputs)} file(s) "
+              f"(outputs that are up to date take less).")
+    return [path for path, _ in predicted]
+
+
+def progress_printer(step=0.1):
+    """progress callback for convert(): prints a line every `step` of the work and whenever a file is done."""
+    lock = threading.Lock()
+    last = {"bucket": 0, "done": 0}
+
+    def show(report):
+        with lock:
+            bucket = int(report["fraction"] / step)
+            if bucket <= last["bucket"] and report["done"] <= last["done"]:
+                return
+            last.update(bucket=max(bucket, last["bucket"]), done=max(report["done"], last["done"]))
+            console_log(f"Progress: {report['fraction']:.0%} ({report['done']}/{report['total']} file(s)), "
+                        f"about {format_seconds(report['remaining_s'])} left")
+
+    return show
+
+
+def parse_slots(values):
+    slots = {}
+    for value in values:
+        kind, sep, count = value.partition("=")
+        if not sep or not count.isdigit():
+            raise SystemExit(f"--slots expects KIND=N, got '{value}'")
+        slots[kind] = int(count)
+    return slots
+
+
+def parse_timeouts(values):
+    timeouts = {}
+    for value in values:
+        kind, sep, seconds = value.partition("=")
+        try:
+            timeouts[kind] = float(seconds)
+        except ValueError:
+            sep = ""
+        if not sep or timeouts[kind] <= 0:
+            raise SystemExit(f"--timeout expects KIND=SECONDS, got '{value}'")
+    return timeouts
+
+
+def build_parser(prog="wav2midi", queue=False, inputs=True):
+    parser = argparse.ArgumentParser(prog=prog, description="Convert audio files to per-stem MIDI.")
+    if queue:
+        parser.add_argument("queue", type=Path, help="Queue folder on the shared volume")
+    if inputs:
+        parser.add_argument("inputs", nargs="+", type=Path, help="Audio files to convert")
+    parser.add_argument("-o", "--output-root", type=Path, default=Path("outputs"), help="Output root (default: outputs)")
+    parser.add_argument("-j", "--jobs", type=int, default=2,
+                        help="Number of songs in flight; their stages overlap, e.g. Demucs on one song "
+                             "while another is transcribed (default: 2)")
+    parser.add_argument("--slots", action="append", default=[], metavar="KIND=N",
+                        help="Concurrent stages per kind (bandit, demucs, merge, transcribe), e.g. demucs=2")
+    parser.add_argument("--timeout", action="append", default=[], metavar="KIND=SECONDS",
+                        help="Kill a stage of this kind (bandit, demucs, transcribe, ...) and its processes "
+                             "when it runs longer, e.g. transcribe=600")
+    parser.add_argument("--transcribe-workers", type=int, default=2,
+                        help="basic-pitch/adtof processes run at the same time across all songs (the scheduler's "
+                             "transcribe slots, same as --slots transcribe=N; default: 2)")
+    parser.add_argument("--model-server", nargs="?", const=default_address(), default=None, metavar="ADDRESS",
+                        help="Use a running warm model server (default address when no value is given); "
+                             "falls back to subprocesses when it is not reachable")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Run Demucs, basic-pitch and ADTOF in this process and pass stems between them in "
+                             "memory (needs their Python packages; falls back to the tools otherwise)")
+    parser.add_argument("--cpu-threads", type=int, default=None, metavar="N",
+                        help="Cores shared out among the running tools through OMP_NUM_THREADS etc. "
+                             "(default: all; 0 = leave their thread pools alone)")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="Start a tool only while the estimated memory of the running ones plus its own "
+                             "fits in this budget (default: 80%% of available memory; 0 = no limit)")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the separation cache")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Separation cache folder (default: <output-root>/.cache)")
+    parser.add_argument("--cache-size", type=float, default=20, metavar="GB",
+                        help="Separation cache budget; least recently used entries are evicted (default: 20)")
+    parser.add_argument("--six-stems", action="store_true", help="Use htdemucs_6s (adds Guitar/Piano)")
+    parser.add_argument("--stems", type=parse_stems, default=None, metavar="STEM[,STEM...]",
+                        help="Only transcribe these stems (Demucs or BandIt names, e.g. drums or drums,bass); "
+                             "a single Demucs stem runs Demucs with --two-stems")
+    parser.add_argument("--force-separate", action="store_true", help="Re-run all separations")
+    parser.add_argument("--force-midi", action="store_true", help="Re-run MIDI conversion")
+    parser.add_argument("--prepare-stems", action="store_true",
+                        help="Resample/downmix each stem once to what its transcriber expects (22.05 kHz mono "
+                             "for basic-pitch) and keep it in <song>/prepared")
+    parser.add_argument("--stem-format", choices=["wav", "flac"], default="wav",
+                        help="Store separated and merged stems as WAV (default) or FLAC, which takes about half "
+                             "the space; 'export-wav' writes WAV copies on demand")
+    parser.add_argument("--order", choices=["input", "shortest"], default="input",
+                        help="Order the files are started in: as given (default) or shortest predicted "
+                             "conversion time first, from the throughput measured on this host")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only print which stages would run for each song (from its manifest.json) and why")
+    parser.add_argument("--segment", type=float, default=None, metavar="SECONDS",
+                        help="Segmented mode for long inputs: separate and transcribe overlapping segments "
+                             "of this length in parallel, then stitch stems and MIDI")
+    parser.add_argument("--segment-overlap", type=float, default=5.0, metavar="SECONDS",
+                        help="Overlap between segments, crossfaded when stitching (default: 5)")
+    parser.add_argument("--silent-stems", choices=["empty", "skip", "transcribe"], default="empty",
+                        help="What to do with stems below the silence thresholds: write an empty MIDI (default), "
+                             "write nothing, or transcribe them anyway")
+    parser.add_argument("--silence-peak-db", type=float, default=-50.0, metavar="DB",
+                        help="Stems whose peak level is below this (dBFS) are silent (default: -50)")
+    parser.add_argument("--silence-rms-db", type=float, default=-65.0, metavar="DB",
+                        help="Stems whose RMS level is below this (dBFS) are silent (default: -65)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print a per-stage timing summary at the end (every song also gets a profile.json)")
+
+    demucs = parser.add_argument_group("Demucs")
+    demucs.add_argument("--shifts", type=int, default=None, metavar="N",
+                        help="Random shifts averaged per separation; better quality, N times slower (Demucs default: 1)")
+    demucs.add_argument("--overlap", type=float, default=None,
+                        help="Overlap between Demucs' windows (Demucs default: 0.25)")
+    demucs.add_argument("--demucs-segment", type=int, default=None, metavar="SECONDS",
+                        help="Demucs window length; smaller uses less memory (default: the model's)")
+    demucs.add_argument("--demucs-output", choices=DEMUCS_OUTPUT_CHOICES, default="int16",
+                        help="Sample format of the Demucs stems (default: int16)")
+
+    bandit = parser.add_argument_group("BandIt")
+    bandit.add_argument("--bandit", metavar="MODEL", help="BandIt model name under GuiApp/bandit, or a model directory")
+    bandit.add_argument("--demucs-input-stem", default=None, help="BandIt stem fed to Demucs (default: music)")
+    bandit.add_argument("--keep-float-stems", action="store_true",
+                        help="Pass BandIt's float stems to Demucs as-is instead of converting them to 16-bit")
+    bandit.add_argument("--merge", action="append", default=[], metavar="STEM=TARGET",
+                        help="Merge a BandIt stem into a Demucs stem, e.g. speech=Vocals. "
+                             "Without any --merge the GUI defaults are used.")
+    bandit.add_argument("--bandit-batch-size", type=int, default=4, metavar="N",
+                        help="Songs separated by one BandIt run (one model load). A song's Demucs waits for its "
+                             "whole batch, so smaller batches start Demucs sooner and larger ones load the model "
+                             "less often. The batch gets N times the bandit --timeout and the memory estimate of "
+                             "its longest song; 1 runs BandIt per song (default: %(default)s)")
+    return parser
+
+
+def build_bandit_settings(args):
+    if not args.bandit:
+        return None
+
+    model_dir = Path(args.bandit)
+    if not model_dir.is_dir():
+        models = scan_bandit_models()
+        if args.bandit not in models:
+            raise SystemExit(f"BandIt model '{args.bandit}' not found. Available: {sorted(models)}")
+        model_dir = models[args.bandit]
+
+    stems = load_bandit_model_info(model_dir)["stems"]
+    if args.merge:
+        merge_targets = parse_merge(args.merge)
+    else:
+        merge_targets = {stem: default_merge_target(stem) for stem in stems}
+
+    demucs_input_stem = args.demucs_input_stem
+    if demucs_input_stem is None:
+        demucs_input_stem = "music" if "music" in stems or not stems else stems[0]
+
+    return BanditSettings(model_dir=model_dir, demucs_input_stem=demucs_input_stem, merge_targets=merge_targets)
+
+
+def build_options(args):
+    return ConversionOptions(
+        output_root=args.output_root,
+        use_6_stems=args.six_stems,
+        stems=args.stems,
+        force_separate=args.force_separate,
+        force_midi=args.force_midi,
+        bandit=build_bandit_settings(args),
+        jobs=args.jobs,
+        transcribe_workers=args.transcribe_workers,
+        stage_slots=parse_slots(args.slots),
+        stage_timeouts=parse_timeouts(args.timeout),
+        cpu_threads=args.cpu_threads,
+        memory_budget_mb=args.memory_budget,
+        prepare_stems=args.prepare_stems,
+        stem_format=args.stem_format,
+        model_server=args.model_server,
+        in_process=args.in_process,
+        use_cache=not args.no_cache,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=int(args.cache_size * 1024 ** 3),
+        keep_float_stems=args.keep_float_stems,
+        bandit_batch_size=args.bandit_batch_size,
+        demucs_shifts=args.shifts,
+        demucs_overlap=args.overlap,
+        demucs_segment=args.demucs_segment,
+        demucs_output=args.demucs_output,
+        segment_seconds=args.segment,
+        segment_overlap=args.segment_overlap,
+        silent_stems=args.silent_stems,
+        silence_peak_db=args.silence_peak_db,
+        silence_rms_db=args.silence_rms_db,
+    )
+
+
+def serve(argv):
+    parser = argparse.ArgumentParser(prog="wav2midi serve", description="Keep models loaded and run jobs for the pipeline.")
+    parser.add_argument("--address", default=default_address(), help="Unix socket path or host:port")
+    parser.add_argument("--max-models", type=int, default=2, help="Models kept resident (LRU)")
+    parser.add_argument("--idle-timeout", type=float, default=600, help="Exit after this many idle seconds (0 = never)")
+    args = parser.parse_args(argv)
+
+    try:
+        server_key()
+    except Exception as e:
+        raise SystemExit(f"Model server not started: {e}")
+    ModelServer(args.address, args.max_models, args.idle_timeout).serve_forever()
+    return 0
+
+
+def compare(argv):
+    parser = argparse.ArgumentParser(prog="wav2midi compare",
+                                     description="Note agreement of a MIDI file with a reference (e.g. segmented vs whole-file run).")
+    parser.add_argument("reference", type=Path)
+    parser.add_argument("candidate", type=Path)
+    parser.add_argument("--onset-tolerance", type=float, default=NOTE_TOLERANCE, help="Seconds (default: %(default)s)")
+    parser.add_argument("--min-f1", type=float, default=None, help="Exit with 1 when the F1 score is below this")
+    args = parser.parse_args(argv)
+
+    result = midi_agreement(args.reference, args.candidate, args.onset_tolerance)
+    print(f"reference notes: {result['reference_notes']}, candidate notes: {result['candidate_notes']}, "
+          f"matched: {result['matched']}")
+    print(f"precision {result['precision']:.3f}  recall {result['recall']:.3f}  f1 {result['f1']:.3f}")
+    if args.min_f1 is not None and result["f1"] < args.min_f1:
+        return 1
+    return 0
+
+
+def export_wav(argv):
+    parser = argparse.ArgumentParser(prog="wav2midi export-wav",
+                                     description="Write WAV copies of FLAC stems (see --stem-format flac).")
+    parser.add_argument("paths", nargs="+", type=Path, help="FLAC files or folders to search (e.g. outputs/<song>)")
+    parser.add_argument("-o", "--output-dir", type=Path, default=None,
+                        help="Write the WAV files here, keeping the folder layout (default: next to each FLAC file)")
+    args = parser.parse_args(argv)
+
+    exported = 0
+    for path in args.paths:
+        if path.is_dir():
+            files = [(f, f.relative_to(path)) for f in stem_files(path, recursive=True, suffixes=(".flac",))]
+        else:
+            files = [(path, Path(path.name))]
+        for flac, rel in files:
+            wav = (args.output_dir / rel if args.output_dir else flac).with_suffix(".wav")
+            wav.parent.mkdir(parents=True, exist_ok=True)
+            transcode(flac, wav)
+            print(wav)
+            exported += 1
+    print(f"{exported} file(s) exported.")
+    return 0
+
+
+# Options that only matter to the submitting process
+_LOCAL_ONLY = {"queue", "inputs", "jobs", "dry_run", "profile", "order"}
+
+
+def submit(argv):
+    parser = build_parser(prog="wav2midi submit", queue=True)
+    parser.description = "Queue audio files for 'worker' processes (the conversion options are stored with each job)."
+    args = parser.parse_args(argv)
+
+    missing = [p for p in args.inputs if not p.exists()]
+    if missing:
+        raise SystemExit(f"Input file(s) not found: {', '.join(map(str, missing))}")
+
+    # Paths are stored absolute: every host mounts the shared volume at the same place
+    args.output_root = args.output_root.resolve()
+    if args.cache_dir:
+        args.cache_dir = args.cache_dir.resolve()
+    if args.bandit and Path(args.bandit).is_dir():
+        args.bandit = str(Path(args.bandit).resolve())
+    settings = {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items() if k not in _LOCAL_ONLY}
+
+    queue = WorkQueue(args.queue)
+    # One job per input: a second one would write to the same output folder at the same time
+    active = queue.active_inputs()
+    queued = 0
+    # Job ids sort in submission order, so workers claim the shortest jobs first
+    for path in order_inputs(args.inputs, build_options(args), args.order):
+        resolved = str(path.resolve())
+        if resolved in active:
+            print(f"{active[resolved]}  {path} (already queued)")
+            continue
+        # Jobs from other submissions may share the stem, so the folder name always carries the path hash
+        active[resolved] = queue.submit(path, settings, unique_song_name(path))
+        print(f"{active[resolved]}  {path}")
+        queued += 1
+    print(f"{queued} job(s) queued in {args.queue}.")
+    return 0
+
+
+def job_options(job):
+    """ConversionOptions for a queued job: the CLI defaults overridden by the settings it was submitted with."""
+    values = vars(build_parser().parse_args([job["input"]]))
+    values.update(job.get("args", {}))
+    args = argparse.Namespace(**values)
+    args.output_root = Path(args.output_root)
+    args.cache_dir = Path(args.cache_dir) if args.cache_dir else None
+    return build_options(args)
+
+
+def run_job(job, cancel):
+    # Jobs submitted before song_name was stored get the same name
+    name = job.get("song_name") or unique_song_name(job["input"])
+    log = lambda message: console_log(f"[{name}] {message}")
+    try:
+        options = job_options(job)
+    except SystemExit as e: # e.g. the BandIt model is not installed on this host
+        return {"success": False, "error": str(e)}
+    result = convert_file(Path(job["input"]), options, log, cancel=cancel, song_name=name)
+    return {
+        "success": result.success and not result.cancelled,
+        "cancelled": result.cancelled,
+        "error": result.error,
+        "failed_stems": result.failed_stems,
+        "output_dir": str(result.output_dir),
+    }
+
+
+def worker(argv):
+    parser = argparse.ArgumentParser(prog="wav2midi worker",
+                                     description="Run queued conversions (see 'submit'); start one or more per host.")
+    parser.add_argument("queue", type=Path, help="Queue folder on the shared volume")
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE, metavar="SECONDS",
+                        help="A job whose worker has not renewed its lease for this long is re-queued "
+                             "(default: %(default)s)")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="Attempts per job before it is moved to failed/ (default: %(default)s)")
+    parser.add_argument("--poll", type=float, default=2.0, metavar="SECONDS",
+                        help="Wait between looks at an empty queue (default: %(default)s)")
+    parser.add_argument("--idle-exit", type=float, default=None, metavar="SECONDS",
+                        help="Exit once the queue has been empty this long (default: run until stopped)")
+    parser.add_argument("--worker-id", default=None, help="Name shown in queue-status (default: host-pid)")
+    args = parser.parse_args(argv)
+
+    cancel = CancelToken()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: cancel.cancel())
+
+    queue = WorkQueue(args.queue, lease_seconds=args.lease, max_attempts=args.max_attempts)
+    worker = QueueWorker(queue, run_job, args.worker_id, poll_seconds=args.poll, idle_exit=args.idle_exit,
+                         log=console_log)
+    processed = worker.serve(cancel)
+    print(f"{processed} job(s) converted by {worker.worker}.")
+    return 130 if cancel.cancelled else 0
+
+
+def queue_status(argv):
+    parser = argparse.ArgumentParser(prog="wav2midi queue-status", description="Show the jobs of a work queue.")
+    parser.add_argument("queue", type=Path)
+    args = parser.parse_args(argv)
+
+    queue = WorkQueue(args.queue)
+    counts, running = queue.status()
+    print("  ".join(f"{folder}: {count}" for folder, count in counts.items()))
+    for job_id, attempt, worker_id, age in running:
+        print(f"running {job_id} (attempt {attempt}) on {worker_id}, last heartbeat {age:.0f}s ago")
+
+    # Each job with its own settings and the throughput measured on this host; running jobs count in full
+    remaining = 0.0
+    for job in queue.jobs("pending") + queue.jobs("running"):
+        try:
+            remaining += estimate([job["input"]], job_options(job))[0][0]
+        except (Exception, SystemExit):
+            pass
+    if remaining:
+        workers = max(1, len({worker_id for _, _, worker_id, _ in running}))
+        print(f"estimated {format_seconds(remaining)} of work left, "
+              f"about {format_seconds(remaining / workers)} with {workers} worker(s)")
+    for failed in sorted((args.queue / "failed").glob("*.json")):
+        job = json.loads(failed.read_text())
+        print(f"failed  {job['id']} {job['input']}: {job.get('result', {}).get('error')}")
+    return 0
+
+
+def watch(argv):
+    parser = build_parser(prog="wav2midi watch", inputs=False)
+    parser.description = "Convert every audio file dropped into a folder, once it is completely written."
+    parser.add_argument("folder", type=Path, help="Folder to watch")
+    group = parser.add_argument_group("Watch")
+    group.add_argument("--max-pending", type=int, default=8,
+                       help="Ready files queued for the -j conversion workers; further files wait in the "
+                            "folder (default: %(default)s)")
+    group.add_argument("--settle", type=float, default=2.0, metavar="SECONDS",
+                       help="A file is complete once its size and mtime have not changed for this long "
+                            "(default: %(default)s)")
+    group.add_argument("--poll", type=float, default=2.0, metavar="SECONDS",
+                       help="Listing interval when inotify is not available (default: %(default)s)")
+    group.add_argument("--status-interval", type=float, default=10.0, metavar="SECONDS",
+                       help="How often queue depth and rate are logged and written to "
+                            "<output-root>/.watch_status.json (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if not args.folder.is_dir():
+        raise SystemExit(f"Folder not found: {args.folder}")
+    options = build_options(args)
+
+    def convert_one(path, cancel, song_name):
+        log = lambda message: console_log(f"[{song_name}] {message}")
+        return convert_file(path, options, log, cancel=cancel, song_name=song_name).success
+
+    cancel = CancelToken()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: cancel.cancel())
+
+    daemon = WatchDaemon(args.folder, convert_one, args.output_root, workers=args.jobs,
+                         max_pending=args.max_pending, settle_seconds=args.settle,
+                         poll_seconds=args.poll, log=console_log)
+    daemon.serve(cancel, status_seconds=args.status_interval)
+    return 130
+
+
+COMMANDS = {
+    "serve": serve,
+    "compare": compare,
+    "export-wav": export_wav,
+    "submit": submit,
+    "worker": worker,
+    "queue-status": queue_status,
+    "watch": watch,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    args = build_parser().parse_args(argv)
+
+    missing = [p for p in args.inputs if not p.exists()]
+    if missing:
+        raise SystemExit(f"Input file(s) not found: {', '.join(map(str, missing))}")
+    resolved = [p.resolve() for p in args.inputs]
+    repeated = sorted({str(p) for p in args.inputs if resolved.count(p.resolve()) > 1})
+    if repeated:
+        raise SystemExit(f"Input file(s) given more than once: {', '.join(repeated)}")
+
+    options = build_options(args)
+
+    if args.dry_run:
+        dry_run(args.inputs, options)
+        order_inputs(args.inputs, options, args.order, show=True)
+        return 0
+
+    inputs = order_inputs(args.inputs, options, args.order, show=len(args.inputs) > 1)
+    profiler = Profiler()
+    results = convert(inputs, options, profiler=profiler, progress=progress_printer())
+
+    failed = [r for r in results if not r.success]
+    print(f"\n{len(results) - len(failed)}/{len(results)} file(s) converted.")
+    if any(r.cancelled for r in results):
+        print("Cancelled.")
+        return 130
+    for r in failed:
+        print(f"FAILED {r.input_path}: {r.error}")
+        for stem, error in r.failed_stems.items():
+            print(f"    {stem}: {error}")
+    if args.profile:
+        print()
+        print(profiler.summary())
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""
+Conversion benchmark: the pipeline's own overhead, without the models.
+
+Generates synthetic songs (a bass line, chords, a vocal-like tone and noise
+drums, stereo) of `--seconds` length in `--format`, puts the stub tools of
+stub_tools.py on PATH in place of demucs, basic-pitch, adtof and
+Music-Source-Separation-Training/inference.py, and times in a fresh
+interpreter per run:
+
+    convert          convert() of every song (what the GUI's run_conversion
+                     and the CLI run), Demucs only
+    convert_bandit   the same with a BandIt model (float stems, int16
+                     conversion, merging)
+    rerun            convert() again on the convert_bandit output (all up to date)
+    mix_audio        mixing two songs
+    int16            converting a float32 song to int16 in place
+    scan             listing the convert_bandit output stems and scanning their levels
+
+For each case it reports the median wall time, the throughput (seconds of
+audio per wall second) and the peak RSS of the Python process (the stubs
+run as children and are not counted). --save-baseline stores the results
+in baseline.json; later runs are compared with it and exit with status 1
+when a case gets slower or bigger than --tolerance allows:
+
+    python benchmarks/conversion.py --save-baseline
+    python benchmarks/conversion.py --tolerance 0.25
+
+The stubs are started through shell scripts, so this needs a POSIX system.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+GUI_DIR = BENCH_DIR.parent / "GuiApp"
+STUB_TOOLS = BENCH_DIR / "stub_tools.py"
+BASELINE_FILE = BENCH_DIR / "baseline.json"
+
+CASES = ["convert", "convert_bandit", "rerun", "mix_audio", "int16", "scan"]
+FORMATS = {"int16": "PCM_16", "int24": "PCM_24", "float32": "FLOAT"}
+# Settings that must match for two runs to be comparable
+SETTINGS = ["seconds", "songs", "rate", "format", "jobs", "latency"]
+
+BANDIT_CONFIG = """\
+training:
+  model_type: bandit
+  instruments: [speech, music, sfx]
+"""
+
+
+def make_song(path, seconds, rate, subtype, seed, block_frames=1 << 16):
+    """Writes a synthetic stereo song, generated block by block so long songs stay cheap."""
+    import numpy as np
+    import soundfile as sf
+
+    rng = np.random.default_rng(seed)
+    bass = rng.choice([41, 43, 45, 48], size=int(seconds) + 1)
+    chords = rng.choice([60, 62, 65, 67], size=int(seconds // 2) + 1)
+    hz = lambda note: 440.0 * 2 ** ((note - 69) / 12)
+
+    with sf.SoundFile(str(path), "w", rate, 2, subtype) as f:
+        for start in range(0, int(seconds * rate), block_frames):
+            t = np.arange(start, min(start + block_frames, int(seconds * rate))) / rate
+            second = t.astype(int)
+            mono = 0.25 * np.sin(2 * np.pi * hz(bass[second]) * t)
+            chord = chords[second // 2]
+            mono += 0.08 * sum(np.sin(2 * np.pi * hz(chord + i) * t) for i in (0, 4, 7))
+            mono += 0.15 * np.sin(2 * np.pi * 440 * t + 3 * np.sin(2 * np.pi * 5 * t))
+            beat = (t * 4) % 1
+            mono += 0.2 * rng.standard_normal(len(t)) * np.exp(-40 * beat)
+            f.write(np.stack([mono * 0.9, mono * 0.7], axis=1).astype(np.float32))
+
+
+def make_project(root, args):
+    """Scratch project folder: songs, stub tools on bin/, a BandIt model and inference.py."""
+    root = Path(root)
+    songs = root / "songs"
+    songs.mkdir()
+    for i in range(args.songs):
+        make_song(songs / f"song{i:02d}.wav", args.seconds, args.rate, FORMATS[args.format], seed=i)
+    make_song(root / "float.wav", args.seconds, args.rate, "FLOAT", seed=0)
+
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    for tool in ["demucs", "basic-pitch", "adtof"]:
+        script = bin_dir / tool
+        script.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{STUB_TOOLS}" {tool} "$@"\n')
+        script.chmod(0o755)
+
+    zft_dir = root / "Music-Source-Separation-Training"
+    zft_dir.mkdir()
+    (zft_dir / "inference.py").write_text(
+        "import runpy, sys\n"
+        f"sys.argv = [{str(STUB_TOOLS)!r}, 'inference'] + sys.argv[1:]\n"
+        f"runpy.run_path({str(STUB_TOOLS)!r}, run_name='__main__')\n"
+    )
+
+    model_dir = root / "GuiApp" / "bandit" / "Bench"
+    model_dir.mkdir(parents=True)
+    (model_dir / "config.yaml").write_text(BANDIT_CONFIG)
+    (model_dir / "model.ckpt").write_bytes(b"\0")
+    return root
+
+
+def worker(case, project, output, jobs):
+    """Runs one case in this (fresh) interpreter and prints its measurements as JSON."""
+    import time
+
+    sys.path.insert(0, str(GUI_DIR))
+    from wav2midi.audio import convert_wav, scan_levels, stem_files
+    from wav2midi.models import default_merge_target, load_bandit_model_info
+    from wav2midi.pipeline import BanditSettings, ConversionOptions, convert, mix_audio
+    from wav2midi.profiling import _rss_bytes, audio_seconds
+
+    project = Path(project)
+    songs = sorted((project / "songs").glob("*.wav"))
+
+    def run_convert(bandit):
+        options = ConversionOptions(output_root=Path(output), jobs=jobs)
+        if bandit:
+            model_dir = project / "GuiApp" / "bandit" / "Bench"
+            stems = load_bandit_model_info(model_dir)["stems"]
+            options.bandit = BanditSettings(model_dir=model_dir,
+                                            merge_targets={s: default_merge_target(s) for s in stems})
+        results = convert(songs, options, log=lambda message: None)
+        failed = [f"{r.input_path.name}: {r.error or r.failed_stems}" for r in results
+                  if not r.success or r.failed_stems]
+        if failed:
+            raise SystemExit("conversion failed: " + "; ".join(failed))
+        return sum(audio_seconds(s) for s in songs)
+
+    start = time.perf_counter()
+    if case in ("convert", "convert_bandit", "rerun"):
+        audio = run_convert(bandit=case != "convert")
+    elif case == "mix_audio":
+        mix_audio(songs[0], songs[-1], Path(output) / "mix.wav")
+        audio = audio_seconds(songs[0])
+    elif case == "int16":
+        convert_wav(Path(output) / "float.wav")
+        audio = audio_seconds(Path(output) / "float.wav")
+    elif case == "scan":
+        stems = stem_files(output, recursive=True)
+        for stem in stems:
+            scan_levels(stem)
+        audio = sum(audio_seconds(s) for s in stems)
+    seconds = time.perf_counter() - start
+
+    try:
+        import resource
+        peak = _rss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    except ImportError: # Windows
+        peak = None
+    print(json.dumps({"seconds": seconds, "audio_seconds": audio, "peak_rss": peak}))
+
+
+def run_worker(case, project, output, args, env):
+    cmd = [sys.executable, __file__, "--worker", case, "--project", str(project),
+           "--output", str(output), "--jobs", str(args.jobs)]
+    out = subprocess.run(cmd, cwd=project, env=env, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(f"{case} failed:\n{out.stdout}{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run_cases(args):
+    results = {case: [] for case in args.cases}
+    with tempfile.TemporaryDirectory() as project:
+        make_project(project, args)
+        env = dict(os.environ)
+        env["PATH"] = str(Path(project) / "bin") + os.pathsep + env.get("PATH", "")
+        env["WAV2MIDI_BENCH_LATENCY"] = json.dumps(args.latency)
+
+        for i in range(args.repeat):
+            out = Path(project) / f"out{i}"
+            out.mkdir()
+            for case in args.cases:
+                if case == "convert":
+                    output = out / "demucs_only"
+                elif case == "int16":
+                    output = out
+                    shutil.copy(Path(project) / "float.wav", out / "float.wav")
+                else:
+                    # rerun and scan work on the convert_bandit output (converted first if it was not selected)
+                    output = out / "bandit"
+                    if case != "convert_bandit" and not output.exists():
+                        run_worker("convert_bandit", project, output, args, env)
+                results[case].append(run_worker(case, project, output, args, env))
+            shutil.rmtree(out)
+    return results
+
+
+def summarize(results):
+    report = {}
+    for case, runs in results.items():
+        seconds = statistics.median(r["seconds"] for r in runs)
+        peaks = [r["peak_rss"] for r in runs if r["peak_rss"] is not None]
+        report[case] = {
+            "seconds": round(seconds, 4),
+            "throughput": round(runs[0]["audio_seconds"] / seconds, 2) if seconds else None,
+            "peak_rss_mb": round(max(peaks) / 1024 ** 2, 1) if peaks else None,
+        }
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Failure messages for cases slower or bigger than the baseline allows."""
+    failures = []
+    for case, result in report.items():
+        base = baseline["cases"].get(case)
+        if not base:
+            continue
+        if result["throughput"] and base["throughput"] and result["throughput"] < base["throughput"] * (1 - tolerance):
+            failures.append(f"{case}: throughput {result['throughput']}x < baseline {base['throughput']}x")
+        if result["peak_rss_mb"] and base["peak_rss_mb"] and result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            failures.append(f"{case}: peak RSS {result['peak_rss_mb']} MB > baseline {base['peak_rss_mb']} MB")
+    return failures
+
+
+def parse_latency(values):
+    latency = {}
+    for value in values:
+        tool, sep, seconds = value.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"expected TOOL=SECONDS, got {value!r}")
+        latency[tool] = float(seconds)
+    return latency
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure wav2midi's own overhead with stub tools.")
+    parser.add_argument("--seconds", type=float, default=30, help="Length of each synthetic song")
+    parser.add_argument("--songs", type=int, default=2)
+    parser.add_argument("--rate", type=int, default=44100)
+    parser.add_argument("--format", choices=list(FORMATS), default="int16", help="Sample format of the songs")
+    parser.add_argument("--jobs", type=int, default=1, help="Songs in flight at the same time")
+    parser.add_argument("--latency", action="append", default=[], metavar="TOOL=SECONDS",
+                        help="Delay per stub run (demucs, inference, basic-pitch, adtof); repeatable")
+    parser.add_argument("--cases", default=",".join(CASES), help=f"Comma-separated subset of {', '.join(CASES)}")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed throughput loss / memory growth against the baseline (default: 0.25)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--project", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        worker(args.worker, args.project, args.output, args.jobs)
+        return 0
+
+    try:
+        args.latency = parse_latency(args.latency)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    args.cases = [c.strip() for c in args.cases.split(",") if c.strip()]
+    unknown = [c for c in args.cases if c not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}")
+
+    report = summarize(run_cases(args))
+    settings = {name: getattr(args, name) for name in SETTINGS}
+
+    if args.json:
+        print(json.dumps({"settings": settings, "cases": report}, indent=2))
+    else:
+        print(f"{'case':<16}{'wall s':>10}{'audio x':>10}{'peak rss MB':>13}")
+        for case, r in report.items():
+            peak = "n/a" if r["peak_rss_mb"] is None else f"{r['peak_rss_mb']:.1f}"
+            print(f"{case:<16}{r['seconds']:>10.3f}{r['throughput']:>10.1f}{peak:>13}")
+
+    if args.save_baseline:
+        host = {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()}
+        with open(args.baseline, "w") as f:
+            json.dump({"settings": settings, "host": host, "cases": report}, f, indent=2)
+            f.write("\n")
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != settings:
+        print(f"Not compared with {args.baseline}: it was recorded with {baseline.get('settings')}", file=sys.stderr)
+        return 0
+    failures = compare(report, baseline, args.tolerance)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
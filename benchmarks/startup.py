@@ -0,0 +1,149 @@
+"""
+GUI startup benchmark.
+
+Runs every measurement in a fresh interpreter (so import caches do not
+carry over) from a scratch project folder with `--models` fake BandIt
+models in GuiApp/bandit, and reports the median of `--repeat` runs:
+
+    import_gui       import wav2midi_gui (must not pull in numpy/scipy/yaml)
+    scan_cold        scan_bandit_models() + every model's stems, no index yet
+    scan_warm        the same with GuiApp/bandit/.index.json in place
+    window           Wav2MidiApp(root) until the first idle (needs a display)
+
+Exits with status 1 when a heavy module is imported at startup or a
+median exceeds its budget, so it can guard against regressions:
+
+    python benchmarks/startup.py --max-import-ms 400 --max-scan-ms 50
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+GUI_DIR = Path(__file__).resolve().parent.parent / "GuiApp"
+HEAVY_MODULES = ["numpy", "scipy", "yaml", "wav2midi.pipeline"]
+
+CONFIG = """\
+training:
+  model_type: bandit
+  instruments: [speech, music, sfx]
+model:
+  in_channel: 2
+  n_bands: 64
+"""
+
+PRELUDE = f"""
+import json, sys, time
+sys.path.insert(0, {str(GUI_DIR)!r})
+"""
+
+SNIPPETS = {
+    "import_gui": """
+t = time.perf_counter()
+import wav2midi_gui
+elapsed = time.perf_counter() - t
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+""",
+    "scan": """
+from wav2midi.models import load_bandit_model_info, scan_bandit_models
+t = time.perf_counter()
+models = scan_bandit_models()
+stems = [load_bandit_model_info(d)["stems"] for d in models.values()]
+elapsed = time.perf_counter() - t
+print(json.dumps({{"seconds": elapsed, "models": len(models)}}))
+""",
+    "window": """
+import tkinter as tk
+try:
+    root = tk.Tk()
+except tk.TclError:
+    print(json.dumps({{"seconds": None}}))
+    sys.exit(0)
+t = time.perf_counter()
+import wav2midi_gui
+app = wav2midi_gui.Wav2MidiApp(root)
+root.update_idletasks()
+elapsed = time.perf_counter() - t
+root.destroy()
+print(json.dumps({{"seconds": elapsed}}))
+""",
+}
+
+
+def make_project(root, models):
+    bandit_dir = Path(root) / "GuiApp" / "bandit"
+    for i in range(models):
+        model_dir = bandit_dir / f"Model{i:02d}"
+        model_dir.mkdir(parents=True)
+        (model_dir / "config.yaml").write_text(CONFIG + "".join(f"  key{k}: {k}\n" for k in range(200)))
+        (model_dir / "model.ckpt").write_bytes(b"\0")
+    return bandit_dir
+
+
+def run_snippet(name, cwd):
+    code = PRELUDE + SNIPPETS[name].format(heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(f"{name} failed:\n{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def median_ms(results):
+    seconds = [r["seconds"] for r in results if r["seconds"] is not None]
+    return round(statistics.median(seconds) * 1000, 1) if seconds else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure wav2midi GUI startup.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--models", type=int, default=10, help="Fake BandIt models to scan")
+    parser.add_argument("--max-import-ms", type=float, help="Fail when importing the GUI takes longer")
+    parser.add_argument("--max-scan-ms", type=float, help="Fail when a warm model scan takes longer")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as project:
+        bandit_dir = make_project(project, args.models)
+        index = bandit_dir / ".index.json"
+
+        results = {"import_gui": [], "scan_cold": [], "scan_warm": [], "window": []}
+        for _ in range(args.repeat):
+            results["import_gui"].append(run_snippet("import_gui", project))
+            if index.exists():
+                os.remove(index)
+            results["scan_cold"].append(run_snippet("scan", project))
+            results["scan_warm"].append(run_snippet("scan", project))
+            results["window"].append(run_snippet("window", project))
+
+    report = {name: median_ms(rs) for name, rs in results.items()}
+    report["heavy_modules"] = sorted({m for r in results["import_gui"] for m in r["heavy"]})
+    report["models"] = args.models
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name in results:
+            value = report[name]
+            print(f"{name:<12}{'n/a (no display)' if value is None else f'{value:>8.1f} ms'}")
+        if report["heavy_modules"]:
+            print(f"heavy modules imported at startup: {', '.join(report['heavy_modules'])}")
+
+    failures = []
+    if report["heavy_modules"]:
+        failures.append("heavy modules imported at startup")
+    if args.max_import_ms is not None and report["import_gui"] > args.max_import_ms:
+        failures.append(f"import_gui {report['import_gui']} ms > {args.max_import_ms} ms")
+    if args.max_scan_ms is not None and report["scan_warm"] > args.max_scan_ms:
+        failures.append(f"scan_warm {report['scan_warm']} ms > {args.max_scan_ms} ms")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
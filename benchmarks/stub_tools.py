@@ -0,0 +1,101 @@
+"""
+Stand-ins for the external tools, used by benchmarks/conversion.py.
+
+    python stub_tools.py demucs -n MODEL INPUT -o OUT
+    python stub_tools.py basic-pitch MIDI_DIR INPUT [...]
+    python stub_tools.py adtof --audio INPUT --out MIDI [...]
+    python stub_tools.py inference --config_path CFG --input_folder IN --store_dir OUT [...]
+
+Each one reads its whole input and writes outputs of the same shape and
+format as the real tool (Demucs: 16-bit stems, inference.py: float stems,
+the transcribers: a small MIDI file), so the pipeline does the same I/O
+as in a real run while the models themselves cost (almost) nothing.
+
+WAV2MIDI_BENCH_LATENCY adds a fixed delay per tool, e.g.
+{"demucs": 2.0, "basic-pitch": 0.5}, to model slow separators.
+"""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import soundfile as sf
+
+DEMUCS_STEMS = ["vocals", "drums", "bass", "other"]
+DEMUCS_6S_STEMS = DEMUCS_STEMS + ["guitar", "piano"]
+
+# One note, so the transcribers' output is a valid, non-empty MIDI file
+NOTE_MIDI = (
+    b"MThd\x00\x00\x00\x06\x00\x00\x00\x01\x00\xdcMTrk\x00\x00\x00\x0c"
+    b"\x00\x90\x3c\x64\x60\x80\x3c\x00\x00\xff\x2f\x00"
+)
+
+
+def delay(tool):
+    latency = json.loads(os.environ.get("WAV2MIDI_BENCH_LATENCY") or "{}")
+    if latency.get(tool):
+        time.sleep(latency[tool])
+
+
+def option(argv, name):
+    return argv[argv.index(name) + 1]
+
+
+def read(path):
+    data, rate = sf.read(str(path), dtype="float32", always_2d=True)
+    return data, rate
+
+
+def demucs(argv):
+    model = option(argv, "-n")
+    out_root = Path(option(argv, "-o"))
+    input_path = Path(next(a for a in argv if a.lower().endswith((".wav", ".flac"))))
+    data, rate = read(input_path)
+    delay("demucs")
+
+    out_dir = out_root / model / input_path.stem
+    out_dir.mkdir(parents=True, exist_ok=True)
+    stems = DEMUCS_6S_STEMS if model.endswith("6s") else DEMUCS_STEMS
+    for i, stem in enumerate(stems):
+        sf.write(str(out_dir / f"{stem}.wav"), data * (0.5 / (i + 1)), rate, subtype="PCM_16")
+
+
+def transcribe(tool, input_path, midi_out):
+    read(input_path)
+    delay(tool)
+    if midi_out.exists():
+        raise SystemExit(f"{midi_out} exists")
+    midi_out.write_bytes(NOTE_MIDI)
+
+
+def basic_pitch(argv):
+    midi_dir, input_path = Path(argv[0]), Path(argv[1])
+    transcribe("basic-pitch", input_path, midi_dir / f"{input_path.stem}_basic_pitch.mid")
+
+
+def adtof(argv):
+    transcribe("adtof", Path(option(argv, "--audio")), Path(option(argv, "--out")))
+
+
+def inference(argv):
+    """ZFTurbo inference.py: every file of --input_folder to <store_dir>/<track>/<stem>.wav (float)."""
+    import yaml
+
+    with open(option(argv, "--config_path")) as f:
+        stems = yaml.safe_load(f)["training"]["instruments"]
+    store_dir = Path(option(argv, "--store_dir"))
+    for input_path in sorted(Path(option(argv, "--input_folder")).iterdir()):
+        data, rate = read(input_path)
+        delay("inference")
+        out_dir = store_dir / input_path.stem
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for i, stem in enumerate(stems):
+            sf.write(str(out_dir / f"{stem}.wav"), data * (0.8 / (i + 1)), rate, subtype="FLOAT")
+
+
+TOOLS = {"demucs": demucs, "basic-pitch": basic_pitch, "adtof": adtof, "inference": inference}
+
+
+if __name__ == "__main__":
+    TOOLS[sys.argv[1]](sys.argv[2:])